@@ -0,0 +1,930 @@
+#!/usr/bin/env python3
+"""
+Image processing building blocks that don't need hardware
+"""
+
+import unittest
+from unittest import mock
+import threading
+import tempfile
+import json
+import os
+import numpy as np
+import cv2
+from uscope.imagep.util import TaskScheduler, TaskBarrier, TASK_PRIORITY_INTERACTIVE
+from uscope.imagep.align import estimate_transform, align_images, ALIGN_QUALITY_WARN
+from uscope.imagep.cache import ProcessingCache
+from uscope.cloud_stitch import upload_filenames
+from uscope.imagep.plugins import median_stack, load_stack, MEDIAN_NETWORK_MAX
+from uscope.imagep.codec import save_image, load_image, image_exif, unshare
+from uscope.imagep.util import EtherealImageR, EtherealImageW, image_to_shm, image_from_shm, encode_data, decode_data, encode_data_results, decode_data_results
+from uscope.imagep.qr import find_qr_code_match_fn, QRPositions
+from uscope.imagep import qr as qr_module
+from uscope.imagep.validate import validate_image, check_valid_image_dir, InvalidImageDir
+from uscope.scan_util import index_scan_images
+from uscope.imagep.materialize import materialize
+from uscope.imagep.deconv import load_psf, PSFTransform, deconvolve
+from uscope.imagep.summary import write_dzi_pyramid, read_dzi, rotation_inverse_map, write_snapshot_grid, write_html_viewer
+from uscope.imagep.thumbnails import get_thumbnails
+from uscope.imagep.stitch import write_preview_stitch
+from uscope.imagep.bigtiff import TIFFStripWriter
+from uscope.imagep.ff import load_ff_calibration, ff_correct
+from PIL import Image
+
+
+class Task:
+    def __init__(self, name):
+        self.name = name
+
+
+class TestTaskScheduler(unittest.TestCase):
+    def test_priority(self):
+        scheduler = TaskScheduler()
+        batch1 = Task("batch1")
+        batch2 = Task("batch2")
+        snapshot = Task("snapshot")
+        scheduler.put(batch1)
+        scheduler.put(batch2)
+        scheduler.put(snapshot, priority=TASK_PRIORITY_INTERACTIVE)
+        self.assertIs(scheduler.get(), snapshot)
+        # FIFO within a priority
+        self.assertIs(scheduler.get(), batch1)
+        self.assertIs(scheduler.get(), batch2)
+        self.assertIsNone(scheduler.get(timeout=0.01))
+
+    def test_deps(self):
+        scheduler = TaskScheduler()
+        a = Task("a")
+        b = Task("b")
+        c = Task("c")
+        scheduler.put(a)
+        scheduler.put(b)
+        scheduler.put(c, deps=[a, b])
+        self.assertIs(scheduler.get(), a)
+        self.assertIs(scheduler.get(), b)
+        scheduler.task_done(a)
+        self.assertIsNone(scheduler.get(timeout=0.01))
+        scheduler.task_done(b)
+        self.assertIs(scheduler.get(timeout=0.01), c)
+        # Already completed dependencies don't block
+        d = Task("d")
+        scheduler.put(d, deps=[a])
+        self.assertIs(scheduler.get(timeout=0.01), d)
+
+    def test_close(self):
+        scheduler = TaskScheduler()
+        got = []
+        thread = threading.Thread(target=lambda: got.append(scheduler.get()))
+        thread.start()
+        scheduler.close()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(got, [None])
+
+
+class TestTaskBarrier(unittest.TestCase):
+    def test_wait(self):
+        tb = TaskBarrier()
+        callbacks = [tb.allocate_callback() for _i in range(3)]
+        threads = [threading.Thread(target=callback) for callback in callbacks]
+        for thread in threads:
+            thread.start()
+        tb.wait(timeout=1.0)
+        self.assertTrue(tb.idle())
+
+    def test_timeout(self):
+        tb = TaskBarrier()
+        tb.allocate_callback()
+        with self.assertRaises(Exception):
+            tb.wait(timeout=0.01)
+
+
+def make_texture(wh=(600, 400), seed=0):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (wh[1] // 10, wh[0] // 10, 3),
+                         dtype=np.uint8)
+    return cv2.GaussianBlur(cv2.resize(small, wh), (5, 5), 0)
+
+
+class TestAlign(unittest.TestCase):
+    def test_translation(self):
+        ref = make_texture()
+        warp_in = np.float32([[1, 0, 5.0], [0, 1, -3.0]])
+        image = cv2.warpAffine(ref,
+                               warp_in,
+                               ref.shape[1::-1],
+                               borderMode=cv2.BORDER_REPLICATE)
+        warp, quality = estimate_transform(ref, image)
+        self.assertAlmostEqual(warp[0, 2], 5.0, delta=0.5)
+        self.assertAlmostEqual(warp[1, 2], -3.0, delta=0.5)
+        self.assertGreater(quality, 0.95)
+
+    def test_exposure_invariant(self):
+        ref = make_texture()
+        dark = (ref * 0.3).astype(np.uint8)
+        aligned, info = align_images([ref, dark])
+        self.assertEqual(len(aligned), 2)
+        self.assertGreater(info["quality"], 0.95)
+
+    def test_unrelated(self):
+        _aligned, info = align_images(
+            [make_texture(seed=0), make_texture(seed=1)])
+        self.assertLess(info["quality"], ALIGN_QUALITY_WARN)
+
+
+class TestMedianStack(unittest.TestCase):
+    def test_matches_numpy(self):
+        rng = np.random.default_rng(0)
+        for n in (1, 2, 3, 4, 5, MEDIAN_NETWORK_MAX + 1,
+                  MEDIAN_NETWORK_MAX + 2):
+            images = [
+                rng.integers(0, 256, (31, 17, 3), dtype=np.uint8)
+                for _i in range(n)
+            ]
+            expect = np.median(np.stack(images, axis=3),
+                               axis=3).astype(np.uint8)
+            # Several strips
+            got = median_stack(images, strip_bytes=1000)
+            self.assertTrue((got == expect).all(), n)
+
+    def test_load_stack(self):
+        rng = np.random.default_rng(0)
+        images = [
+            rng.integers(0, 256, (31, 17, 3), dtype=np.uint8)
+            for _i in range(5)
+        ]
+        exif = Image.Exif()
+        exif[0x010f] = "uscope"
+        exif = exif.tobytes()
+        expect = median_stack(images)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, "c000_r000_is00.npy")
+            save_image(Image.fromarray(images[0]), fn, exif=exif)
+            images_in = [EtherealImageR(fn=fn)] + [
+                EtherealImageR(im=Image.fromarray(image))
+                for image in images[1:]
+            ]
+            for max_bytes in (1 << 30, 0):
+                frames, got_exif = load_stack(images_in, tmp_dir, max_bytes)
+                self.assertEqual(got_exif, exif)
+                # Not decoded
+                self.assertIsInstance(frames[0], np.memmap)
+                # Big stacks go to disk
+                self.assertEqual(isinstance(frames[1], np.memmap),
+                                 max_bytes == 0)
+                self.assertTrue((median_stack(frames) == expect).all())
+                del frames
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_npy(self):
+        image = make_texture((60, 40))
+        fn = os.path.join(self.tmp.name, "c000_r000.npy")
+        exif = Image.Exif()
+        # Exposure time
+        exif[33434] = 0.01
+        exif = exif.tobytes()
+        save_image(Image.fromarray(image), fn, quality=90, exif=exif)
+        im = load_image(fn)
+        self.assertTrue((np.asarray(im) == image).all())
+        self.assertEqual(im.info["exif"], exif)
+        # External tools get a file they can read
+        imr = EtherealImageR(fn=fn)
+        self.assertTrue(imr.get_filename().endswith(".tif"))
+        self.assertTrue((np.asarray(Image.open(imr.get_filename())) == image
+                         ).all())
+
+    def test_tif_lossless(self):
+        image = make_texture((60, 40))
+        fn = os.path.join(self.tmp.name, "c000_r000.tif")
+        imw = EtherealImageW(want_fn=fn,
+                             save_kwargs={"compression": "tiff_lzw"})
+        imw.set_im(Image.fromarray(image), quality=90)
+        self.assertTrue((np.asarray(load_image(fn)) == image).all())
+
+    def test_tif_exif_to_jpg(self):
+        fn = os.path.join(self.tmp.name, "c000_r000.tif")
+        exif = Image.Exif()
+        # Make, exposure time
+        exif[0x010f] = "uscope"
+        exif.get_ifd(0x8769)[33434] = 0.01
+        Image.fromarray(make_texture((60, 40))).save(fn, exif=exif.tobytes())
+        fn_jpg = os.path.join(self.tmp.name, "c000_r000.jpg")
+        Image.open(fn).save(fn_jpg, exif=image_exif(Image.open(fn)))
+        exif = Image.open(fn_jpg).getexif()
+        self.assertEqual(exif[0x010f], "uscope")
+        self.assertEqual(exif.get_ifd(0x8769)[33434], 0.01)
+        # TIFF strip layout doesn't leak into the JPEG
+        self.assertNotIn(273, exif)
+
+    def test_in_memory_chain(self):
+        """
+        Save kwargs given to an in memory stage reach the final file
+        """
+        image = make_texture((60, 40))
+        exif = Image.Exif()
+        exif[0x010f] = "uscope"
+        exif = exif.tobytes()
+        imw = EtherealImageW(want_im=True)
+        imw.set_im(Image.fromarray(image), quality=95, exif=exif)
+        self.assertEqual(imw.get_im().info["exif"], exif)
+        imr = EtherealImageR(im=imw.get_im(),
+                             save_kwargs=imw.get_save_kwargs())
+
+        # Next stage doesn't know about the EXIF
+        imw = EtherealImageW(want_im=True)
+        imw.inherit_save_kwargs([imr])
+        imw.set_im(Image.fromarray(255 - image), quality=90)
+        self.assertEqual(imw.get_save_kwargs(), {"quality": 90, "exif": exif})
+        imr = EtherealImageR(im=imw.get_im(),
+                             save_kwargs=imw.get_save_kwargs())
+
+        # Through a worker process and back
+        shms = []
+        data_in = decode_data(encode_data({"image": imr}, shms))
+        data_out = {"image": EtherealImageW(want_im=True)}
+        data_out_worker = decode_data(encode_data(data_out, shms))
+        data_out_worker["image"].inherit_save_kwargs([data_in["image"]])
+        data_out_worker["image"].set_im(data_in["image"].to_im())
+        decode_data_results(data_out, encode_data_results(data_out_worker))
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        self.assertEqual(data_out["image"].get_im().info["exif"], exif)
+        imr = EtherealImageR(im=data_out["image"].get_im(),
+                             save_kwargs=data_out["image"].get_save_kwargs())
+
+        fn = os.path.join(self.tmp.name, "c000_r000.jpg")
+        imw = EtherealImageW(want_fn=fn)
+        imw.inherit_save_kwargs([imr])
+        imw.set_im(imr.to_im(), quality=95)
+        im = Image.open(fn)
+        self.assertEqual(im.getexif()[0x010f], "uscope")
+        err = np.abs(np.asarray(im).astype(float) - (255 - image)).mean()
+        self.assertLess(err, 3.0)
+
+    def test_shm(self):
+        image = make_texture((60, 40))
+        shm, desc = image_to_shm(Image.fromarray(image))
+        try:
+            # Attaching doesn't take the block from its creator
+            im = image_from_shm(desc)
+            self.assertEqual(im.mode, "RGB")
+            self.assertTrue((np.asarray(im) == image).all())
+            im = image_from_shm(desc)
+            self.assertTrue((np.asarray(im) == image).all())
+        finally:
+            shm.close()
+            shm.unlink()
+        with self.assertRaises(FileNotFoundError):
+            image_from_shm(desc)
+
+        # Handed over: the reader unlinks it
+        shm, desc = image_to_shm(Image.fromarray(image[:, :, 0]))
+        shm.close()
+        im = image_from_shm(desc, unlink=True)
+        self.assertEqual(im.mode, "L")
+        self.assertTrue((np.asarray(im) == image[:, :, 0]).all())
+        with self.assertRaises(FileNotFoundError):
+            image_from_shm(desc)
+
+
+class TestQR(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_find(self):
+        image = make_texture((1200, 800))
+        fn = os.path.join(self.tmp.name, "c000_r000.jpg")
+        Image.fromarray(image).save(fn, quality=90)
+        self.assertEqual(find_qr_code_match_fn(fn, "chip-.*"), (None, None))
+        qr = cv2.QRCodeEncoder.create().encode("chip-1234")
+        # 8 pixels per module: readable without a full resolution decode
+        qr = cv2.resize(qr,
+                        None,
+                        fx=8,
+                        fy=8,
+                        interpolation=cv2.INTER_NEAREST)
+        image[100:100 + qr.shape[0], 200:200 + qr.shape[1]] = qr[:, :, None]
+        Image.fromarray(image).save(fn, quality=90)
+        self.assertEqual(find_qr_code_match_fn(fn, "chip-.*"),
+                         ("chip-1234", 2))
+        self.assertEqual(find_qr_code_match_fn(fn, "wafer-.*"), (None, None))
+
+    def test_find_small(self):
+        """
+        Too small to see at 1/2 scale: found at full resolution
+        """
+        image = make_texture((1200, 800))
+        qr = cv2.QRCodeEncoder.create().encode("chip-5678")
+        qr = cv2.resize(qr, None, fx=3, fy=3, interpolation=cv2.INTER_NEAREST)
+        image[100:100 + qr.shape[0], 200:200 + qr.shape[1]] = qr[:, :, None]
+        fn = os.path.join(self.tmp.name, "c000_r000.png")
+        Image.fromarray(image).save(fn)
+        self.assertEqual(find_qr_code_match_fn(fn, "chip-.*", scales=(2, )),
+                         (None, None))
+        self.assertEqual(find_qr_code_match_fn(fn, "chip-.*"),
+                         ("chip-5678", 1))
+
+    def test_find_large(self):
+        image = make_texture((1200, 800))
+        qr = cv2.QRCodeEncoder.create().encode("chip-9012")
+        # 32 pixels per module: 1/8 scale is enough
+        qr = cv2.resize(qr,
+                        None,
+                        fx=32,
+                        fy=32,
+                        interpolation=cv2.INTER_NEAREST)
+        image[0:qr.shape[0], 0:qr.shape[1]] = qr[:, :, None]
+        fn = os.path.join(self.tmp.name, "c000_r000.jpg")
+        Image.fromarray(image).save(fn, quality=90)
+        self.assertEqual(find_qr_code_match_fn(fn, "chip-.*"),
+                         ("chip-9012", 8))
+
+    def count_full_decodes(self, fn, expr):
+        """
+        Return (find_qr_code_match_fn() result, full resolution decodes)
+        """
+        with mock.patch.object(qr_module,
+                               "decode_full",
+                               wraps=qr_module.decode_full) as decode_full:
+            ret = find_qr_code_match_fn(fn, expr)
+        return ret, decode_full.call_count
+
+    def test_no_label_full_decodes(self):
+        """
+        Most tiles have no label: don't pay for a full resolution decode
+        """
+        image = make_texture((1200, 800))
+        fn = os.path.join(self.tmp.name, "c000_r000.jpg")
+        Image.fromarray(image).save(fn, quality=90)
+        self.assertEqual(self.count_full_decodes(fn, "chip-.*"),
+                         ((None, None), 0))
+        # No draft decode: one full decode, reduced from there
+        fn = os.path.join(self.tmp.name, "c000_r000.png")
+        Image.fromarray(image).save(fn)
+        self.assertEqual(self.count_full_decodes(fn, "chip-.*"),
+                         ((None, None), 1))
+
+        # Too small to read at reduced scale but located: worth a full decode
+        qr = cv2.QRCodeEncoder.create().encode("chip-5678")
+        qr = cv2.resize(qr, None, fx=3, fy=3, interpolation=cv2.INTER_NEAREST)
+        image[100:100 + qr.shape[0], 200:200 + qr.shape[1]] = qr[:, :, None]
+        fn = os.path.join(self.tmp.name, "c000_r001.jpg")
+        Image.fromarray(image).save(fn, quality=95)
+        self.assertEqual(self.count_full_decodes(fn, "chip-.*"),
+                         (("chip-5678", 1), 1))
+
+    def test_positions(self):
+        fn = os.path.join(self.tmp.name, "qr_positions.json")
+        iindex = {
+            "images": {
+                "c000_r000.jpg": {
+                    "col": 0,
+                    "row": 0
+                },
+                "c000_r001.jpg": {
+                    "col": 0,
+                    "row": 1
+                },
+                "c001_r000.jpg": {
+                    "col": 1,
+                    "row": 0
+                },
+            }
+        }
+        QRPositions(fn).record(1, 0)
+        self.assertEqual(
+            QRPositions(fn).order(iindex),
+            ["c001_r000.jpg", "c000_r000.jpg", "c000_r001.jpg"])
+
+
+class TestValidate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def truncate(self, fn):
+        os.truncate(fn, os.stat(fn).st_size - 100)
+
+    def test_truncated(self):
+        image = Image.fromarray(make_texture((60, 40)))
+        for basename, kwargs in (("c000_r000.jpg", {}), ("c000_r001.tif", {}),
+                                 ("c000_r002.tif", {
+                                     "compression": "tiff_lzw"
+                                 })):
+            fn = os.path.join(self.tmp.name, basename)
+            save_image(image, fn, **kwargs)
+            self.assertEqual(validate_image(fn, decode=True), [])
+            self.truncate(fn)
+            problems = validate_image(fn)
+            self.assertTrue(problems)
+            self.assertTrue(all(p["fatal"] for p in problems))
+        fn = os.path.join(self.tmp.name, "c000_r003.npy")
+        save_image(image, fn)
+        self.truncate(fn)
+        self.assertEqual(validate_image(fn)[0]["check"], "npy")
+
+    def test_dir(self):
+        image = Image.fromarray(make_texture((60, 40)))
+        for row in range(3):
+            image.save(os.path.join(self.tmp.name, "c000_r%03u.jpg" % row))
+        # Readers don't mind trailing junk
+        with open(os.path.join(self.tmp.name, "c000_r001.jpg"), "ab") as f:
+            f.write(b"junk")
+        iindex = index_scan_images(self.tmp.name)
+        report = check_valid_image_dir(iindex, log=lambda s: None)
+        self.assertEqual(report["files"], 3)
+        self.assertEqual([(p["file"], p["fatal"]) for p in report["problems"]],
+                         [("c000_r001.jpg", False)])
+        self.truncate(os.path.join(self.tmp.name, "c000_r002.jpg"))
+        with self.assertRaises(InvalidImageDir) as cm:
+            check_valid_image_dir(iindex, log=lambda s: None)
+        self.assertIn("c000_r002.jpg",
+                      [p["file"] for p in cm.exception.problems if p["fatal"]])
+
+
+class TestMaterialize(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "src.jpg")
+        self.dst = os.path.join(self.tmp.name, "dst.jpg")
+        with open(self.src, "wb") as f:
+            f.write(b"src")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, fn):
+        with open(fn, "rb") as f:
+            return f.read()
+
+    def test_methods(self):
+        for method in ("hardlink", "copy"):
+            self.assertEqual(
+                materialize(self.src, self.dst, methods=(method, )), method)
+            self.assertEqual(self.read(self.dst), b"src")
+        # reflink needs btrfs / XFS: must fall back, not fail
+        self.assertIn(
+            materialize(self.src, self.dst, methods=("reflink", "copy")),
+            ("reflink", "copy"))
+        self.assertEqual(self.read(self.dst), b"src")
+
+    def test_unshare(self):
+        materialize(self.src, self.dst, methods=("hardlink", ))
+        unshare(self.dst)
+        with open(self.dst, "wb") as f:
+            f.write(b"dst")
+        self.assertEqual(self.read(self.src), b"src")
+
+    def test_write_unshares(self):
+        """
+        Outputs written through EtherealImageW leave a hardlinked source alone
+        """
+        Image.new("RGB", (8, 8), "white").save(self.src)
+        src = self.read(self.src)
+        for fn in ("set_im.jpg", "get_filename.jpg"):
+            fn = os.path.join(self.tmp.name, fn)
+            materialize(self.src, fn, methods=("hardlink", ))
+            image = EtherealImageW(want_fn=fn)
+            if "set_im" in fn:
+                image.set_im(Image.new("RGB", (8, 8), "black"))
+            else:
+                # ex: CLI tool
+                with open(image.get_filename(), "wb") as f:
+                    f.write(b"dst")
+            self.assertEqual(self.read(self.src), src)
+            self.assertNotEqual(self.read(fn), src)
+
+
+def ff_correct_reference(image, ff):
+    """
+    Per band flat field correction as CorrectFF1Plugin used to do it
+    """
+    ret = []
+    for band in range(3):
+        ff_band = Image.fromarray(ff[:, :, band])
+        hist = ff_band.histogram()
+        npixels = ff_band.width * ff_band.height
+        pixels = 0
+        for high, vals in enumerate(hist):
+            pixels += vals
+            if pixels / npixels >= 0.99:
+                break
+        scalar = high / ff[:, :, band]
+        ret.append(
+            np.minimum(np.round(image[:, :, band] * scalar),
+                       255).astype(np.uint8))
+    return np.dstack(ret)
+
+
+class TestFF(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        rng = np.random.default_rng(0)
+        # Vignetting + pixel noise
+        y, x = np.mgrid[0:48, 0:64]
+        r2 = ((x - 32) / 32.0)**2 + ((y - 24) / 24.0)**2
+        illum = 220 - 80 * r2[:, :, None] * np.array([1.0, 0.8, 1.2])
+        illum = illum + rng.normal(0, 3, illum.shape)
+        self.illum = np.clip(illum, 1, 255)
+        self.image = np.clip(self.illum * 0.6, 0, 255).astype(np.uint8)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, basename, array):
+        fn = os.path.join(self.tmp.name, basename)
+        Image.fromarray(array.astype(np.uint8)).save(fn)
+        return fn
+
+    def test_reference(self):
+        """
+        Same output as the old per band algorithm
+        """
+        ff = self.illum.astype(np.uint8)
+        cal = load_ff_calibration(self.write("ff.tif", ff),
+                                  cache_dir=self.cache_dir)
+        corrected = ff_correct(self.image, cal)
+        expect = ff_correct_reference(self.image, ff)
+        diff = np.abs(corrected.astype(int) - expect)
+        # float32 vs float64 rounding
+        self.assertLessEqual(diff.max(), 1)
+        self.assertLess(np.count_nonzero(diff) / diff.size, 0.01)
+
+    def test_dark(self):
+        dark = np.full(self.illum.shape, 12.0)
+        dark[::7, ::5] = 30
+        cal = load_ff_calibration(self.write("ff.tif", self.illum + dark),
+                                  dark_fn=self.write("dark.tif", dark),
+                                  cache_dir=self.cache_dir)
+        image = (self.illum.astype(np.uint8) // 2 + dark).astype(np.uint8)
+        corrected = ff_correct(image, cal).astype(float)
+        # Flat once dark is removed and vignetting is corrected
+        for band in range(3):
+            mean = corrected[:, :, band].mean()
+            self.assertLess(np.abs(corrected[:, :, band] - mean).max(), 4.0)
+        # Without dark subtraction the dark pattern shows through
+        flat = ff_correct(
+            image,
+            load_ff_calibration(self.write("ff2.tif", self.illum + dark),
+                                cache_dir=self.cache_dir))
+        self.assertGreater(
+            flat.std(axis=(0, 1)).min(),
+            corrected.std(axis=(0, 1)).max())
+
+    def test_16bit(self):
+        cal = load_ff_calibration(self.write("ff.tif", self.illum),
+                                  cache_dir=self.cache_dir)
+        corrected8 = ff_correct(self.image, cal)
+        corrected16 = ff_correct(self.image, cal, bits=16)
+        self.assertEqual(corrected16.dtype, np.uint16)
+        self.assertLessEqual(
+            np.abs(corrected16 / 257.0 - corrected8).max(), 0.5 + 1e-3)
+
+        exif = Image.Exif()
+        exif[0x010f] = "pyuscope"
+        exif.get_ifd(0x8769)[0x829a] = 0.25
+        for basename in ("out.tif", "out.npy", "out.png"):
+            fn = os.path.join(self.tmp.name, basename)
+            EtherealImageW(want_fn=fn).set_im(corrected16, exif=exif.tobytes())
+            if basename.endswith(".npy"):
+                got = np.load(fn)
+            else:
+                got = cv2.cvtColor(cv2.imread(fn, cv2.IMREAD_UNCHANGED),
+                                   cv2.COLOR_BGR2RGB)
+            np.testing.assert_array_equal(got, corrected16)
+            if basename.endswith(".tif"):
+                with Image.open(fn) as im:
+                    self.assertEqual(im.getexif()[0x010f], "pyuscope")
+                    self.assertEqual(
+                        float(im.getexif().get_ifd(0x8769)[0x829a]), 0.25)
+        with self.assertRaises(ValueError):
+            EtherealImageW(want_im=True).set_im(corrected16)
+
+    def test_cache(self):
+        """
+        Gain map is computed once, memory mapped and redone when the file changes
+        """
+        ff_fn = self.write("ff.tif", self.illum)
+        cal = load_ff_calibration(ff_fn, cache_dir=self.cache_dir)
+        self.assertIsInstance(cal.gain, np.memmap)
+        self.assertFalse(cal.gain.flags.writeable)
+        self.assertEqual(cal.size, (64, 48))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        gain_fn = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        mtime = os.stat(gain_fn).st_mtime_ns
+        cal2 = load_ff_calibration(ff_fn, cache_dir=self.cache_dir)
+        np.testing.assert_array_equal(cal.gain, cal2.gain)
+        self.assertEqual(os.stat(gain_fn).st_mtime_ns, mtime)
+
+        # New calibration
+        self.write("ff.tif", np.full(self.illum.shape, 100))
+        st = os.stat(ff_fn)
+        os.utime(ff_fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        cal3 = load_ff_calibration(ff_fn, cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        np.testing.assert_allclose(cal3.gain, 1.0)
+
+
+class TestDeconv(unittest.TestCase):
+    def test_deconvolve(self):
+        rng = np.random.default_rng(0)
+        image = cv2.GaussianBlur(
+            rng.uniform(0, 255, (96, 128)).astype(np.float32), (0, 0), 2.0)
+        image = np.dstack([image] * 3)
+        psf = load_psf({"gaussian": 1.5})
+        blurred = image.copy()
+        blurred[:, :, 2] = cv2.filter2D(image[:, :, 2], -1, psf,
+                                        borderType=cv2.BORDER_REFLECT)
+        transforms = {2: PSFTransform(psf, image.shape[0:2])}
+        error = np.abs(blurred - image)[:, :, 2].mean()
+        for method in ("wiener", "richardson-lucy"):
+            result = deconvolve(blurred,
+                                transforms,
+                                method=method,
+                                balance=0.001,
+                                iterations=20)
+            # Other channels untouched
+            self.assertTrue(np.array_equal(result[:, :, 0:2], blurred[:, :,
+                                                                       0:2]))
+            self.assertLess(
+                np.abs(result - image)[:, :, 2].mean(), error * 0.5, method)
+
+
+class TestDZIPyramid(unittest.TestCase):
+    def test_grid(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            texture = make_texture((300, 200))
+            for col in range(3):
+                for row in range(2):
+                    cv2.imwrite(
+                        os.path.join(tmp, "c%03u_r%03u.jpg" % (col, row)),
+                        texture)
+            dzi_fn = write_dzi_pyramid(index_scan_images(tmp),
+                                       layout="grid",
+                                       nthreads=2)
+            dzi = read_dzi(dzi_fn)
+            self.assertEqual((dzi["width"], dzi["height"]), (900, 400))
+            files_dir = os.path.splitext(dzi_fn)[0] + "_files"
+            # 1024 > 900 => level 10 is full resolution
+            self.assertEqual(sorted(int(d) for d in os.listdir(files_dir)),
+                             list(range(11)))
+            self.assertEqual(
+                cv2.imread(os.path.join(files_dir, "10", "1_0.jpg")).shape,
+                (255, 256, 3))
+            self.assertEqual(
+                cv2.imread(os.path.join(files_dir, "10", "3_1.jpg")).shape,
+                (147, 139, 3))
+            self.assertEqual(
+                cv2.imread(os.path.join(files_dir, "0", "0_0.jpg")).shape,
+                (1, 1, 3))
+
+
+class TestThumbnails(unittest.TestCase):
+    def test_summaries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            texture = make_texture((600, 400))
+            for col in range(3):
+                for row in range(2):
+                    cv2.imwrite(
+                        os.path.join(tmp, "c%03u_r%03u.jpg" % (col, row)),
+                        texture)
+            iindex = index_scan_images(tmp)
+            write_html_viewer(iindex, nthreads=2)
+            thumbnails = get_thumbnails(iindex)
+            fn = os.path.join(tmp, "c000_r000.jpg")
+            thumb_fn = thumbnails["c000_r000.jpg"]
+            self.assertEqual(Image.open(thumb_fn).size, (256, 171))
+            with open(os.path.join(tmp, "index.html")) as f:
+                html = f.read()
+            self.assertIn(
+                '<a href="c000_r000.jpg"><img src="thumbnails/256/c000_r000.jpg"',
+                html)
+            self.assertIn('loading="lazy"', html)
+
+            # Only remade when the image changes
+            mtime = os.stat(thumb_fn).st_mtime_ns
+            get_thumbnails(iindex)
+            self.assertEqual(os.stat(thumb_fn).st_mtime_ns, mtime)
+            stale = os.stat(fn).st_mtime_ns - 10**9
+            os.utime(thumb_fn, ns=(stale, stale))
+            get_thumbnails(iindex)
+            self.assertGreater(os.stat(thumb_fn).st_mtime_ns, stale)
+
+            # 3 x 103 px images + 2 x 3 px spacing
+            grid_fn = os.path.join(tmp, "tiles.jpg")
+            write_snapshot_grid(iindex, grid_fn, max_size=320)
+            self.assertEqual(Image.open(grid_fn).size, (315, 141))
+            write_snapshot_grid(iindex, grid_fn, max_size=None)
+            self.assertEqual(Image.open(grid_fn).size, (1840, 820))
+
+
+class TestQuickPano(unittest.TestCase):
+    def test_rotation_matches_pil(self):
+        image = cv2.cvtColor(make_texture((200, 150)), cv2.COLOR_RGB2GRAY)
+        for angle in (2.0, -3.0):
+            expect = np.asarray(
+                Image.fromarray(image).rotate(angle,
+                                              Image.BICUBIC,
+                                              expand=True)).astype(int)
+            w, h, matrix = rotation_inverse_map(200, 150, angle)
+            self.assertEqual((h, w), expect.shape)
+            got = cv2.warpAffine(image,
+                                 matrix, (w, h),
+                                 flags=cv2.INTER_CUBIC
+                                 | cv2.WARP_INVERSE_MAP)
+            # Interpolation kernels differ slightly
+            self.assertLessEqual(
+                np.abs(got[20:-20, 20:-20] - expect[20:-20, 20:-20]).max(), 3)
+
+
+class TestPreviewStitch(unittest.TestCase):
+    def test_registers_stage_error(self):
+        scene = make_texture((1100, 600))
+        # Stage error (pixels) of each image
+        errors = {
+            (0, 0): (0, 0),
+            (1, 0): (7, -5),
+            (2, 0): (-6, 4),
+            (0, 1): (5, 6),
+            (1, 1): (-8, -3),
+            (2, 1): (3, -7),
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {}
+            for (col, row), (dx, dy) in errors.items():
+                # Nominal: 400 x 300 images, 100 pixel overlap
+                # Row 0 at the bottom
+                x = 50 + col * 300
+                y = 50 + (1 - row) * 200
+                basename = "c%03u_r%03u.jpg" % (col, row)
+                cv2.imwrite(os.path.join(tmp, basename),
+                            scene[y + dy:y + dy + 300, x + dx:x + dx + 400],
+                            [cv2.IMWRITE_JPEG_QUALITY, 95])
+                files[basename] = {
+                    "col": col,
+                    "row": row,
+                    # 1 um / pixel
+                    "position": {
+                        "x": x / 1000,
+                        "y": (600 - y) / 1000
+                    },
+                }
+            with open(os.path.join(tmp, "uscan.json"), "w") as f:
+                json.dump(
+                    {
+                        "files": files,
+                        "image-save": {
+                            "extension": ".jpg"
+                        },
+                        "pconfig": {
+                            "app": {
+                                "objective": {
+                                    "um_per_pixel": 1.0
+                                }
+                            }
+                        },
+                    }, f)
+            report = write_preview_stitch(index_scan_images(tmp),
+                                          os.path.join(tmp, "stitch.jpg"),
+                                          nthreads=2)
+            self.assertEqual(report["registered"], 7)
+            positions = report["positions"]
+            x0, y0 = positions["c000_r000"]
+            for (col, row), (dx, dy) in errors.items():
+                x, y = positions["c%03u_r%03u" % (col, row)]
+                expect_x = col * 300 + dx
+                expect_y = (1 - row) * 200 + dy - 200
+                self.assertLessEqual(abs(x - x0 - expect_x), 1, (col, row))
+                self.assertLessEqual(abs(y - y0 - expect_y), 1, (col, row))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "stitch.json")))
+
+
+class TestTIFFStripWriter(unittest.TestCase):
+    def test_round_trip(self):
+        image = make_texture((517, 333))
+        with tempfile.TemporaryDirectory() as tmp:
+            for bigtiff in (False, True):
+                fn = os.path.join(tmp, "out.tif")
+                with TIFFStripWriter(fn,
+                                     517,
+                                     333,
+                                     rows_per_strip=50,
+                                     bigtiff=bigtiff) as tiff:
+                    # Not a multiple of the strip size
+                    for y in range(0, 333, 77):
+                        tiff.write_rows(image[y:y + 77])
+                self.assertEqual(validate_image(fn, decode=True), [])
+                with Image.open(fn) as im:
+                    self.assertTrue(np.array_equal(np.asarray(im), image))
+
+
+class TestProcessingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.fn_in = os.path.join(self.dir, "in.jpg")
+        self.fn_out = os.path.join(self.dir, "out.jpg")
+        self.write(self.fn_in, b"in")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, fn, data):
+        with open(fn, "wb") as f:
+            f.write(data)
+
+    def reload(self, cache):
+        cache.save()
+        return ProcessingCache(self.dir, log=lambda s: None)
+
+    def test_fresh(self):
+        cache = ProcessingCache(self.dir, log=lambda s: None)
+        key = cache.task_key("stabilization", [self.fn_in])
+        self.assertFalse(cache.is_fresh(self.fn_out, key))
+        self.write(self.fn_out, b"out")
+        cache.record(self.fn_out, key, info={"align_quality": 0.9})
+        cache = self.reload(cache)
+        self.assertEqual(cache.task_key("stabilization", [self.fn_in]), key)
+        self.assertTrue(cache.is_fresh(self.fn_out, key))
+        self.assertEqual(cache.get_info(self.fn_out), {"align_quality": 0.9})
+        # Different settings
+        key2 = cache.task_key("stabilization", [self.fn_in],
+                              fingerprints=[{
+                                  "bits": 16
+                              }])
+        self.assertFalse(cache.is_fresh(self.fn_out, key2))
+        # Different input
+        self.write(self.fn_in, b"in2")
+        key3 = cache.task_key("stabilization", [self.fn_in])
+        self.assertNotEqual(key3, key)
+        self.assertFalse(cache.is_fresh(self.fn_out, key3))
+
+    def test_not_uploaded(self):
+        cache = ProcessingCache(self.dir, log=lambda s: None)
+        cache.task_key("stabilization", [self.fn_in])
+        cache.save()
+        self.assertTrue(
+            os.path.exists(os.path.join(self.dir, "processing_cache.json")))
+        self.write(os.path.join(self.dir, "uscan.json"), b"{}")
+        self.assertEqual([
+            os.path.basename(fn) for fn in upload_filenames(self.dir)
+        ], ["in.jpg", "uscan.json"])
+
+    def test_adopt(self):
+        # Processed before the cache existed
+        cv2.imwrite(self.fn_out, make_texture())
+        fn_out2 = os.path.join(self.dir, "out2.jpg")
+        with open(self.fn_out, "rb") as f:
+            self.write(fn_out2, f.read()[:1000])
+        cache = ProcessingCache(self.dir, log=lambda s: None)
+        key = cache.task_key("stabilization", [self.fn_in])
+        self.assertTrue(cache.is_fresh(self.fn_out, key))
+        # Cut off by a crash
+        self.assertFalse(cache.is_fresh(fn_out2, key))
+        cache = self.reload(cache)
+        key = cache.task_key("stabilization", [self.fn_in], options={"x": 1})
+        self.assertFalse(cache.is_fresh(self.fn_out, key))
+
+    def test_journal(self):
+        cache = ProcessingCache(self.dir, log=lambda s: None)
+        key = cache.task_key("stabilization", [self.fn_in])
+        self.write(self.fn_out, b"out")
+        cache.record(self.fn_out, key, stage="stabilization")
+        cache.save()
+        fn_out2 = os.path.join(self.dir, "out2.jpg")
+        self.write(fn_out2, b"out2")
+        cache.record(fn_out2, key, stage="stabilization")
+        # Crash before save(), mid write of the next entry
+        with open(os.path.join(self.dir, "processing_journal.jsonl"),
+                  "a") as f:
+            f.write('{"output": "out3.j')
+        cache = ProcessingCache(self.dir, log=lambda s: None)
+        self.assertEqual(cache.resumed, 1)
+        self.assertTrue(cache.is_fresh(self.fn_out, key))
+        self.assertTrue(cache.is_fresh(fn_out2, key))
+        # Never completed
+        fn_out3 = os.path.join(self.dir, "out3.jpg")
+        self.write(fn_out3, b"partial")
+        self.assertFalse(cache.is_fresh(fn_out3, key))
+        cache.save()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dir,
+                                        "processing_journal.jsonl")))
+
+
+if __name__ == "__main__":
+    unittest.main()
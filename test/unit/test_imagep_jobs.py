@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+cs_auto scan scheduling (uscope.imagep.jobs)
+Scans are never actually processed: scan processes are faked
+"""
+
+import unittest
+from unittest import mock
+import tempfile
+import json
+import os
+from uscope.imagep import jobs
+from uscope.imagep.jobs import ScanJobQueue, UploadGate, DirWatcher, ScanScheduler, JOBS_FN, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, t):
+        self.sleeps.append(t)
+        self.now += t
+
+
+class TestScanJobQueue(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, JOBS_FN)
+            queue = ScanJobQueue(fn)
+            for basename in ("scan_a", "scan_b", "scan_c", "scan_d"):
+                self.assertTrue(queue.add(os.path.join(tmp_dir, basename)))
+            self.assertFalse(queue.add(os.path.join(tmp_dir, "scan_a")))
+            queue.set_state("scan_a", JOB_DONE)
+            queue.set_state("scan_b", JOB_RUNNING)
+            queue.set_state("scan_c", JOB_FAILED, error="oops")
+            self.assertEqual(queue.queued(), ["scan_d"])
+            self.assertEqual(queue.get("scan_c")["error"], "oops")
+
+            # Restart: interrupted and failed scans are retried in arrival order
+            queue = ScanJobQueue(fn)
+            self.assertEqual(queue.queued(), ["scan_b", "scan_c", "scan_d"])
+            self.assertEqual(queue.get("scan_a")["state"], JOB_DONE)
+            self.assertEqual(
+                queue.get("scan_d")["dir"], os.path.join(tmp_dir, "scan_d"))
+            # Saved atomically
+            self.assertEqual(os.listdir(tmp_dir), [JOBS_FN])
+
+
+class TestUploadGate(unittest.TestCase):
+    def test_burst(self):
+        clock = FakeClock()
+        gate = UploadGate(burst=2, interval=100)
+        log = []
+        with mock.patch.object(jobs.time, "time", clock.time), \
+                mock.patch.object(jobs.time, "sleep", clock.sleep):
+            # Burst goes right away
+            gate.acquire(log=log.append)
+            clock.now += 10
+            gate.acquire(log=log.append)
+            self.assertEqual(clock.sleeps, [])
+            self.assertEqual(log, [])
+
+            # Then waits for the oldest to be interval old
+            gate.acquire(log=log.append)
+            self.assertEqual(clock.now, 1100.0)
+            self.assertEqual(len(log), 1)
+            self.assertIn("90 sec", log[0])
+            gate.acquire(log=log.append)
+            self.assertEqual(clock.now, 1110.0)
+            # Long waits are done in steps
+            self.assertTrue(all(t <= 60 for t in clock.sleeps))
+
+            # Quiet for a while: a full burst again
+            clock.now += 1000
+            clock.sleeps = []
+            gate.acquire(log=log.append)
+            gate.acquire(log=log.append)
+            self.assertEqual(clock.sleeps, [])
+
+
+class TestDirWatcher(unittest.TestCase):
+    def test_polling(self):
+        clock = FakeClock()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(jobs, "inotify_simple", None), \
+                mock.patch.object(jobs.time, "sleep", clock.sleep):
+            watcher = DirWatcher(tmp_dir, poll_interval=30.0)
+            self.assertIsNone(watcher.inotify)
+            # No-ops without inotify
+            watcher.watch(tmp_dir)
+            watcher.unwatch(tmp_dir)
+            watcher.wait()
+            watcher.wait(timeout=5.0)
+            watcher.wait(timeout=100.0)
+            self.assertEqual(clock.sleeps, [30.0, 5.0, 30.0])
+
+
+class FakeProcess:
+    """
+    Scan process that finishes after a few polls
+    """
+    def __init__(self, ctx, target, args, name):
+        self.ctx = ctx
+        self.directory, _log_fn, self.kwargs = args
+        self.polls = 0
+        self.exitcode = None
+
+    def start(self):
+        self.ctx.started.append(self)
+        self.ctx.alive.add(self)
+        self.ctx.max_alive = max(self.ctx.max_alive, len(self.ctx.alive))
+
+    def is_alive(self):
+        self.polls += 1
+        if self.polls < 3:
+            return True
+        self.ctx.alive.discard(self)
+        self.exitcode = 1 if "bad" in self.directory else 0
+        return False
+
+    def join(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.started = []
+        self.alive = set()
+        self.max_alive = 0
+
+    def Process(self, target, args, name):
+        return FakeProcess(self, target, args, name)
+
+    def Value(self, *args):
+        return self.ctx.Value(*args)
+
+
+class TestScanScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.scan_dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_scan(self, basename, ready=True):
+        directory = os.path.join(self.scan_dir, basename)
+        os.mkdir(directory)
+        if ready:
+            with open(os.path.join(directory, "uscan.json"), "w") as f:
+                json.dump({}, f)
+        return directory
+
+    def scheduler(self, **kwargs):
+        scheduler = ScanScheduler(scan_dir=self.scan_dir,
+                                  nthreads=4,
+                                  max_scans=2,
+                                  min_free_memory=0,
+                                  log=lambda s: None,
+                                  **kwargs)
+        scheduler.ctx = FakeContext(scheduler.ctx)
+        return scheduler
+
+    def test_run(self):
+        for basename in ("scan_a", "scan_b", "scan_c", "scan_bad"):
+            self.make_scan(basename)
+        # Still being acquired
+        self.make_scan("scan_partial", ready=False)
+        directory = self.make_scan("scan_uploaded")
+        os.mkdir(os.path.join(directory, "stitch"))
+        with open(os.path.join(directory, "stitch", "cloud_stitch.json"),
+                  "w") as f:
+            json.dump({}, f)
+        # Processed before, then renamed after its QR code
+        queue = ScanJobQueue(os.path.join(self.scan_dir, JOBS_FN))
+        queue.add(os.path.join(self.scan_dir, "scan_qr"))
+        queue.set_state("scan_qr", JOB_DONE)
+        self.make_scan("scan_qr_chip-1234")
+
+        scheduler = self.scheduler()
+        with mock.patch.object(jobs.time, "sleep"):
+            failed = scheduler.run()
+        ctx = scheduler.ctx
+        self.assertEqual(failed, ["scan_bad"])
+        self.assertEqual(
+            sorted(os.path.basename(p.directory) for p in ctx.started),
+            ["scan_a", "scan_b", "scan_bad", "scan_c"])
+        self.assertEqual(ctx.max_alive, 2)
+        jobs_ = ScanJobQueue(os.path.join(self.scan_dir, JOBS_FN)).jobs
+        self.assertNotIn("scan_partial", jobs_)
+        for basename in ("scan_a", "scan_b", "scan_c", "scan_uploaded",
+                         "scan_qr_chip-1234"):
+            self.assertEqual(jobs_[basename]["state"], JOB_DONE, basename)
+        # Requeued on restart
+        self.assertEqual(jobs_["scan_bad"]["state"], JOB_QUEUED)
+
+    def test_core_budget(self):
+        self.make_scan("scan_a")
+        scheduler = self.scheduler()
+        scheduler.discover()
+        scheduler.fill([("scan_a", os.path.join(self.scan_dir, "scan_a"))])
+        # Alone: all cores
+        limit_a = scheduler.worker_limits["scan_a"]
+        self.assertEqual(limit_a.value, 4)
+        process_a = scheduler.running["scan_a"]
+        self.assertEqual(process_a.kwargs["nthreads"], 4)
+        self.assertIs(process_a.kwargs["worker_limit"], limit_a)
+
+        self.make_scan("scan_b")
+        scheduler.discover()
+        scheduler.fill([("scan_b", os.path.join(self.scan_dir, "scan_b"))])
+        limit_b = scheduler.worker_limits["scan_b"]
+        self.assertEqual((limit_a.value, limit_b.value), (2, 2))
+
+        # No room for a third
+        self.make_scan("scan_c")
+        scheduler.discover()
+        left = scheduler.fill([("scan_c", os.path.join(self.scan_dir,
+                                                       "scan_c"))])
+        self.assertEqual(len(left), 1)
+
+        # a finishes: b gets its cores back
+        while process_a.is_alive():
+            pass
+        scheduler.reap()
+        self.assertEqual(limit_b.value, 4)
+
+    def test_directories(self):
+        directory = self.make_scan("scan_a")
+        scheduler = ScanScheduler(directories=[directory],
+                                  nthreads=4,
+                                  log=lambda s: None)
+        with mock.patch.object(jobs, "process_dir") as process_dir:
+            self.assertEqual(scheduler.run(), [])
+        process_dir.assert_called_once_with(directory,
+                                            nthreads=4,
+                                            upload_gate=None)
+
+
+if __name__ == "__main__":
+    unittest.main()
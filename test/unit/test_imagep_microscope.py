@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+Image processing that needs a (virtual) microscope config:
+plugins, DirCSIP, StreamCSIP
+"""
+
+import unittest
+from unittest import mock
+import contextlib
+import tempfile
+import threading
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import cv2
+from uscope.microscope import get_virtual_microscope
+from uscope.imagep.plugins import get_plugins
+from uscope.imagep.pipeline import (CSImageProcessor, WorkerProcessDied,
+                                    process_safe_options)
+from uscope.imagep.streams import run_planner_stream
+from uscope.imager.imager import MockImager
+from uscope.motion.hal import MockHal
+from uscope.planner.planner import PlannerStop
+from uscope.planner.planner_util import get_planner
+from uscope.planner.thread import SimplePlannerThread
+from uscope.imagep.telemetry import TELEMETRY_FN, TaskMeter, count_subprocess
+from uscope.imagep.util import EtherealImageR, EtherealImageW, TaskBarrier
+from PIL import Image
+
+microscope = None
+
+
+def get_microscope():
+    global microscope
+    if microscope is None:
+        microscope = get_virtual_microscope()
+    return microscope
+
+
+@contextlib.contextmanager
+def plugin_config(name, j):
+    """
+    Temporarily set microscope ipp config for plugin name
+    """
+    ippj = get_microscope().usc.ipp.j
+    plugins = ippj.setdefault("plugins", {})
+    old = plugins.get(name)
+    plugins[name] = j
+    try:
+        yield
+    finally:
+        if old is None:
+            del plugins[name]
+        else:
+            plugins[name] = old
+
+
+class TestCorrectDeconvPlugin(unittest.TestCase):
+    def test_bad_config(self):
+        with plugin_config("correct-deconv",
+                           {"psf": {
+                               "purple": {
+                                   "gaussian": 1.0
+                               }
+                           }}):
+            # Doesn't take down every other plugin
+            plugins = get_plugins(microscope=get_microscope())
+            with self.assertRaisesRegex(ValueError, "purple"):
+                plugins["correct-deconv"].fingerprint()
+
+
+def run_plugin(name, images, options={}):
+    """
+    Run plugin name on in memory numpy images
+    Return (numpy result, plugin result)
+    """
+    plugins = get_plugins(microscope=get_microscope())
+    data_out = {"image": EtherealImageW(want_im=True)}
+    ret = plugins[name].run(data_in={
+        "images": [
+            EtherealImageR(im=image if isinstance(image, Image.Image) else
+                           Image.fromarray(image)) for image in images
+        ]
+    },
+                            data_out=data_out,
+                            options=options)
+    return np.asarray(data_out["image"].get_im()), ret
+
+
+def make_texture(wh=(160, 120), seed=0):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (wh[1] // 4, wh[0] // 4, 3), dtype=np.uint8)
+    return cv2.resize(small, wh, interpolation=cv2.INTER_LINEAR)
+
+
+def mean_error(a, b, border=0):
+    height, width = a.shape[0:2]
+    a = a[border:height - border, border:width - border]
+    b = b[border:height - border, border:width - border]
+    return np.abs(a.astype(float) - b.astype(float)).mean()
+
+
+class TestStackNativePlugin(unittest.TestCase):
+    def make_stack(self, sharp, shifts=None):
+        """
+        Each frame is in focus on one horizontal band only
+        """
+        blurred = cv2.GaussianBlur(sharp, (0, 0), 1.5)
+        height = sharp.shape[0]
+        ret = []
+        for i in range(3):
+            frame = blurred.copy()
+            y0, y1 = i * height // 3, (i + 1) * height // 3
+            frame[y0:y1] = sharp[y0:y1]
+            if shifts:
+                frame = np.roll(frame, shifts[i], axis=(0, 1))
+            ret.append(frame)
+        return ret
+
+    def test_fuse(self):
+        sharp = make_texture()
+        stack = self.make_stack(sharp)
+        result, ret = run_plugin("stack-native", stack)
+        self.assertEqual(result.shape, sharp.shape)
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertNotIn("align_quality", ret)
+        err = mean_error(result, sharp)
+        self.assertLess(err, 5.0)
+        for frame in stack:
+            self.assertLess(err * 2, mean_error(frame, sharp))
+
+    def test_single(self):
+        sharp = make_texture()
+        result, _ret = run_plugin("stack-native", [sharp])
+        self.assertTrue((result == sharp).all())
+
+    def test_align_xy(self):
+        sharp = make_texture()
+        # (y, x)
+        stack = self.make_stack(sharp, shifts=[(0, 0), (2, -3), (-3, 2)])
+        err_unaligned = mean_error(run_plugin("stack-native", stack)[0],
+                                   sharp,
+                                   border=8)
+        with plugin_config("stack-native", {"align_xy": True}):
+            result, ret = run_plugin("stack-native", stack)
+        self.assertGreater(ret["align_quality"], 0.5)
+        err = mean_error(result, sharp, border=8)
+        self.assertLess(err, 8.0)
+        self.assertLess(err * 2, err_unaligned)
+
+
+def strip_exif(ims):
+    return [Image.fromarray(np.asarray(im)) for im in ims]
+
+
+class TestHDRMergeCVPlugin(unittest.TestCase):
+    def make_brackets(self):
+        """
+        Return (scene radiance, brackets, exposure times)
+        Scene is brighter than any one exposure can hold
+        """
+        texture = make_texture().astype(np.float32) / 255
+        ramp = np.linspace(0.1, 4.0, texture.shape[1], dtype=np.float32)
+        scene = texture * ramp[None, :, None]
+        times = [0.25, 1.0, 4.0]
+        brackets = []
+        for t in times:
+            image = np.clip(scene * t * 64, 0, 255).astype(np.uint8)
+            im = Image.fromarray(image)
+            exif = Image.Exif()
+            exif.get_ifd(0x8769)[33434] = t
+            im.info["exif"] = exif.tobytes()
+            brackets.append(im)
+        return scene, brackets, times
+
+    def check_result(self, result, scene, brackets):
+        self.assertEqual(result.shape, scene.shape)
+        self.assertEqual(result.dtype, np.uint8)
+        gray = result.astype(float).mean(axis=2).ravel()
+        # Follows the scene everywhere, unlike a single clipped exposure
+        # Range is compressed: compare on a log scale
+        log_scene = np.log(scene.mean(axis=2).ravel() + 1e-3)
+        corr = np.corrcoef(gray, log_scene)[0, 1]
+        self.assertGreater(corr, 0.9)
+        clipped = [(np.asarray(im) == 255).mean() for im in brackets]
+        self.assertLess((result == 255).mean(), max(clipped))
+
+    def test_mertens(self):
+        scene, brackets, _times = self.make_brackets()
+        result, ret = run_plugin("hdr-opencv", brackets)
+        self.assertNotIn("align_quality", ret)
+        self.check_result(result, scene, brackets)
+
+    def test_radiance(self):
+        scene, brackets, times = self.make_brackets()
+        for method in ("debevec", "robertson"):
+            # Exposure times from EXIF
+            result, _ret = run_plugin("hdr-opencv",
+                                      brackets,
+                                      options={"method": method})
+            self.check_result(result, scene, brackets)
+            # Or given
+            result_times, _ret = run_plugin("hdr-opencv",
+                                            strip_exif(brackets),
+                                            options={
+                                                "method": method,
+                                                "exposure_times": times
+                                            })
+            self.assertTrue((result_times == result).all())
+
+    def test_radiance_no_times(self):
+        _scene, brackets, _times = self.make_brackets()
+        with self.assertRaisesRegex(AssertionError, "exposure times"):
+            run_plugin("hdr-opencv",
+                       strip_exif(brackets),
+                       options={"method": "debevec"})
+
+    def test_config(self):
+        _scene, brackets, _times = self.make_brackets()
+        with plugin_config("hdr-opencv", {"method": "debevec"}):
+            configured, _ret = run_plugin("hdr-opencv", brackets)
+        result, _ret = run_plugin("hdr-opencv",
+                                  brackets,
+                                  options={"method": "debevec"})
+        self.assertTrue((configured == result).all())
+
+
+def make_tile(col, row):
+    # Smooth: survives JPEG
+    y, x = np.mgrid[0:48, 0:64]
+    im = 128 + 100 * np.sin(x / 9.0 + col) * np.cos(y / 7.0 + row)
+    return np.repeat(im[:, :, None], 3, axis=2).astype(np.uint8)
+
+
+class CSIPTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csip = CSImageProcessor(nthreads=2,
+                                     microscope=get_microscope(),
+                                     log=lambda s: None,
+                                     worker_mode="thread")
+        self.csip.start()
+
+    def tearDown(self):
+        self.csip.shutdown()
+        self.tmp.cleanup()
+
+    def telemetry_tasks(self, directory):
+        with open(os.path.join(directory, TELEMETRY_FN), "r") as f:
+            return [j for j in map(json.loads, f) if j["type"] == "task"]
+
+
+def get_scan_microscope():
+    """
+    Virtual microscope with mock motion and imager such that a Planner can run
+    """
+    ret = get_virtual_microscope()
+    motion = MockHal(microscope=ret, log=lambda s: None)
+    motion.configure(options={})
+    ret.set_motion(motion)
+    ret.set_motion_ts(motion)
+    imager = MockImager(width=64, height=48)
+    ret.set_imager(imager)
+    ret.set_imager_ts(imager)
+    return ret
+
+
+class TestStreamCSIP(CSIPTestCase):
+    """
+    Mock scan: 3 x 2 tiles, 3 stabilization frames each
+    Tiles are processed while a Planner (MockHal + MockImager) captures them
+    Identical frames => stabilized tile is the frame
+    """
+    def setUp(self):
+        super().setUp()
+        self.scan_microscope = get_scan_microscope()
+        self.directory = os.path.join(self.tmp.name, "scan")
+        self.dir_out = os.path.join(self.directory, "stabilization")
+        self.configj = {
+            "cloud_stitch": False,
+            "write_html_viewer": False,
+        }
+
+    def planner_args(self):
+        return {
+            "pconfig": {
+                "imager": {
+                    "x_view": 1.0,
+                },
+                "points-xy2p": {
+                    "contour": {
+                        "start": {
+                            "x": 0.0,
+                            "y": 0.0,
+                        },
+                        "end": {
+                            "x": 2.0,
+                            "y": 1.0,
+                        },
+                    },
+                },
+                "image-stabilization": {
+                    "n": 3,
+                },
+            },
+            "microscope": self.scan_microscope,
+            "out_dir": self.directory,
+            "dry": False,
+        }
+
+    def scan(self):
+        thread = SimplePlannerThread(self.planner_args(),
+                                     progress_cb=lambda state: None,
+                                     csip=self.csip,
+                                     stream_kwargs={"configj": self.configj})
+        thread.log = lambda msg="": None
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNotNone(thread.planner)
+
+    def test_stream(self):
+        self.scan()
+        basenames = sorted(os.listdir(self.dir_out))
+        self.assertEqual(basenames, [
+            "c000_r000.jpg", "c000_r001.jpg", "c001_r000.jpg", "c001_r001.jpg",
+            "c002_r000.jpg", "c002_r001.jpg"
+        ])
+        for basename in basenames:
+            im = np.asarray(Image.open(os.path.join(self.dir_out, basename)))
+            self.assertEqual(im.shape, (48, 64, 3))
+            self.assertGreater(im.min(), 240)
+        # Finalize reused the stream's outputs instead of redoing them
+        self.assertEqual(len(self.telemetry_tasks(self.directory)), 6)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.directory, "processing.json")))
+
+        # Interrupted write: rescanning only redoes that tile
+        fn_bad = os.path.join(self.dir_out, "c000_r001.jpg")
+        with open(fn_bad, "r+b") as f:
+            f.truncate(100)
+        self.scan()
+        redone = [
+            os.path.basename(j["output"])
+            for j in self.telemetry_tasks(self.directory)[6:]
+        ]
+        self.assertEqual(redone, ["c000_r001.jpg"])
+        Image.open(fn_bad).load()
+
+    def test_abort(self):
+        planner = get_planner(log=lambda *args, **kwargs: None,
+                              **self.planner_args())
+
+        def progress_cb(state):
+            # Stop partway through the third tile
+            if state["type"] == "image" and state["images_captured"] == 7:
+                planner.shutdown_request(None)
+
+        planner.register_progress_callback(progress_cb)
+        # Returns instead of waiting on images that will never arrive
+        with self.assertRaises(PlannerStop):
+            run_planner_stream(planner, self.csip, configj=self.configj)
+        # Tiles captured before the stop were processed
+        self.assertEqual(len(os.listdir(self.dir_out)), 2)
+        self.assertEqual(len(self.telemetry_tasks(self.directory)), 2)
+        # But an incomplete scan isn't finalized
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, "processing.json")))
+
+
+def make_hdr_scan(directory):
+    """
+    Mock scan: 2 x 2 tiles, 2 HDR exposures, 3 stabilization frames each
+    """
+    os.mkdir(directory)
+    rng = np.random.default_rng(0)
+    for col in range(2):
+        for row in range(2):
+            for hdr in range(2):
+                for i in range(3):
+                    im = make_tile(col, row) // (2 - hdr)
+                    im = im + rng.integers(0, 8, im.shape, dtype=np.uint8)
+                    Image.fromarray(im).save(os.path.join(
+                        directory,
+                        "c%03u_r%03u_h%02u_is%02u.jpg" % (col, row, hdr, i)),
+                                             quality=95)
+
+
+class TestFused(CSIPTestCase):
+    def process(self, directory, fused):
+        self.csip.process_dir(directory,
+                              configj={
+                                  "fused": fused,
+                                  "hdr_plugin": "hdr-opencv",
+                                  "intermediate_format": "npy",
+                                  "cloud_stitch": False,
+                                  "write_html_viewer": False,
+                              })
+        dir_out = os.path.join(directory, "stabilization", "hdr")
+        return {
+            basename: np.asarray(Image.open(os.path.join(dir_out, basename)))
+            for basename in os.listdir(dir_out)
+        }
+
+    def test_fused(self):
+        dir_fused = os.path.join(self.tmp.name, "fused")
+        dir_staged = os.path.join(self.tmp.name, "staged")
+        make_hdr_scan(dir_fused)
+        make_hdr_scan(dir_staged)
+        fused = self.process(dir_fused, True)
+        staged = self.process(dir_staged, False)
+        self.assertEqual(sorted(fused.keys()), [
+            "c000_r000.jpg", "c000_r001.jpg", "c001_r000.jpg", "c001_r001.jpg"
+        ])
+        self.assertEqual(sorted(fused.keys()), sorted(staged.keys()))
+        # Lossless intermediates: same pixels with or without them
+        for basename, image in fused.items():
+            self.assertTrue((image == staged[basename]).all(), basename)
+        # One task per tile vs one per stage output
+        self.assertEqual(len(self.telemetry_tasks(dir_fused)), 4)
+        self.assertEqual(len(self.telemetry_tasks(dir_staged)), 4 * 2 + 4)
+        self.assertEqual(os.listdir(os.path.join(dir_fused, "stabilization")),
+                         ["hdr"])
+
+        # Nothing changed: lazy reruns skip everything
+        self.process(dir_fused, True)
+        self.process(dir_staged, False)
+        self.assertEqual(len(self.telemetry_tasks(dir_fused)), 4)
+        self.assertEqual(len(self.telemetry_tasks(dir_staged)), 4 * 2 + 4)
+
+
+class TestTelemetry(CSIPTestCase):
+    def test_staged(self):
+        directory = os.path.join(self.tmp.name, "scan")
+        make_hdr_scan(directory)
+        self.csip.process_dir(directory,
+                              configj={
+                                  "hdr_plugin": "hdr-opencv",
+                                  "cloud_stitch": False,
+                                  "write_html_viewer": False,
+                              })
+        with open(os.path.join(directory, TELEMETRY_FN), "r") as f:
+            lines = [json.loads(line) for line in f]
+        # One line per task, then one per stage
+        self.assertEqual([j["type"] for j in lines],
+                         ["task"] * 12 + ["stage"] * 2)
+        tasks = lines[0:12]
+        self.assertEqual(len(set(j["output"] for j in tasks)), 12)
+        self.assertEqual(sorted(set(j["stage"] for j in tasks)),
+                         ["hdr-opencv", "stabilization"])
+        for j in tasks:
+            self.assertEqual(j["result"], "ok")
+            for k in ("wall_s", "cpu_s", "queue_s", "maxrss_delta",
+                      "subprocesses", "read_bytes", "write_bytes"):
+                self.assertIn(k, j)
+            self.assertGreaterEqual(j["wall_s"], 0.0)
+            # In process plugins
+            self.assertEqual(j["subprocesses"], 0)
+
+        stages = {j["stage"]: j for j in lines[12:]}
+        self.assertEqual(stages["stabilization"]["tasks"], 8)
+        self.assertEqual(stages["hdr-opencv"]["tasks"], 4)
+        for stage, agg in stages.items():
+            self.assertEqual(agg["failed"], 0)
+            self.assertAlmostEqual(
+                agg["wall_s"],
+                sum(j["wall_s"] for j in tasks if j["stage"] == stage))
+        with open(os.path.join(directory, "processing.json"), "r") as f:
+            summary = json.load(f)["telemetry"]
+        for stage, agg in stages.items():
+            for k, v in summary[stage].items():
+                self.assertEqual(agg[k], v)
+
+    def test_subprocesses(self):
+        """
+        Processes a plugin spawns count against the task running it
+        """
+        plugin = get_plugins(microscope=get_microscope())["hdr-enfuse"]
+        plugin.enfuse = "enfuse"
+
+        def check_call(args):
+            # Stand in for enfuse --output out_fn ...
+            Image.fromarray(make_tile(0, 0)).save(args[2])
+
+        images = [Image.fromarray(make_tile(0, 0) // i) for i in (1, 2)]
+        meter = TaskMeter()
+        meter.start()
+        with mock.patch("subprocess.check_call", side_effect=check_call):
+            plugin.run(
+                data_in={"images": [EtherealImageR(im=im) for im in images]},
+                data_out={"image": EtherealImageW(want_im=True)})
+        self.assertEqual(meter.stop()["subprocesses"], 1)
+
+        # Other threads' spawns aren't this task's
+        meter.start()
+        thread = threading.Thread(target=count_subprocess)
+        thread.start()
+        thread.join()
+        self.assertEqual(meter.stop()["subprocesses"], 0)
+
+
+class TestWorkerLimit(unittest.TestCase):
+    def test_limit(self):
+        worker_limit = multiprocessing.Value("i", 1)
+        csip = CSImageProcessor(nthreads=3,
+                                microscope=get_microscope(),
+                                log=lambda s: None,
+                                worker_limit=worker_limit)
+        csip.start()
+        try:
+            frames = [Image.fromarray(make_tile(0, 0))] * 3
+
+            def run_tasks():
+                tb = TaskBarrier()
+                ret = []
+                for _i in range(6):
+                    csip.queue_stabilization(
+                        ims_in=frames,
+                        want_im_out=True,
+                        callback=lambda ip_params, result, info: ret.append(
+                            ip_params.telemetry["worker"]),
+                        tb=tb)
+                tb.wait()
+                return ret
+
+            # Only the first worker_limit workers take tasks
+            self.assertEqual(set(run_tasks()), {"w0"})
+            worker_limit.value = 3
+            # Idle workers notice within WORKER_LIMIT_POLL
+            time.sleep(1.0)
+            self.assertEqual(len(run_tasks()), 6)
+        finally:
+            csip.shutdown()
+
+
+class TestProcessMode(CSIPTestCase):
+    """
+    Workers in child processes give the same results as thread workers
+    """
+    def run_stabilization(self, csip, frames, fn_out=None):
+        done = threading.Event()
+        ret = {}
+
+        def callback(ip_params, result, info):
+            ret["result"] = (result, info)
+            ret["data_out"] = ip_params.data_out
+            done.set()
+
+        csip.queue_stabilization(ims_in=frames,
+                                 fn_out=fn_out,
+                                 want_im_out=fn_out is None,
+                                 callback=callback)
+        self.assertTrue(done.wait(60))
+        self.assertEqual(ret["result"][0], "ok", ret["result"][1])
+        return ret["data_out"]
+
+    def test_process(self):
+        frames = [Image.fromarray(make_tile(i, 0)) for i in range(3)]
+        csip = CSImageProcessor(nthreads=2,
+                                microscope=get_microscope(),
+                                log=lambda s: None,
+                                worker_mode="process")
+        csip.start()
+        try:
+            # In memory both ways: shared memory in and out
+            want = self.run_stabilization(self.csip, frames)["image"].get_im()
+            got = self.run_stabilization(csip, frames)["image"].get_im()
+            self.assertEqual(got.mode, want.mode)
+            self.assertTrue((np.asarray(got) == np.asarray(want)).all())
+
+            # Files
+            fn_out = os.path.join(self.tmp.name, "c000_r000.tif")
+            self.run_stabilization(csip, frames, fn_out=fn_out)
+            self.assertTrue(
+                (np.asarray(Image.open(fn_out)) == np.asarray(want)).all())
+        finally:
+            csip.shutdown()
+        for worker in csip.workers.values():
+            worker.join(5.0)
+            self.assertFalse(worker.process.is_alive())
+
+    def test_worker_died(self):
+        frames = [Image.fromarray(make_tile(i, 0)) for i in range(3)]
+        csip = CSImageProcessor(nthreads=1,
+                                microscope=get_microscope(),
+                                log=lambda s: None,
+                                worker_mode="process")
+        csip.start()
+        try:
+            worker, = csip.workers.values()
+            done = threading.Event()
+            ret = {}
+
+            def callback(ip_params, result, info):
+                ret["result"] = (result, info)
+                done.set()
+
+            # Dies while the task is in flight
+            worker.process.kill()
+            worker.process.join(5.0)
+            with mock.patch.object(worker.process,
+                                   "is_alive",
+                                   return_value=True):
+                csip.queue_stabilization(ims_in=frames,
+                                         want_im_out=True,
+                                         callback=callback)
+                self.assertTrue(done.wait(60))
+            result, info = ret["result"]
+            self.assertEqual(result, "exception")
+            self.assertIsInstance(info, WorkerProcessDied)
+            self.assertIn("exit code -9", str(info))
+
+            # Next task gets a new process
+            process = worker.process
+            self.run_stabilization(csip, frames)
+            self.assertIsNot(worker.process, process)
+            self.assertTrue(worker.process.is_alive())
+        finally:
+            csip.shutdown()
+
+
+class TestProcessSafeOptions(unittest.TestCase):
+    def test_options(self):
+        options = process_safe_options({
+            "captured_image": threading.Lock(),
+            "scale_factor": 0.5,
+        })
+        self.assertEqual(options, {"scale_factor": 0.5})
+        with self.assertRaises(ValueError):
+            process_safe_options({"lock": threading.Lock()})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -230,11 +230,18 @@ class QPlannerThread(PlannerThreadBase, ArgusThread):
     plannerDone = pyqtSignal(dict)
     log_msg = pyqtSignal(str)
 
-    def __init__(self, planner_args, progress_cb, parent=None):
+    def __init__(self,
+                 planner_args,
+                 progress_cb,
+                 csip=None,
+                 stream_kwargs={},
+                 parent=None):
         ArgusThread.__init__(self, parent)
         PlannerThreadBase.__init__(self,
                                    planner_args=planner_args,
-                                   progress_cb=progress_cb)
+                                   progress_cb=progress_cb,
+                                   csip=csip,
+                                   stream_kwargs=stream_kwargs)
 
     def log(self, msg=""):
         self.log_msg.emit(msg)
@@ -255,7 +262,7 @@ class QPlannerThread(PlannerThreadBase, ArgusThread):
             self.log()
             self.log()
             self.log()
-            ret["meta"] = self.planner.run()
+            ret["meta"] = self.run_planner()
             ret["result"] = "ok"
             b.stop()
             self.log('Planner done!  Took : %s' % str(b))
@@ -3,6 +3,7 @@ import io
 import boto3
 from uscope import config
 from uscope.util import writej
+from uscope.imagep.cache import CACHE_FN
 import datetime
 import json
 import glob
@@ -67,6 +68,23 @@ class CSInfo:
         return self._notification_email
 
 
+def upload_filenames(directory):
+    """
+    Files in directory CloudStitch needs: images + metadata
+    """
+    # uploading too much junk
+    # do simple glob for now
+    #for root, _, files in os.walk(directory):
+    return [
+        fn for fn in sorted(
+            list(glob.glob(os.path.join(directory, "*.jpg"))) +
+            list(glob.glob(os.path.join(directory, "*.tif"))) +
+            list(glob.glob(os.path.join(directory, "*.json"))))
+        # Local processing state
+        if os.path.basename(fn) != CACHE_FN
+    ]
+
+
 def upload_dir(directory,
                verbose=True,
                log=None,
@@ -98,13 +116,7 @@ def upload_dir(directory,
                       aws_access_key_id=cs_info.access_key(),
                       aws_secret_access_key=cs_info.secret_key())
 
-    # uploading too much junk
-    # do simple glob for now
-    #for root, _, files in os.walk(directory):
-    for src_fn in sorted(
-            list(glob.glob(os.path.join(directory, "*.jpg"))) +
-            list(glob.glob(os.path.join(directory, "*.tif"))) +
-            list(glob.glob(os.path.join(directory, "*.json")))):
+    for src_fn in upload_filenames(directory):
         if running is not None and not running.is_set():
             raise Exception("Upload interrupted")
         dst_fn = DEST_DIR + '/' + os.path.basename(src_fn)
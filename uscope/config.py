@@ -274,6 +274,16 @@ class USCImager:
     def has_ff_cal(self):
         return os.path.exists(self.ff_cal_fn())
 
+    def dark_cal_fn(self):
+        """
+        Optional dark frame (lens capped / light off) subtracted before flat field
+        """
+        return os.path.join(self.microscope.usc.get_microscope_data_dir(),
+                            "imager_calibration_dark.tif")
+
+    def has_dark_cal(self):
+        return os.path.exists(self.dark_cal_fn())
+
     def videoflip_method(self):
         return self.j.get("videoflip_method", None)
 
@@ -1337,6 +1347,13 @@ class BaseConfig:
         """
         return self.j.get("argus_cs_auto", "./utils/cs_auto.py")
 
+    def argus_stream_processing(self):
+        """
+        Process tiles (HDR, stack, etc) while the scan is still running
+        Post scan processing then only has to do the final steps
+        """
+        return bool(self.j.get("argus_stream_processing", False))
+
     def dev_mode(self):
         """
         Display unsightly extra information
@@ -1529,8 +1529,22 @@ class ImagingTaskWidget(AWidget):
                 #"verbosity": 2,
             }
 
+            csip = None
+            stream_kwargs = {}
+            if not dry and self.ac.microscope.bc.argus_stream_processing():
+                csip = self.ac.image_processing_thread.ip
+                # Post scan processing (cs_auto) finalizes
+                stream_kwargs = {
+                    "configj": pconfig.get("ipp", {}),
+                    "finalize": False,
+                }
+
             self.ac.planner_thread = QPlannerThread(
-                planner_args, progress_cb=emitCncProgress, parent=self)
+                planner_args,
+                progress_cb=emitCncProgress,
+                csip=csip,
+                stream_kwargs=stream_kwargs,
+                parent=self)
             self.ac.planner_thread.log_msg.connect(self.ac.log)
             self.ac.planner_thread.plannerDone.connect(self.plannerDone)
             self.setControlsEnabled(False)
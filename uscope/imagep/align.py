@@ -0,0 +1,168 @@
+"""
+Image registration for stacks / HDR brackets without external tools
+
+Transforms are estimated on a reduced resolution grayscale copy
+then applied once at full resolution:
+-Phase correlation gives a sub-pixel translation
+-Optionally ECC refines that into an affine transform (ex: zoom through focus)
+ coarse to fine over a small pyramid
+
+Quality is the normalized cross correlation between the reference
+and the aligned image (1.0: perfect match, ~0: unrelated)
+It is invariant to brightness / contrast changes so works across HDR brackets
+"""
+
+import cv2
+import numpy as np
+
+# Below this an alignment is suspicious and worth a look
+ALIGN_QUALITY_WARN = 0.5
+
+
+def image_gray(image):
+    """
+    Return a float32 grayscale copy of a numpy RGB or grayscale image
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return image.astype(np.float32)
+
+
+def reduce_gray(image, max_width):
+    """
+    Return (float32 grayscale image no wider than max_width, scale factor)
+    """
+    gray = image_gray(image)
+    height, width = gray.shape
+    scale = max(1.0, width / max_width)
+    if scale > 1.0:
+        gray = cv2.resize(gray,
+                          (max(1, int(round(width / scale))),
+                           max(1, int(round(height / scale)))),
+                          interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def normalize(gray):
+    """
+    Zero mean, unit variance: removes exposure differences
+    """
+    std = gray.std()
+    if std == 0:
+        std = 1.0
+    return (gray - gray.mean()) / std
+
+
+def phase_correlate(ref, image):
+    """
+    Return a 2x3 float32 warp such that
+    warpAffine(image, warp, flags=WARP_INVERSE_MAP) lines up with ref
+    """
+    window = cv2.createHanningWindow(ref.shape[::-1], cv2.CV_32F)
+    (dx, dy), _response = cv2.phaseCorrelate(ref, image, window)
+    return np.array([[1, 0, dx], [0, 1, dy]], dtype=np.float32)
+
+
+def ecc_refine(ref, image, warp, levels=2, iterations=50, eps=1e-4):
+    """
+    Refine warp to an affine transform, coarse to fine
+    Returns the input warp if ECC fails to converge
+    """
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations,
+                eps)
+    refs = [ref]
+    images = [image]
+    for _level in range(levels - 1):
+        if min(refs[-1].shape) < 64:
+            break
+        refs.append(cv2.pyrDown(refs[-1]))
+        images.append(cv2.pyrDown(images[-1]))
+
+    scale = 2**(len(refs) - 1)
+    this_warp = warp.copy()
+    this_warp[:, 2] /= scale
+    try:
+        for ref_level, image_level in zip(reversed(refs), reversed(images)):
+            _cc, this_warp = cv2.findTransformECC(ref_level, image_level,
+                                                  this_warp,
+                                                  cv2.MOTION_AFFINE, criteria,
+                                                  None, 5)
+            if scale > 1:
+                this_warp[:, 2] *= 2
+                scale //= 2
+    except cv2.error:
+        return warp
+    return this_warp
+
+
+def warp_image(image, warp, wh):
+    return cv2.warpAffine(image,
+                          warp,
+                          wh,
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def alignment_quality(ref, image, warp):
+    """
+    Normalized cross correlation between ref and warped image
+    Ignores a border that may have been filled in by the warp
+    """
+    height, width = ref.shape
+    aligned = warp_image(image, warp, (width, height))
+    margin_x = min(width // 4, int(abs(warp[0, 2])) + 1)
+    margin_y = min(height // 4, int(abs(warp[1, 2])) + 1)
+    a = normalize(ref[margin_y:height - margin_y, margin_x:width - margin_x])
+    b = normalize(aligned[margin_y:height - margin_y,
+                          margin_x:width - margin_x])
+    return float((a * b).mean())
+
+
+def estimate_transform(ref, image, affine=False, max_width=1024):
+    """
+    Estimate the full resolution transform taking image onto ref
+    ref / image: numpy images (RGB or grayscale) of the same size
+    affine: also allow rotation / scale / shear, not just translation
+    Return (2x3 float32 warp for warp_image(), quality)
+    """
+    ref_gray, scale = reduce_gray(ref, max_width)
+    image_gray_, _scale = reduce_gray(image, max_width)
+    ref_gray = normalize(ref_gray)
+    image_gray_ = normalize(image_gray_)
+
+    warp = phase_correlate(ref_gray, image_gray_)
+    if affine:
+        warp = ecc_refine(ref_gray, image_gray_, warp)
+    quality = alignment_quality(ref_gray, image_gray_, warp)
+    # Back to full resolution
+    warp = warp.copy()
+    warp[:, 2] *= scale
+    return warp, quality
+
+
+def align_images(images, affine=False, max_width=1024):
+    """
+    Align numpy images against the first one
+    Return (aligned images, info)
+    info
+        warps: per image 2x3 transform (identity for the reference)
+        qualities: per image quality (1.0 for the reference)
+        quality: worst quality
+    """
+    height, width = images[0].shape[0:2]
+    ret = [images[0]]
+    warps = [np.eye(2, 3, dtype=np.float32)]
+    qualities = [1.0]
+    for image in images[1:]:
+        warp, quality = estimate_transform(images[0],
+                                           image,
+                                           affine=affine,
+                                           max_width=max_width)
+        ret.append(warp_image(image, warp, (width, height)))
+        warps.append(warp)
+        qualities.append(quality)
+    return ret, {
+        "warps": warps,
+        "qualities": qualities,
+        "quality": min(qualities),
+    }
@@ -0,0 +1,153 @@
+"""
+Write a TIFF a strip at a time (ex: QuickPano canvas)
+
+PIL needs the whole image in memory and fails past 4 GiB (struct.error => HugeTIF)
+Rows are written as they come so memory is one strip
+Classic TIFF when it fits, BigTIFF otherwise
+Uncompressed, chunky (RGB RGB ...) 8 bit
+"""
+
+import struct
+
+# TIFF types
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_LONG8 = 16
+# Offsets must stay below this for classic TIFF
+CLASSIC_MAX = 2**32 - 1
+# Target bytes per strip
+STRIP_BYTES = 1 << 20
+
+
+class TIFFStripWriter:
+    """
+    w = TIFFStripWriter(fn, width, height)
+    w.write_rows(rows) top to bottom: numpy uint8 n x width x channels
+    w.close()
+    """
+    def __init__(self,
+                 fn,
+                 width,
+                 height,
+                 channels=3,
+                 rows_per_strip=None,
+                 bigtiff=None):
+        assert channels in (1, 3)
+        self.fn = fn
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.row_bytes = width * channels
+        if rows_per_strip is None:
+            rows_per_strip = max(1, STRIP_BYTES // self.row_bytes)
+        self.rows_per_strip = rows_per_strip
+        nstrips = (height + rows_per_strip - 1) // rows_per_strip
+        if bigtiff is None:
+            # Image data + strip tables + IFD
+            bigtiff = self.row_bytes * height + nstrips * 8 + 4096 > CLASSIC_MAX
+        self.bigtiff = bigtiff
+        self.rows = 0
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        # Rows of a partial strip
+        self.pending = []
+        self.pending_rows = 0
+        self.f = open(fn, "wb")
+        # IFD offset is patched in by close()
+        if bigtiff:
+            self.f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        else:
+            self.f.write(b"II" + struct.pack("<HI", 42, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+    def write_strip(self, data):
+        self.strip_offsets.append(self.f.tell())
+        self.strip_byte_counts.append(len(data))
+        self.f.write(data)
+
+    def write_rows(self, rows):
+        assert rows.shape[1] == self.width, (rows.shape, self.width)
+        assert rows.size == len(rows) * self.row_bytes, rows.shape
+        self.rows += len(rows)
+        assert self.rows <= self.height
+        i = 0
+        while i < len(rows):
+            n = min(len(rows) - i, self.rows_per_strip - self.pending_rows)
+            self.pending.append(rows[i:i + n].tobytes())
+            self.pending_rows += n
+            i += n
+            if self.pending_rows == self.rows_per_strip:
+                self.write_strip(b"".join(self.pending))
+                self.pending = []
+                self.pending_rows = 0
+
+    def pack_values(self, typ, values):
+        fmt = {TIFF_SHORT: "H", TIFF_LONG: "I", TIFF_LONG8: "Q"}[typ]
+        return struct.pack("<%u%s" % (len(values), fmt), *values)
+
+    def close(self):
+        assert self.rows == self.height, (self.rows, self.height)
+        if self.pending:
+            self.write_strip(b"".join(self.pending))
+            self.pending = []
+        offset_type = TIFF_LONG8 if self.bigtiff else TIFF_LONG
+        # tag => (type, values), written in tag order
+        tags = {
+            256: (TIFF_LONG, [self.width]),
+            257: (TIFF_LONG, [self.height]),
+            258: (TIFF_SHORT, [8] * self.channels),
+            # No compression
+            259: (TIFF_SHORT, [1]),
+            # RGB or black is zero
+            262: (TIFF_SHORT, [2 if self.channels == 3 else 1]),
+            273: (offset_type, self.strip_offsets),
+            277: (TIFF_SHORT, [self.channels]),
+            278: (TIFF_LONG, [self.rows_per_strip]),
+            279: (offset_type, self.strip_byte_counts),
+            # Chunky
+            284: (TIFF_SHORT, [1]),
+        }
+        inline_bytes = 8 if self.bigtiff else 4
+        # Values that don't fit in their entry go before the IFD
+        entries = []
+        for tag, (typ, values) in sorted(tags.items()):
+            data = self.pack_values(typ, values)
+            if len(data) > inline_bytes:
+                if self.f.tell() % 2:
+                    self.f.write(b"\0")
+                offset = self.f.tell()
+                self.f.write(data)
+                data = struct.pack("<Q" if self.bigtiff else "<I", offset)
+            entries.append(
+                (tag, typ, len(values), data.ljust(inline_bytes, b"\0")))
+        if self.f.tell() % 2:
+            self.f.write(b"\0")
+        ifd_offset = self.f.tell()
+        if not self.bigtiff and ifd_offset > CLASSIC_MAX:
+            raise ValueError("Too large for classic TIFF, use bigtiff")
+        if self.bigtiff:
+            ifd = struct.pack("<Q", len(entries))
+            for tag, typ, count, value in entries:
+                ifd += struct.pack("<HHQ", tag, typ, count) + value
+            ifd += struct.pack("<Q", 0)
+        else:
+            ifd = struct.pack("<H", len(entries))
+            for tag, typ, count, value in entries:
+                ifd += struct.pack("<HHI", tag, typ, count) + value
+            ifd += struct.pack("<I", 0)
+        self.f.write(ifd)
+        if self.bigtiff:
+            self.f.seek(8)
+            self.f.write(struct.pack("<Q", ifd_offset))
+        else:
+            self.f.seek(4)
+            self.f.write(struct.pack("<I", ifd_offset))
+        self.f.close()
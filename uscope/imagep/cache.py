@@ -0,0 +1,252 @@
+"""
+Per scan processing result cache for lazy reprocessing
+
+processing_cache.json in the scan directory records, for each output image,
+a key derived from:
+-Content hash of each input image
+-Plugin name(s) and options
+-Plugin fingerprint (ex: flat field calibration, alignment settings)
+An output is only reused if its key still matches and it wasn't modified since
+
+Input hashes are remembered by (size, mtime) so unchanged files aren't re-read
+
+Scans processed before the cache existed have no manifest
+Their existing outputs are adopted on the first run if they decode
+
+processing_journal.jsonl is appended (and fsync'd) as each task completes
+so that a crash mid stage only loses tasks that were in flight
+The manifest is rewritten after each stage and the journal is then dropped
+Loading replays any journal left over on top of the manifest
+Outputs not in either were never completed and are redone
+(or, before the first manifest, kept only if they decode)
+"""
+
+from uscope.util import writej
+from PIL import Image
+import hashlib
+import json
+import os
+import threading
+
+CACHE_VERSION = 1
+CACHE_FN = "processing_cache.json"
+JOURNAL_FN = "processing_journal.jsonl"
+
+
+def file_sha1(fn):
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        while True:
+            buf = f.read(1 << 20)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def file_stat(fn):
+    st = os.stat(fn)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def image_complete(fn):
+    """
+    Return True if fn decodes fully (ie wasn't cut off by a crash)
+    """
+    try:
+        with Image.open(fn) as im:
+            im.load()
+        return True
+    except Exception:
+        return False
+
+
+class ProcessingCache:
+    def __init__(self, directory, log=None):
+        if log is None:
+
+            def log(s):
+                print(s)
+
+        self.log = log
+        self.directory = directory
+        self.fn = os.path.join(directory, CACHE_FN)
+        self.journal_fn = os.path.join(directory, JOURNAL_FN)
+        self.journal_f = None
+        self.lock = threading.Lock()
+        self.dirty = False
+        # rel fn => {"size", "mtime_ns", "sha1"}
+        self.files = {}
+        # rel fn out => {"key", "size", "mtime_ns"}
+        self.outputs = {}
+        # No manifest: trust whatever is already there
+        self.adopt = True
+        # Outputs recovered from the journal
+        self.resumed = 0
+        if os.path.exists(self.fn):
+            self.load()
+        if os.path.exists(self.journal_fn):
+            self.replay()
+
+    def load(self):
+        try:
+            with open(self.fn, "r") as f:
+                j = json.load(f)
+        except ValueError:
+            self.log(f"WARNING: corrupt {self.fn}, ignoring")
+            self.adopt = False
+            return
+        self.adopt = False
+        if j.get("version") != CACHE_VERSION:
+            self.log(f"{self.fn}: old version, ignoring")
+            return
+        self.files = j.get("files", {})
+        self.outputs = j.get("outputs", {})
+
+    def replay(self):
+        """
+        Apply journal entries written since the last save()
+        """
+        with open(self.journal_fn, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn final write
+                    self.log(f"{self.journal_fn}: ignoring partial entry")
+                    break
+                if entry.get("version") != CACHE_VERSION:
+                    continue
+                if "file" in entry:
+                    self.files[entry.pop("file")] = {
+                        "size": entry["size"],
+                        "mtime_ns": entry["mtime_ns"],
+                        "sha1": entry["sha1"],
+                    }
+                elif "output" in entry:
+                    rel = entry.pop("output")
+                    entry.pop("version")
+                    entry.pop("stage", None)
+                    self.outputs[rel] = entry
+                    self.resumed += 1
+        self.dirty = True
+
+    def journal(self, entry, sync=False):
+        """
+        Append entry to the journal
+        sync: flush it (and everything before it) to disk
+        Must hold lock
+        """
+        if self.journal_f is None:
+            self.journal_f = open(self.journal_fn, "a")
+        self.journal_f.write(
+            json.dumps(dict(entry, version=CACHE_VERSION)) + "\n")
+        self.journal_f.flush()
+        if sync:
+            os.fsync(self.journal_f.fileno())
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            j = {
+                "version": CACHE_VERSION,
+                "files": self.files,
+                "outputs": self.outputs,
+            }
+            self.dirty = False
+            tmp_fn = self.fn + ".tmp"
+            writej(tmp_fn, j)
+            with open(tmp_fn, "r") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_fn, self.fn)
+            # Everything in the journal is now in the manifest
+            if self.journal_f is not None:
+                self.journal_f.close()
+                self.journal_f = None
+            if os.path.exists(self.journal_fn):
+                os.unlink(self.journal_fn)
+
+    def rel(self, fn):
+        return os.path.relpath(os.path.realpath(fn),
+                               os.path.realpath(self.directory))
+
+    def hash_file(self, fn):
+        """
+        Content hash, memoized by size + mtime
+        """
+        rel = self.rel(fn)
+        stat = file_stat(fn)
+        with self.lock:
+            entry = self.files.get(rel)
+            if entry and entry["size"] == stat["size"] and entry[
+                    "mtime_ns"] == stat["mtime_ns"]:
+                return entry["sha1"]
+        sha1 = file_sha1(fn)
+        with self.lock:
+            self.files[rel] = dict(stat, sha1=sha1)
+            self.dirty = True
+            # Not worth a sync: worst case it gets hashed again
+            self.journal(dict(stat, file=rel, sha1=sha1))
+        return sha1
+
+    def task_key(self, plugins, fns_in, options={}, fingerprints=[]):
+        """
+        plugins: plugin name or list of names (fused chain)
+        fingerprints: JSON serializable plugin state, see IPPlugin.fingerprint()
+        """
+        j = {
+            "plugins": plugins,
+            "options": options,
+            "fingerprints": fingerprints,
+            "inputs": [self.hash_file(fn) for fn in fns_in],
+        }
+        return hashlib.sha1(
+            json.dumps(j, sort_keys=True,
+                       default=str).encode("utf-8")).hexdigest()
+
+    def is_fresh(self, fn_out, key):
+        """
+        Return True if fn_out was produced from the same key and hasn't changed since
+        """
+        if not os.path.exists(fn_out):
+            return False
+        rel = self.rel(fn_out)
+        stat = file_stat(fn_out)
+        with self.lock:
+            entry = self.outputs.get(rel)
+            if entry is None:
+                if not self.adopt:
+                    return False
+                # Legacy output
+                if not image_complete(fn_out):
+                    self.log(f"{fn_out}: incomplete, redoing")
+                    return False
+                self.outputs[rel] = dict(stat, key=key)
+                self.dirty = True
+                return True
+            return entry["key"] == key and entry["size"] == stat[
+                "size"] and entry["mtime_ns"] == stat["mtime_ns"]
+
+    def record(self, fn_out, key, info=None, stage=None):
+        """
+        Call once fn_out has been written
+        info: optional JSON serializable plugin result to keep with it
+        stage: plugin name(s) for the journal
+        """
+        rel = self.rel(fn_out)
+        stat = file_stat(fn_out)
+        entry = dict(stat, key=key)
+        if info:
+            entry["info"] = info
+        with self.lock:
+            self.outputs[rel] = entry
+            self.dirty = True
+            self.journal(dict(entry, output=rel, stage=stage), sync=True)
+
+    def get_info(self, fn_out):
+        """
+        Return info given to record() or None
+        """
+        with self.lock:
+            return self.outputs.get(self.rel(fn_out), {}).get("info")
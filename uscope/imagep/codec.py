@@ -0,0 +1,234 @@
+"""
+Image file formats for intermediate processing stages
+
+Selected by IPPConfigJ.intermediate_format()
+native: same as the scan (.jpg or .tif). Historical behavior
+jpg: JPEG. Smallest but lossy and slow to encode / decode
+tif: TIFF, LZW compressed
+tif-zstd: TIFF, zstd compressed. Faster than LZW but needs a recent libtiff to read
+npy: uncompressed numpy array. Memory mapped on read => no decode at all
+    EXIF (ex: exposure time for HDR) is kept in a .exif sidecar file
+
+The final stage always writes the scan's native format
+
+save_image() also takes 16 bit RGB numpy arrays, which PIL can't hold
+(ex: 16 bit flat field output). Those can only go to .tif, .png or .npy
+"""
+
+from PIL import Image, TiffImagePlugin, TiffTags
+import cv2
+import numpy as np
+import os
+
+# format => (suffix, PIL save() kwargs)
+INTERMEDIATE_FORMATS = {
+    "native": (None, {}),
+    "jpg": (".jpg", {}),
+    "tif": (".tif", {
+        "compression": "tiff_lzw"
+    }),
+    "tif-zstd": (".tif", {
+        "compression": "zstd"
+    }),
+    "npy": (".npy", {}),
+}
+
+# Extensions index_scan_images() picks up
+IMAGE_EXTENSIONS = (".jpg", ".tif", ".npy")
+
+
+def intermediate_format(name):
+    """
+    Return (suffix, save kwargs) for given format name
+    suffix is None for native
+    """
+    ret = INTERMEDIATE_FORMATS.get(name)
+    if ret is None:
+        raise ValueError("Unknown intermediate format %s. Expect one of: %s" %
+                         (name, ", ".join(INTERMEDIATE_FORMATS.keys())))
+    return ret
+
+
+def is_npy(fn):
+    return os.path.splitext(fn)[1].lower() == ".npy"
+
+
+def exif_fn(fn):
+    return fn + ".exif"
+
+
+def unshare(fn):
+    """
+    fn (+ sidecar) is about to be rewritten
+    If it is a hardlink (see uscope.imagep.materialize), remove it
+    so that the write can't modify the source
+    """
+    for this_fn in (fn, exif_fn(fn)):
+        try:
+            if os.stat(this_fn).st_nlink > 1:
+                os.unlink(this_fn)
+        except FileNotFoundError:
+            pass
+
+
+# TIFF tags describing the pixel layout
+# PIL reports them as EXIF but they'd be wrong in any other file
+TIFF_LAYOUT_TAGS = (
+    254,  # NewSubfileType
+    256,  # ImageWidth
+    257,  # ImageLength
+    258,  # BitsPerSample
+    259,  # Compression
+    262,  # PhotometricInterpretation
+    266,  # FillOrder
+    273,  # StripOffsets
+    277,  # SamplesPerPixel
+    278,  # RowsPerStrip
+    279,  # StripByteCounts
+    284,  # PlanarConfiguration
+    317,  # Predictor
+    322,  # TileWidth
+    323,  # TileLength
+    324,  # TileOffsets
+    325,  # TileByteCounts
+    338,  # ExtraSamples
+    339,  # SampleFormat
+)
+
+
+def image_exif(im):
+    """
+    Return EXIF bytes to carry im's metadata into another file (ex: .tif => .jpg)
+    or None if it has none
+    """
+    exif = im.info.get("exif")
+    if exif:
+        return exif
+    if im.format != "TIFF":
+        return None
+    exif = im.getexif()
+    for tag in TIFF_LAYOUT_TAGS:
+        exif.pop(tag, None)
+    if 0x8769 in exif:
+        # Pull in the sub IFD (ex: exposure time) before it loses its file offset
+        exif.get_ifd(0x8769)
+    if not len(exif):
+        return None
+    return exif.tobytes()
+
+
+def save_exif_sidecar(fn, exif):
+    if exif:
+        with open(exif_fn(fn), "wb") as f:
+            f.write(exif)
+    elif os.path.exists(exif_fn(fn)):
+        os.unlink(exif_fn(fn))
+
+
+def load_exif_sidecar(fn):
+    """
+    Return the EXIF bytes saved with .npy fn or None
+    """
+    try:
+        with open(exif_fn(fn), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def save_tiff16(fn, array, exif=None, strip_bytes=1 << 20):
+    """
+    Write a 16 bit numpy array (h x w x 3) as an uncompressed TIFF
+    PIL can't hold the image but its TIFF tag writer still does the metadata
+    exif: EXIF bytes. Copied into the TIFF tags like PIL's own TIFF save()
+    """
+    height, width, channels = array.shape
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=b"II")
+    if exif:
+        tags = Image.Exif()
+        tags.load(exif)
+        for tag in tags:
+            if tag in TIFF_LAYOUT_TAGS:
+                continue
+            if tag in TiffTags.TAGS_V2_GROUPS:
+                ifd[tag] = tags.get_ifd(tag)
+            else:
+                ifd[tag] = tags.get(tag)
+    row_bytes = width * channels * 2
+    rows_per_strip = max(1, min(height, strip_bytes // row_bytes))
+    strips = (height + rows_per_strip - 1) // rows_per_strip
+    ifd[256] = width
+    ifd[257] = height
+    ifd[258] = (16, ) * channels
+    ifd[259] = 1
+    ifd[262] = 2
+    ifd[277] = channels
+    ifd[278] = rows_per_strip
+    ifd[284] = 1
+    ifd.tagtype[279] = TiffTags.LONG
+    ifd[279] = tuple(
+        row_bytes *
+        (min(height, (i + 1) * rows_per_strip) - i * rows_per_strip)
+        for i in range(strips))
+    # Relative to the end of the IFD, see ImageFileDirectory_v2.tobytes()
+    ifd.tagtype[273] = TiffTags.LONG
+    ifd[273] = tuple(i * rows_per_strip * row_bytes for i in range(strips))
+    with open(fn, "wb") as f:
+        ifd.save(f)
+        np.ascontiguousarray(array, dtype="<u2").tofile(f)
+
+
+def save_array16(array, fn, exif=None):
+    """
+    16 bit RGB numpy array
+    EXIF is kept for .tif and .npy (sidecar) but not .png (OpenCV writes it)
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in (".tif", ".tiff"):
+        save_tiff16(fn, array, exif=exif)
+    elif ext == ".png":
+        if not cv2.imwrite(fn, cv2.cvtColor(array, cv2.COLOR_RGB2BGR)):
+            raise IOError(f"Failed to write {fn}")
+    elif ext == ".npy":
+        with open(fn, "wb") as f:
+            np.save(f, array)
+        save_exif_sidecar(fn, exif)
+    else:
+        raise ValueError(
+            f"{fn}: 16 bit output requires a .tif / .png / .npy file")
+
+
+def save_image(im, fn, **kwargs):
+    """
+    Like PIL im.save(fn, **kwargs) but also understands .npy
+    im may also be a 16 bit numpy array, see save_array16()
+    Never writes through a hardlink
+    """
+    unshare(fn)
+    if isinstance(im, np.ndarray):
+        save_array16(im, fn, exif=kwargs.get("exif"))
+        return
+    if not is_npy(fn):
+        # Plugins ask for JPEG quality. Lossless TIFF compression rejects it
+        if kwargs.get("compression", "jpeg") != "jpeg":
+            kwargs = dict(kwargs)
+            kwargs.pop("quality", None)
+        im.save(fn, **kwargs)
+        return
+    with open(fn, "wb") as f:
+        np.save(f, np.asarray(im))
+    save_exif_sidecar(fn, kwargs.get("exif", im.info.get("exif")))
+
+
+def load_image(fn):
+    """
+    Like PIL Image.open(fn) but also understands .npy
+    .npy pixels are copied straight out of the page cache, no decode
+    """
+    if not is_npy(fn):
+        return Image.open(fn)
+    im = Image.fromarray(np.load(fn, mmap_mode="r"))
+    exif = load_exif_sidecar(fn)
+    if exif:
+        im.info["exif"] = exif
+    return im
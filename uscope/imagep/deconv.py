@@ -0,0 +1,228 @@
+"""
+Deconvolution by FFT (see CorrectDeconvPlugin)
+
+PSFs are given per channel in the microscope ipp config:
+"plugins": {
+    "correct-deconv": {
+        // wiener (default) or richardson-lucy
+        "method": "wiener",
+        // wiener: noise to signal power ratio. Higher => less sharpening, less noise
+        "balance": 0.01,
+        // richardson-lucy
+        "iterations": 10,
+        // Channels not listed are left alone
+        "psf": {
+            // Gaussian, sigma in pixels
+            "red": {"gaussian": 1.0},
+            // Weight by distance from center in pixels, like correct-vm1v1
+            "green": {"radial": [1.0, 0.5, 0.125]},
+            // Image or .npy, relative to the microscope data dir
+            "blue": {"file": "psf_blue.tif"},
+        },
+    },
+},
+
+Spatial convolution cost grows with PSF area, FFT cost doesn't
+The PSF transform (OTF) only depends on the tile size
+so it's computed once and reused for every tile
+"""
+
+from PIL import Image
+import numpy as np
+import cv2
+import hashlib
+import json
+import math
+import os
+
+CHANNELS = ("red", "green", "blue")
+DECONV_METHODS = ("wiener", "richardson-lucy")
+# Avoid divide by 0 in Richardson-Lucy
+RL_EPS = 1e-6
+
+
+def gaussian_psf(sigma):
+    radius = max(1, int(math.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    g = np.exp(-(x * x) / (2 * sigma * sigma))
+    return np.outer(g, g)
+
+
+def radial_psf(profile):
+    """
+    profile[i]: weight at distance i from the center, linearly interpolated
+    """
+    radius = len(profile) - 1
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    dist = np.sqrt(x[None, :]**2 + x[:, None]**2)
+    return np.interp(dist, np.arange(len(profile)), profile,
+                     right=0.0).astype(np.float32)
+
+
+def psf_fn(spec, base_dir=None):
+    fn = spec["file"]
+    if base_dir and not os.path.isabs(fn):
+        fn = os.path.join(base_dir, fn)
+    return fn
+
+
+def psf_cache_key(psfs, base_dir=None):
+    """
+    psfs: channel => config entry
+    Changes whenever the config or a PSF file changes
+    """
+    h = hashlib.sha1()
+    for channel, spec in sorted(psfs.items()):
+        h.update(("%s %s" %
+                  (channel, json.dumps(spec, sort_keys=True))).encode("utf-8"))
+        if "file" in spec:
+            fn = psf_fn(spec, base_dir)
+            st = os.stat(fn)
+            h.update(("%s %u %u" % (os.path.realpath(fn), st.st_size,
+                                    st.st_mtime_ns)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_psf(spec, base_dir=None):
+    """
+    Return a normalized float32 PSF from a config entry
+    """
+    if "gaussian" in spec:
+        psf = gaussian_psf(float(spec["gaussian"]))
+    elif "radial" in spec:
+        psf = radial_psf([float(x) for x in spec["radial"]])
+    elif "file" in spec:
+        fn = psf_fn(spec, base_dir)
+        if os.path.splitext(fn)[1].lower() == ".npy":
+            psf = np.load(fn)
+        else:
+            psf = np.asarray(Image.open(fn).convert("F"))
+        psf = np.asarray(psf, dtype=np.float32)
+    else:
+        raise ValueError(f"Bad PSF {spec}")
+    if psf.ndim != 2:
+        raise ValueError(f"PSF must be 2D, got shape {psf.shape}")
+    total = psf.sum()
+    if total <= 0:
+        raise ValueError(f"PSF must have positive sum: {spec}")
+    return psf / total
+
+
+def padded_shape(shape, psf):
+    """
+    Image is reflect padded by the PSF radius to avoid wrap around artifacts
+    then up to a size the FFT is fast at
+    """
+    return tuple(
+        cv2.getOptimalDFTSize(n + 2 * (p // 2))
+        for n, p in zip(shape, psf.shape))
+
+
+def psf_kernel(psf, shape):
+    """
+    Return psf zero padded to shape with its center at the origin
+    """
+    padded = np.zeros(shape, dtype=np.float32)
+    padded[:psf.shape[0], :psf.shape[1]] = psf
+    return np.roll(padded, (-(psf.shape[0] // 2), -(psf.shape[1] // 2)),
+                   axis=(0, 1))
+
+
+def dft(channel):
+    # Packed (CCS) real transform: about twice as fast as complex output
+    return cv2.dft(channel)
+
+
+def idft(spectrum):
+    return cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+
+
+class PSFTransform:
+    """
+    Precomputed frequency domain PSF for one tile size
+    """
+    def __init__(self, psf, shape):
+        self.psf = psf
+        self.shape = shape
+        self.pad_shape = padded_shape(shape, psf)
+        self.kernel = psf_kernel(psf, self.pad_shape)
+        self.otf = dft(self.kernel)
+        # balance => filter
+        self.wiener_filters = {}
+
+    def wiener_filter(self, balance):
+        """
+        conj(H) / (|H|^2 + balance) is the transform of a real kernel
+        so it can be brought to the packed format via that kernel
+        """
+        wiener_filter = self.wiener_filters.get(balance)
+        if wiener_filter is None:
+            otf = np.fft.rfft2(self.kernel)
+            kernel = np.fft.irfft2(np.conj(otf) / (np.abs(otf)**2 + balance),
+                                   s=self.pad_shape)
+            wiener_filter = dft(kernel.astype(np.float32))
+            self.wiener_filters[balance] = wiener_filter
+        return wiener_filter
+
+    def pad(self, channel):
+        """
+        Reflect pad by at least the PSF radius on every side
+        so that FFT wrap around never reaches the image
+        """
+        top, left = self.psf.shape[0] // 2, self.psf.shape[1] // 2
+        bottom = self.pad_shape[0] - self.shape[0] - top
+        right = self.pad_shape[1] - self.shape[1] - left
+        return cv2.copyMakeBorder(channel, top, bottom, left, right,
+                                  cv2.BORDER_REFLECT)
+
+    def crop(self, channel):
+        top, left = self.psf.shape[0] // 2, self.psf.shape[1] // 2
+        return channel[top:top + self.shape[0], left:left + self.shape[1]]
+
+    def wiener(self, channel, balance):
+        """
+        One forward / inverse FFT pair
+        """
+        return self.crop(
+            idft(
+                cv2.mulSpectrums(dft(self.pad(channel)),
+                                 self.wiener_filter(balance), 0)))
+
+    def convolve(self, channel, correlate=False):
+        """
+        correlate: convolve with the PSF flipped (adjoint)
+        """
+        return idft(
+            cv2.mulSpectrums(dft(channel), self.otf, 0, conjB=correlate))
+
+    def richardson_lucy(self, channel, iterations):
+        observed = np.maximum(self.pad(channel), 0) + RL_EPS
+        estimate = observed.copy()
+        for _i in range(iterations):
+            blurred = self.convolve(estimate)
+            estimate *= self.convolve(observed / (blurred + RL_EPS),
+                                      correlate=True)
+        return self.crop(estimate)
+
+
+def deconvolve(image,
+               transforms,
+               method="wiener",
+               balance=0.01,
+               iterations=10):
+    """
+    image: h x w x c numpy array
+    transforms: channel index => PSFTransform. Other channels are copied
+    Return float32 array, same shape, not clipped
+    """
+    if method not in DECONV_METHODS:
+        raise ValueError(f"Unknown deconvolution method {method}")
+    ret = image.astype(np.float32)
+    for channeli, transform in transforms.items():
+        channel = np.ascontiguousarray(ret[:, :, channeli])
+        if method == "wiener":
+            ret[:, :, channeli] = transform.wiener(channel, balance)
+        else:
+            ret[:, :,
+                channeli] = transform.richardson_lucy(channel, iterations)
+    return ret
@@ -0,0 +1,159 @@
+"""
+Flat field (+ optional dark frame) correction
+
+corrected = (image - dark) * gain
+gain = max(ff - dark) / (ff - dark) per band
+where max is taken at the 99th percentile to ignore outliers
+
+The gain (and dark) maps are computed once per calibration
+and cached as float32 .npy files
+Every worker memory maps the same read only files
+so threads and processes share one copy through the page cache
+"""
+
+from PIL import Image
+import numpy as np
+import hashlib
+import tempfile
+import threading
+import os
+
+# Fraction of flat field pixels allowed above the normalization max
+FF_OUTLIER_THRESH = 0.01
+
+_calibrations = {}
+_calibrations_lock = threading.Lock()
+
+
+class FFCalibration:
+    def __init__(self, gain, dark=None):
+        # h x w x 3 float32, read only
+        self.gain = gain
+        self.dark = dark
+        # PIL style (width, height)
+        self.size = (gain.shape[1], gain.shape[0])
+
+
+def ff_cache_dir():
+    return os.path.join(tempfile.gettempdir(), "pyuscope_ff")
+
+
+def ff_cache_key(ff_fn, dark_fn=None):
+    """
+    Changes whenever a calibration file is replaced
+    """
+    h = hashlib.sha1()
+    for fn in (ff_fn, dark_fn):
+        if fn is None:
+            h.update(b"none")
+            continue
+        st = os.stat(fn)
+        h.update(("%s %u %u" % (os.path.realpath(fn), st.st_size,
+                                st.st_mtime_ns)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def compute_ff_gain(ff, dark=None):
+    """
+    ff / dark: h x w x 3 numpy arrays
+    Return float32 h x w x 3 per pixel multiplier
+    """
+    ff = ff.astype(np.float32)
+    if dark is not None:
+        ff -= dark
+    # Dead / fully dark pixels: don't blow up to infinity
+    ff = np.maximum(ff, 1.0)
+    # Boost dim values by scalars in the range 1.0 to near 0.0
+    # The lower the flat field value, the more it needs to be scaled
+    # Values at max flat field value stay the same
+    # It's easy to have an outlier that boosts everything => not the true max
+    band_max = np.quantile(ff.reshape(-1, ff.shape[2]),
+                           1.0 - FF_OUTLIER_THRESH,
+                           axis=0,
+                           method="inverted_cdf")
+    return (band_max.astype(np.float32) / ff).astype(np.float32)
+
+
+def save_npy_atomic(fn, arr):
+    """
+    Other workers may be loading the same cache file
+    """
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_fn, fn)
+    except Exception:
+        os.unlink(tmp_fn)
+        raise
+
+
+def load_ff_calibration(ff_fn, dark_fn=None, cache_dir=None):
+    """
+    Return a FFCalibration backed by memory mapped cache files
+    Cache files are created on first use
+    """
+    if cache_dir is None:
+        cache_dir = ff_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = ff_cache_key(ff_fn, dark_fn)
+    gain_fn = os.path.join(cache_dir, key + "_gain.npy")
+    dark_npy_fn = os.path.join(cache_dir, key + "_dark.npy")
+
+    if not os.path.exists(gain_fn):
+        ff = np.array(Image.open(ff_fn).convert("RGB"))
+        dark = None
+        if dark_fn:
+            dark = np.array(Image.open(dark_fn).convert("RGB"),
+                            dtype=np.float32)
+            if dark.shape != ff.shape:
+                raise ValueError(
+                    "Dark frame size %uw x %uh doesn't match flat field %uw x %uh"
+                    % (dark.shape[1], dark.shape[0], ff.shape[1],
+                       ff.shape[0]))
+            save_npy_atomic(dark_npy_fn, dark)
+        save_npy_atomic(gain_fn, compute_ff_gain(ff, dark))
+
+    dark = None
+    if dark_fn:
+        dark = np.load(dark_npy_fn, mmap_mode="r")
+    return FFCalibration(np.load(gain_fn, mmap_mode="r"), dark)
+
+
+def get_ff_calibration(ff_fn, dark_fn=None):
+    """
+    Like load_ff_calibration() but shared by everyone in this process
+    """
+    key = ff_cache_key(ff_fn, dark_fn)
+    with _calibrations_lock:
+        ret = _calibrations.get(key)
+        if ret is None:
+            ret = load_ff_calibration(ff_fn, dark_fn)
+            _calibrations[key] = ret
+        return ret
+
+
+def ff_correct(image, cal, bits=8):
+    """
+    image: h x w x 3 numpy array (8 bit)
+    Return corrected h x w x 3 numpy array
+    bits
+        8: uint8
+        16: uint16, keeps the fractional part of the correction
+    """
+    out = image.astype(np.float32)
+    if cal.dark is not None:
+        np.subtract(out, cal.dark, out=out)
+        np.maximum(out, 0.0, out=out)
+    np.multiply(out, cal.gain, out=out)
+    if bits == 16:
+        # 255 => 65535
+        np.multiply(out, 257.0, out=out)
+        dtype = np.uint16
+    elif bits == 8:
+        dtype = np.uint8
+    else:
+        raise ValueError(f"Unsupported output bits {bits}")
+    np.rint(out, out=out)
+    np.minimum(out, np.iinfo(dtype).max, out=out)
+    return out.astype(dtype)
@@ -0,0 +1,431 @@
+"""
+Process many scans at once (ex: cs_auto watching the scan directory)
+
+ScanJobQueue: scans seen so far and their state, persisted to JSON
+    so that a restart neither redoes nor forgets anything
+UploadGate: limits how often CloudStitch uploads start (shared across processes)
+    Processing itself is never held back by it
+DirWatcher: wakes up when the scan directory changes
+    inotify if inotify_simple is installed, otherwise polling
+ScanScheduler: runs up to max_scans scans concurrently
+    Each scan runs in its own process and logs to <scan>/cs_auto.log
+    Cores are one budget shared by the running scans:
+    every scan has a worker per core but only its share of them take tasks
+    Shares are rebalanced as scans start and finish (a lone scan gets all of them)
+    New scans don't start while free memory is below a threshold
+    Explicitly given directories are instead processed one at a time
+    in the foreground, output to the terminal, uploads not throttled
+
+A scan is ready once the planner has written uscan.json (last file written)
+"""
+
+from uscope.util import writej
+from uscope.imagep.pipeline import process_dir, already_uploaded
+import json
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+JOBS_FN = "cs_auto_jobs.json"
+# Per scan processing log
+SCAN_LOG_FN = "cs_auto.log"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def scan_ready(directory):
+    return os.path.exists(os.path.join(directory, "uscan.json"))
+
+
+class ScanJobQueue:
+    """
+    Jobs keyed by scan directory basename, in arrival order
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        # basename => {"dir", "state", "queued", "started", "finished", "error"}
+        self.jobs = {}
+        if os.path.exists(fn):
+            with open(fn, "r") as f:
+                self.jobs = json.load(f)["jobs"]
+        # Interrupted or failed: try again (DirCSIP lazy mode resumes the work)
+        for job in self.jobs.values():
+            if job["state"] in (JOB_RUNNING, JOB_FAILED):
+                job["state"] = JOB_QUEUED
+
+    def save(self):
+        tmp_fn = self.fn + ".tmp"
+        writej(tmp_fn, {"jobs": self.jobs})
+        os.replace(tmp_fn, self.fn)
+
+    def add(self, directory):
+        """
+        Return True if directory is new
+        """
+        basename = os.path.basename(os.path.abspath(directory))
+        with self.lock:
+            if basename in self.jobs:
+                return False
+            self.jobs[basename] = {
+                "dir": os.path.abspath(directory),
+                "state": JOB_QUEUED,
+                "queued": time.time(),
+                "started": None,
+                "finished": None,
+                "error": None,
+            }
+            self.save()
+            return True
+
+    def set_state(self, basename, state, error=None):
+        with self.lock:
+            job = self.jobs[basename]
+            job["state"] = state
+            if state == JOB_RUNNING:
+                job["started"] = time.time()
+            elif state in (JOB_DONE, JOB_FAILED):
+                job["finished"] = time.time()
+                job["error"] = error
+            self.save()
+
+    def queued(self):
+        """
+        Return basenames waiting to run, oldest first
+        """
+        with self.lock:
+            return sorted([
+                k for k, job in self.jobs.items() if job["state"] == JOB_QUEUED
+            ],
+                          key=lambda k: self.jobs[k]["queued"])
+
+    def get(self, basename):
+        with self.lock:
+            return dict(self.jobs[basename])
+
+
+class UploadGate:
+    """
+    Allow at most burst uploads to start per interval seconds
+    Previously: sleep interval seconds before each upload after the first burst
+    Safe to pass to processes created with the same multiprocessing context
+    """
+    def __init__(self, burst=2, interval=2400, ctx=None):
+        if ctx is None:
+            ctx = multiprocessing.get_context("spawn")
+        self.interval = interval
+        self.lock = ctx.Lock()
+        # Start times of the last burst uploads
+        self.starts = ctx.Array("d", [0.0] * burst, lock=False)
+
+    def acquire(self, log=print):
+        warned = False
+        while True:
+            with self.lock:
+                oldest = min(range(len(self.starts)),
+                             key=lambda i: self.starts[i])
+                wait = self.starts[oldest] + self.interval - time.time()
+                if wait <= 0:
+                    self.starts[oldest] = time.time()
+                    return
+            if not warned:
+                log("WARNING: throttling upload to let stitch server catch up (%u sec)"
+                    % math.ceil(wait))
+                warned = True
+            time.sleep(min(wait, 60))
+
+
+class DirWatcher:
+    """
+    Wait for something to change in a directory or any of given subdirectories
+    """
+    def __init__(self, directory, poll_interval=30.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.inotify = None
+        # path => watch descriptor
+        self.watches = {}
+        if inotify_simple:
+            self.inotify = inotify_simple.INotify()
+            self.watch(directory)
+
+    def watch(self, directory):
+        """
+        Also wake up on changes inside directory (ex: uscan.json appearing)
+        """
+        if self.inotify is None or directory in self.watches:
+            return
+        flags = inotify_simple.flags
+        try:
+            self.watches[directory] = self.inotify.add_watch(
+                directory, flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE)
+        except OSError:
+            pass
+
+    def unwatch(self, directory):
+        wd = self.watches.pop(directory, None)
+        if wd is not None:
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                # Directory already gone
+                pass
+
+    def wait(self, timeout=None):
+        """
+        Return after a change, timeout seconds or poll_interval when polling
+        """
+        if self.inotify is None:
+            if timeout is None:
+                timeout = self.poll_interval
+            time.sleep(min(timeout, self.poll_interval))
+            return
+        self.inotify.read(timeout=None if timeout is None else int(timeout *
+                                                                   1000))
+        # Coalesce bursts (ex: a scan writing images)
+        self.inotify.read(timeout=100)
+
+
+def run_scan_job(directory, log_fn, kwargs):
+    """
+    Entry point of a scan process
+    """
+    fd = os.open(log_fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    # Also captures enfuse etc output
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout = os.fdopen(1, "w", buffering=1)
+    sys.stderr = os.fdopen(2, "w", buffering=1)
+    try:
+        process_dir(directory, **kwargs)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+class ScanScheduler:
+    """
+    directories: process these in this process, one at a time, then return
+    scan_dir: process anything ready in here, max_scans at once
+        watch: keep going, picking up new scans as they complete
+        Skips scans already uploaded and scans renamed after their QR code
+    nthreads: worker threads shared by all running scans
+    max_scans: scans processed at once
+    min_free_memory: don't start another scan below this many bytes available
+    kwargs: passed to process_dir() (ex: upload, lazy)
+    """
+    def __init__(self,
+                 directories=None,
+                 scan_dir=None,
+                 watch=False,
+                 nthreads=None,
+                 max_scans=2,
+                 min_free_memory=4 * 1024**3,
+                 upload_burst=2,
+                 upload_interval=2400,
+                 poll_interval=30.0,
+                 log=None,
+                 **kwargs):
+        if log is None:
+
+            def log(s):
+                print(s)
+
+        self.log = log
+        self.directories = directories
+        self.scan_dir = scan_dir
+        self.watch = watch
+        if not nthreads:
+            nthreads = multiprocessing.cpu_count()
+        if directories:
+            # Foreground
+            max_scans = 1
+        self.max_scans = max_scans
+        self.nthreads = nthreads
+        self.min_free_memory = min_free_memory
+        self.poll_interval = poll_interval
+        self.kwargs = kwargs
+        self.ctx = multiprocessing.get_context("spawn")
+        self.upload_gate = UploadGate(burst=upload_burst,
+                                      interval=upload_interval,
+                                      ctx=self.ctx)
+        # Only needed when discovering scans
+        self.jobs = None
+        if not directories:
+            self.jobs = ScanJobQueue(os.path.join(scan_dir, JOBS_FN))
+        self.watcher = None
+        # basename => multiprocessing.Process
+        self.running = {}
+        # basename => shared worker_limit of the scan's CSImageProcessor
+        self.worker_limits = {}
+
+    def discover(self):
+        """
+        Queue ready scans not seen before
+        """
+        for basename in sorted(os.listdir(self.scan_dir)):
+            directory = os.path.join(self.scan_dir, basename)
+            if not os.path.isdir(directory) or basename in self.jobs.jobs:
+                continue
+            if not scan_ready(directory):
+                # Wake up when uscan.json shows up
+                if self.watcher:
+                    self.watcher.watch(directory)
+                continue
+            if self.watcher:
+                self.watcher.unwatch(directory)
+            if already_uploaded(directory):
+                self.log(f"{basename}: skip, already uploaded")
+                self.jobs.add(directory)
+                self.jobs.set_state(basename, JOB_DONE)
+                continue
+            renamed_from = self.renamed_from(basename)
+            if renamed_from:
+                self.log(f"{basename}: skip, QR renamed {renamed_from}")
+                self.jobs.add(directory)
+                self.jobs.set_state(basename, JOB_DONE)
+                continue
+            self.log(f"{basename}: queued")
+            self.jobs.add(directory)
+
+    def renamed_from(self, basename):
+        """
+        Processing renames a scan after its QR code (<scan>_<qr>)
+        Return the job basename that basename was renamed from or None
+        """
+        for k, job in self.jobs.jobs.items():
+            # May still be running: renamed before the upload
+            if basename.startswith(k + "_") and not os.path.exists(job["dir"]):
+                return k
+        return None
+
+    def rebalance(self):
+        """
+        Split the cores evenly across running scans
+        """
+        if not self.worker_limits:
+            return
+        share, extra = divmod(self.nthreads, len(self.worker_limits))
+        for i, basename in enumerate(sorted(self.worker_limits)):
+            self.worker_limits[basename].value = max(
+                1, share + (1 if i < extra else 0))
+
+    def memory_ok(self):
+        if psutil is None or not self.running:
+            return True
+        return psutil.virtual_memory().available >= self.min_free_memory
+
+    def start(self, basename, directory):
+        log_fn = os.path.join(directory, SCAN_LOG_FN)
+        worker_limit = self.ctx.Value("i", self.nthreads)
+        self.worker_limits[basename] = worker_limit
+        self.rebalance()
+        kwargs = dict(self.kwargs,
+                      nthreads=self.nthreads,
+                      worker_limit=worker_limit,
+                      upload_gate=self.upload_gate)
+        process = self.ctx.Process(target=run_scan_job,
+                                   args=(directory, log_fn, kwargs),
+                                   name=f"cs_auto-{basename}")
+        process.start()
+        self.running[basename] = process
+        self.log(f"{basename}: start w/ {worker_limit.value} / "
+                 f"{self.nthreads} threads, log {log_fn}")
+
+    def reap(self):
+        """
+        Return basenames that finished since last call and if they succeeded
+        """
+        ret = []
+        for basename, process in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.running[basename]
+            del self.worker_limits[basename]
+            ok = process.exitcode == 0
+            self.log(f"{basename}: {'done' if ok else 'FAILED'}")
+            ret.append((basename, ok))
+        # Hand the cores to whatever is still running
+        self.rebalance()
+        return ret
+
+    def fill(self, pending):
+        """
+        Start scans from pending (list of (basename, directory)) while there is room
+        Return what is left
+        """
+        while pending and len(self.running) < self.max_scans:
+            if not self.memory_ok():
+                break
+            basename, directory = pending.pop(0)
+            if self.jobs:
+                self.jobs.set_state(basename, JOB_RUNNING)
+            self.start(basename, directory)
+        return pending
+
+    def run_directories(self):
+        """
+        Like a scan process but output and errors go straight to the caller
+        Uploads aren't throttled: the user asked for these
+        """
+        for directory in self.directories:
+            basename = os.path.basename(os.path.abspath(directory))
+            self.log(f"{basename}: start w/ {self.nthreads} threads")
+            process_dir(directory,
+                        nthreads=self.nthreads,
+                        upload_gate=None,
+                        **self.kwargs)
+            self.log(f"{basename}: done")
+        return []
+
+    def run_scan_dir(self):
+        if self.watch:
+            self.watcher = DirWatcher(self.scan_dir,
+                                      poll_interval=self.poll_interval)
+        failed = []
+        while True:
+            self.discover()
+            for basename, ok in self.reap():
+                self.jobs.set_state(basename,
+                                    JOB_DONE if ok else JOB_FAILED,
+                                    error=None if ok else "see " + SCAN_LOG_FN)
+                if not ok:
+                    failed.append(basename)
+            pending = [(basename, self.jobs.get(basename)["dir"])
+                       for basename in self.jobs.queued()]
+            self.fill(pending)
+            if not self.running and not self.jobs.queued() and not self.watch:
+                return failed
+            if self.watcher and not self.running:
+                self.watcher.wait()
+            else:
+                # Poll children
+                time.sleep(1.0)
+
+    def run(self):
+        """
+        Return list of scans that failed
+        """
+        if self.directories:
+            return self.run_directories()
+        else:
+            return self.run_scan_dir()
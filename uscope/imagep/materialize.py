@@ -0,0 +1,91 @@
+"""
+Make a file appear somewhere else without copying its bytes when possible
+
+Stages that don't change an image (ex: a stack of one) and fix_dir
+used to write a full copy. Instead try, in order:
+-rename: if the source is disposable
+-hardlink: same filesystem. No data written at all
+-reflink (FICLONE): copy on write clone on btrfs / XFS. Independent file
+-copy: fallback
+Hardlinked outputs share the inode with their source
+so anything about to rewrite one must unshare() it first
+codec.save_image() and EtherealImageW.get_filename() do
+"""
+
+from uscope.imagep.codec import exif_fn, is_npy
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MATERIALIZE_METHODS = ("hardlink", "reflink", "copy")
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Not supported here: try the next method
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+                   errno.ENOTSUP, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                   errno.EACCES)
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink not supported", dst)
+    with open(src, "rb") as f_src:
+        with open(dst, "wb") as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            except OSError:
+                os.unlink(dst)
+                raise
+
+
+def materialize(src, dst, methods=MATERIALIZE_METHODS, move=False):
+    """
+    Make dst have the contents of src, replacing dst if it exists
+    move: src is no longer needed. Rename if possible
+    Return the method used
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if move:
+        try:
+            os.rename(src, dst)
+            return "rename"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(src, dst)
+            elif method == "reflink":
+                reflink(src, dst)
+            elif method == "copy":
+                shutil.copyfile(src, dst)
+            else:
+                raise ValueError(f"Unknown method {method}")
+        except OSError as e:
+            if method == "copy" or e.errno not in FALLBACK_ERRNOS:
+                raise
+            continue
+        if move:
+            os.unlink(src)
+        return method
+    raise OSError(errno.ENOTSUP, "no materialize method worked", dst)
+
+
+def materialize_image(src, dst, **kwargs):
+    """
+    Like materialize() but also brings along an .npy EXIF sidecar
+    """
+    ret = materialize(src, dst, **kwargs)
+    if is_npy(src) and os.path.exists(exif_fn(src)):
+        materialize(exif_fn(src), exif_fn(dst), **kwargs)
+    elif os.path.lexists(exif_fn(dst)):
+        os.unlink(exif_fn(dst))
+    return ret
+
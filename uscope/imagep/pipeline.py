@@ -13,10 +13,16 @@ These are image processing algorithms such as HDR or focus stacking
 They generally take one or more images in and produce a single image out
 """
 
-from uscope.scan_util import index_scan_images
-from uscope.imagep.util import EtherealImageR, EtherealImageW
-from uscope.imagep.streams import DirCSIP, SnapshotCSIP
+from uscope.scan_util import index_scan_images, iindex_parse_fn, bucket_group
+from uscope.imagep.util import (EtherealImageR, EtherealImageW, encode_data,
+                                decode_data, encode_data_results,
+                                decode_data_results, TaskScheduler,
+                                TaskBarrier, SubtaskException,
+                                TASK_PRIORITY_BATCH)
+from uscope.imagep.streams import DirCSIP, SnapshotCSIP, StreamCSIP
 from uscope.imagep.plugins import get_plugins, get_plugin_ctors
+from uscope.imagep.telemetry import TaskMeter
+from uscope.imagep.materialize import materialize_image
 from uscope import config
 from uscope.microscope import get_virtual_microscope, get_mconfig
 from uscope.threads import ShutdownPhase
@@ -28,10 +34,12 @@ import shutil
 from collections import OrderedDict
 import traceback
 import multiprocessing
+from multiprocessing import resource_tracker
+import pickle
 import threading
-import queue
 import tempfile
 import json
+import time
 
 
 def get_open_set(working_iindex):
@@ -50,73 +58,187 @@ def already_uploaded(directory):
                          recursive=True)) > 0
 
 
+# Pseudo task: take one tile through a whole plugin chain on a single worker
+FUSED_TASK = "fused"
+# How often a worker over CSImageProcessor worker_limit checks
+# if it may run again
+WORKER_LIMIT_POLL = 0.5
+
+
+def run_fused_chain(plugins, data_in, data_out, options):
+    """
+    Run a sequence of plugins on one tile
+    Intermediate images stay in memory and are never written to the output dir
+
+    data_in: "images": list of EtherealImageR making up the tile
+    data_out: "image": EtherealImageW for the final image
+    options
+        stages: list of {"plugin", "bucket"}
+            bucket: ex "hdr" to merge all images differing only by hdr index
+            None for 1 to 1 plugins
+        basenames: scan file name of each input image (ex: c000_r001_h02.jpg)
+        temp_dir: where intermediate images go if a plugin needs a file
+    Returns plugin results merged across the chain
+        align_quality: worst of any stage
+    """
+    ret = {}
+    images = OrderedDict(zip(options["basenames"], data_in["images"]))
+    stages = options["stages"]
+    for stagei, stage in enumerate(stages):
+        if stage["bucket"]:
+            iindex = {
+                "images": {
+                    basename: iindex_parse_fn(basename)
+                    for basename in images
+                }
+            }
+            jobs = []
+            for fn_prefix, bucket in bucket_group(iindex,
+                                                  stage["bucket"]).items():
+                basenames = [fn for _i, fn in sorted(bucket.items())]
+                extension = iindex["images"][basenames[0]]["extension"]
+                jobs.append((fn_prefix + extension, {
+                    "images": [images[fn] for fn in basenames]
+                }))
+        else:
+            jobs = [(basename, {
+                "image": image
+            }) for basename, image in images.items()]
+
+        last = stagei == len(stages) - 1
+        if last:
+            assert len(jobs) == 1, (
+                "Chain must reduce to a single image, got %u" % len(jobs))
+        images = OrderedDict()
+        for basename, data_in_this in jobs:
+            if last:
+                data_out_this = data_out
+            else:
+                data_out_this = {
+                    "image":
+                    EtherealImageW(want_im=True,
+                                   temp_dir=options.get("temp_dir"))
+                }
+            # Ex: EXIF from a stage before stays in the final image
+            data_out_this["image"].inherit_save_kwargs(
+                data_in_this.get("images") or [data_in_this["image"]])
+            result = plugins[stage["plugin"]].run(data_in=data_in_this,
+                                                  data_out=data_out_this)
+            if result and "align_quality" in result:
+                ret["align_quality"] = min(ret.get("align_quality", 1.0),
+                                           result["align_quality"])
+            if not last:
+                images[basename] = EtherealImageR(
+                    im=data_out_this["image"].get_im(),
+                    temp_dir=options.get("temp_dir"),
+                    save_kwargs=data_out_this["image"].get_save_kwargs())
+    return ret
+
+
+def run_task(plugins, task_name, data_in, data_out, options):
+    if task_name == FUSED_TASK:
+        return run_fused_chain(plugins, data_in, data_out, options)
+    return plugins[task_name].run(data_in=data_in,
+                                  data_out=data_out,
+                                  options=options)
+
+
 class CSImageProcessorThread(threading.Thread):
     """
     A single worker thread that can perform a number of low level corrections
     Intended to be used with CSImageProcessor
     """
-    def __init__(self, csip, name):
+    def __init__(self, csip, name, index=0):
         super().__init__()
         self.csip = csip
         self.log = self.csip.log
         self.name = name
+        # See CSImageProcessor worker_limit
+        self.index = index
         self.running = threading.Event()
-        # Set for single commands
-        self.simple_idle = threading.Event()
-        self.simple_idle.set()
-        self.queue_in = queue.Queue()
-        # self.queue_out = queue.Queue()
 
         # Each thrread gets its own set of correction engines
-        self.plugins = get_plugins(log=self.log,
-                                   microscope=self.csip.microscope)
+        self.plugins = self.create_plugins()
+        self.meter = TaskMeter(per_thread=True)
         self.running.set()
 
+    def create_plugins(self):
+        return get_plugins(log=self.log, microscope=self.csip.microscope)
+
     def stop(self):
         self.running.clear()
 
-    def queue_command(self, ip_params):
-        self.queue_in.put(ip_params)
+    def has_plugin(self, task_name):
+        return task_name == FUSED_TASK or task_name in self.plugins
 
-    """
-    def wait_queue_out(self, command=None, timeout=None):
-        (call_info, result, info) = self.queue_in.get(True, timeout)
-        (name, data_in, data_out, options) = call_info
-        if result != "ok":
-            raise Exception(f"Command {name} failed: {result} {info}")
-        if command:
-            assert name == command
-        return info
-    """
+    def execute(self, ip_params):
+        """
+        Run the task and return the plugin result
+        Adds resource usage to ip_params.telemetry
+        Raises on plugin failure
+        """
+        self.meter.start()
+        try:
+            return run_task(self.plugins,
+                            ip_params.task_name,
+                            data_in=ip_params.data_in,
+                            data_out=ip_params.data_out,
+                            options=ip_params.options)
+        finally:
+            ip_params.telemetry.update(self.meter.stop())
 
     def run(self):
-
+        scheduler = self.csip.scheduler
         while self.running.is_set():
-            try:
-                ip_params = self.queue_in.get(True, 0.1)
-            except queue.Empty:
+            if not self.csip.worker_allowed(self):
+                # Cores are lent to another scan for now
+                time.sleep(WORKER_LIMIT_POLL)
                 continue
+            # Blocks until there is work. None => shutting down
+            ip_params = scheduler.get()
+            if ip_params is None:
+                break
+
+            start = time.time()
+            ip_params.telemetry = {
+                "worker": self.name,
+                "start": start,
+                "queue_s": start - ip_params.queued_time,
+            }
 
             def finish_command(result, info):
+                ip_params.result = result
+                end = time.time()
+                ip_params.telemetry["end"] = end
+                ip_params.telemetry["wall_s"] = end - start
                 out = (ip_params, result, info)
-                # self.queue_out.put(out)
-                if ip_params.tb:
-                    if result != "ok":
-                        ip_params.tb.add_exception()
-                    ip_params.tb.callback()
-                if ip_params.callback:
-                    ip_params.callback(*out)
-                self.simple_idle.set()
-
-            plugin = self.plugins.get(ip_params.task_name)
-            if plugin is None:
+                # User callback first: it may queue follow up tasks
+                # that the barrier needs to know about
+                try:
+                    if ip_params.callback:
+                        ip_params.callback(*out)
+                finally:
+                    scheduler.task_done(ip_params)
+                    if ip_params.tb:
+                        if result != "ok":
+                            ip_params.tb.add_exception()
+                        ip_params.tb.callback()
+
+            failed_deps = [
+                dep.task_name for dep in ip_params.deps if dep.result != "ok"
+            ]
+            if failed_deps:
+                finish_command(
+                    "exception",
+                    SubtaskException("Dependency failed: %s" %
+                                     ", ".join(failed_deps)))
+                continue
+            if not self.has_plugin(ip_params.task_name):
                 self.log(f"Invalid plugin {ip_params.task_name}")
                 finish_command("error", "invalid command")
                 continue
             try:
-                ret = plugin.run(data_in=ip_params.data_in,
-                                 data_out=ip_params.data_out,
-                                 options=ip_params.options)
+                ret = self.execute(ip_params)
                 # self.log("Command done")
                 finish_command("ok", ret)
             except Exception as e:
@@ -127,6 +249,180 @@ class CSImageProcessorThread(threading.Thread):
                 continue
 
 
+# Options that are only meaningful to the dispatcher
+# and are expensive or impossible to send to another process
+PROCESS_SKIP_OPTIONS = ("captured_image", )
+
+
+def process_safe_options(options):
+    """
+    Reduce plugin options to what can be pickled to a worker process
+    """
+    ret = {}
+    for k, v in options.items():
+        if k in PROCESS_SKIP_OPTIONS:
+            continue
+        try:
+            pickle.dumps(v)
+        except Exception as e:
+            raise ValueError(
+                f"Option {k} can't be sent to a worker process: {e}") from e
+        ret[k] = v
+    return ret
+
+
+class WorkerProcessDied(Exception):
+    """
+    The worker process exited (ex: segfault, OOM kill) while running a task
+    """
+    pass
+
+
+def process_worker_main(conn, mconfig):
+    """
+    Entry point of a worker process
+    Runs plugins on request from a CSImageProcessorProcess
+    and replies with the result
+    mconfig: microscope name / serial. None => no microscope
+    """
+    def log(s):
+        print(s)
+
+    microscope = None
+    if mconfig is not None:
+        microscope = get_virtual_microscope(mconfig=mconfig)
+    plugins = get_plugins(log=log, microscope=microscope)
+    # Only this process runs tasks: count all of it
+    meter = TaskMeter(per_thread=False)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        # Shutdown request
+        if request is None:
+            break
+        task_name, data_in, data_out, options = request
+        meter.start()
+        try:
+            data_out = decode_data(data_out)
+            ret = run_task(plugins,
+                           task_name,
+                           data_in=decode_data(data_in),
+                           data_out=data_out,
+                           options=options)
+            reply = ("ok", ret, encode_data_results(data_out), meter.stop())
+        except Exception as e:
+            log("")
+            log("WARNING: worker process crashed")
+            tb = traceback.format_exc()
+            log(tb)
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = Exception(tb)
+            reply = ("exception", e, {}, meter.stop())
+        try:
+            conn.send(reply)
+        except Exception as e:
+            conn.send(("exception", Exception(f"Failed to send result: {e}"),
+                       {}, reply[3]))
+    conn.close()
+
+
+class CSImageProcessorProcess(CSImageProcessorThread):
+    """
+    Dispatcher side of a worker that runs plugins in its own process
+    This side keeps the queue / callback contract of CSImageProcessorThread
+    but numpy heavy plugins no longer contend for this process's GIL
+    In memory images are handed to the worker through shared memory
+
+    Workers are not forked: the dispatcher already runs threads
+    (GUI, imager, other workers) and a fork can copy one of their locks held
+    The worker starts clean and reloads the microscope config from its files
+    so in memory config changes aren't seen by plugins there
+    """
+    def __init__(self, csip, name, index=0):
+        super().__init__(csip, name, index=index)
+        self.conn = None
+        self.process = None
+        self.start_process()
+
+    def start_process(self):
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("forkserver")
+        else:
+            ctx = multiprocessing.get_context("spawn")
+        if self.conn is not None:
+            self.conn.close()
+        self.conn, child_conn = ctx.Pipe()
+        # Started before the worker so both share the one tracker
+        resource_tracker.ensure_running()
+        mconfig = None
+        microscope = self.csip.microscope
+        if microscope is not None:
+            mconfig = get_mconfig(name=microscope.name,
+                                  serial=microscope.serial())
+        self.process = ctx.Process(target=process_worker_main,
+                                   args=(child_conn, mconfig),
+                                   name=f"csip-{self.name}",
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def create_plugins(self):
+        # Plugins are instantiated in the worker process
+        return None
+
+    def has_plugin(self, task_name):
+        return task_name == FUSED_TASK or task_name in get_plugin_ctors()
+
+    def execute(self, ip_params):
+        # Died on an earlier task: only that task failed, keep going
+        if not self.process.is_alive():
+            self.log(f"WARNING: {self.name}: worker process died "
+                     f"(exit code {self.process.exitcode}), restarting")
+            self.start_process()
+        shms = []
+        try:
+            data_in = encode_data(ip_params.data_in, shms)
+            data_out = encode_data(ip_params.data_out, shms)
+            options = process_safe_options(ip_params.options)
+            try:
+                self.conn.send(
+                    (ip_params.task_name, data_in, data_out, options))
+                result, info, results, telemetry = self.conn.recv()
+            except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+                # Give it a moment to exit so the exit code can be reported
+                self.process.join(timeout=1.0)
+                raise WorkerProcessDied(
+                    f"{self.name}: worker process died running "
+                    f"{ip_params.task_name} "
+                    f"(exit code {self.process.exitcode})") from e
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        ip_params.telemetry.update(telemetry)
+        if result != "ok":
+            raise info
+        decode_data_results(ip_params.data_out, results)
+        return info
+
+    def stop(self):
+        super().stop()
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def join(self, timeout=None):
+        super().join(timeout=timeout)
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
 """
 Command passed to image processing thread
 """
@@ -139,11 +435,26 @@ class CSIPParams:
                  data_out={},
                  options={},
                  callback=None,
-                 tb=None):
+                 tb=None,
+                 priority=TASK_PRIORITY_BATCH,
+                 deps=[]):
         self.task_name = task_name
         self.data_in = data_in
         self.data_out = data_out
         self.options = options
+        # Higher runs first. See TASK_PRIORITY_*
+        self.priority = priority
+        """
+        CSIPParams that must complete before this one starts
+        If any of them fails this task fails without running
+        """
+        self.deps = deps
+        # Set to "ok", "exception", etc once complete
+        self.result = None
+        # Set by queue_task()
+        self.queued_time = None
+        # Resource usage, set once complete. See uscope.imagep.telemetry
+        self.telemetry = {}
         """
         User supplied callback on task completion
         on success
@@ -169,23 +480,41 @@ Can accept:
 -Small jobs like a single stack
 
 Currently only one high level task can be run at a time
-ie it can't process two completed scans at the same time or do an image stack while a scan is running 
+ie it can't process two completed scans at the same time
+or do an image stack while a scan is running
 Probably would need to make this a thread to handle that
+
+worker_mode
+"thread" (default): workers are threads sharing this process
+"process": each worker runs plugins in a child process
+    Scales better for numpy heavy plugins at the cost of some memory
+
+worker_limit
+None (default): all workers take tasks
+Otherwise a shared value (ex: multiprocessing.Value)
+that can change while running:
+    only the first worker_limit.value workers take new tasks
+    Lets several scans share the cores (see uscope.imagep.jobs.ScanScheduler)
 """
 
 
 class CSImageProcessor(threading.Thread):
-    def __init__(self, nthreads=None, log=None, microscope=None):
+    def __init__(self,
+                 nthreads=None,
+                 log=None,
+                 microscope=None,
+                 worker_mode=None,
+                 worker_limit=None):
         super().__init__()
         self.microscope = microscope
+        self.worker_limit = worker_limit
         if log is None:
 
             def log(s):
                 print(s)
 
         self.log = log
-        self.queue_in = queue.Queue()
-        # self.queue_out = queue.Queue()
+        self.scheduler = TaskScheduler()
         self.running = threading.Event()
         self.ready = threading.Event()
         self.workers = OrderedDict()
@@ -196,14 +525,34 @@ class CSImageProcessor(threading.Thread):
 
         if not nthreads:
             nthreads = multiprocessing.cpu_count()
+        if worker_mode is None:
+            worker_mode = "thread"
+        worker_ctor = {
+            "thread": CSImageProcessorThread,
+            "process": CSImageProcessorProcess,
+        }.get(worker_mode)
+        if worker_ctor is None:
+            raise ValueError(f"Unknown worker mode {worker_mode}")
+        self.worker_mode = worker_mode
+        # Dispatcher side plugin instances, only used for fingerprint()
+        self.fingerprint_plugins = {}
         for i in range(nthreads):
             name = f"w{i}"
-            self.workers[name] = CSImageProcessorThread(self, name)
+            self.workers[name] = worker_ctor(self, name, index=i)
         self.running.set()
 
     def __del__(self):
         self.shutdown()
 
+    def worker_allowed(self, worker):
+        """
+        Return True if worker may take a new task
+        """
+        if self.worker_limit is None:
+            return True
+        # Always leave one running: queued work must finish eventually
+        return worker.index < max(1, self.worker_limit.value)
+
     def shutdown(self):
         self.shutdown_request(ShutdownPhase.FINAL)
         self.shutdown_join()
@@ -211,6 +560,8 @@ class CSImageProcessor(threading.Thread):
     def shutdown_request(self, phase):
         if phase == ShutdownPhase.FINAL:
             self.running.clear()
+            # Wake up idle workers
+            self.scheduler.close()
 
             if self.workers:
                 self.log("Shutting down: requesting")
@@ -229,13 +580,26 @@ class CSImageProcessor(threading.Thread):
             self.temp_dir_object.cleanup()
             self.temp_dir = None
 
+    def plugin_fingerprint(self, plugin):
+        """
+        Return the IPPlugin.fingerprint() of given plugin
+        as it will be created by the workers
+        """
+        if plugin not in self.fingerprint_plugins:
+            self.fingerprint_plugins[plugin] = get_plugin_ctors()[plugin](
+                log=self.log, microscope=self.microscope)
+        return self.fingerprint_plugins[plugin].fingerprint()
+
     def queue_task(self, ip_params, callback=None, block=None):
         assert not block, "fixme"
         if ip_params.tb:
             # Mark task allocated
             # tb callback will be manually invoked on result
             ip_params.tb.allocate_callback()
-        self.queue_in.put(ip_params)
+        ip_params.queued_time = time.time()
+        self.scheduler.put(ip_params,
+                           priority=ip_params.priority,
+                           deps=ip_params.deps)
 
     def queue_n_to_1_plugin(self,
                             task_name=None,
@@ -248,19 +612,29 @@ class CSImageProcessor(threading.Thread):
                             options={},
                             callback=None,
                             tb=None,
+                            priority=TASK_PRIORITY_BATCH,
+                            deps=[],
+                            save_kwargs={},
                             block=None):
         """
         Use enfuse to HDR process a sequence of images of varying exposures
+        save_kwargs: how to write fn_out, see EtherealImageW
         """
         if fns_in is not None:
             data_in = {
                 "images": [EtherealImageR(fn=fn_in) for fn_in in fns_in]
             }
         if fn_out is not None:
-            data_out = {"image": EtherealImageW(want_fn=fn_out)}
+            data_out = {
+                "image": EtherealImageW(want_fn=fn_out,
+                                        save_kwargs=save_kwargs)
+            }
         if ims_in is not None:
             data_in = {
-                "images": [EtherealImageR(im=im_in) for im_in in ims_in]
+                "images": [
+                    EtherealImageR(im=im_in, temp_dir=self.temp_dir)
+                    for im_in in ims_in
+                ]
             }
         if want_im_out:
             data_out = {
@@ -271,8 +645,11 @@ class CSImageProcessor(threading.Thread):
                                data_out=data_out,
                                options=options,
                                callback=callback,
-                               tb=tb)
+                               tb=tb,
+                               priority=priority,
+                               deps=deps)
         self.queue_task(ip_params=ip_params, block=block)
+        return ip_params
 
     def queue_1_to_1_plugin(self,
                             plugin,
@@ -285,6 +662,9 @@ class CSImageProcessor(threading.Thread):
                             options={},
                             callback=None,
                             tb=None,
+                            priority=TASK_PRIORITY_BATCH,
+                            deps=[],
+                            save_kwargs={},
                             block=None):
         if plugin not in get_plugin_ctors():
             print("Valid plugins:", get_plugin_ctors().keys())
@@ -292,9 +672,14 @@ class CSImageProcessor(threading.Thread):
         if fn_in is not None:
             data_in = {"image": EtherealImageR(fn=fn_in)}
         if fn_out is not None:
-            data_out = {"image": EtherealImageW(want_fn=fn_out)}
+            data_out = {
+                "image": EtherealImageW(want_fn=fn_out,
+                                        save_kwargs=save_kwargs)
+            }
         if im_in is not None:
-            data_in = {"image": EtherealImageR(im=im_in)}
+            data_in = {
+                "image": EtherealImageR(im=im_in, temp_dir=self.temp_dir)
+            }
         if want_im_out:
             data_out = {
                 "image": EtherealImageW(want_im=True, temp_dir=self.temp_dir)
@@ -304,10 +689,46 @@ class CSImageProcessor(threading.Thread):
                                data_out=data_out,
                                options=options,
                                callback=callback,
-                               tb=tb)
+                               tb=tb,
+                               priority=priority,
+                               deps=deps)
         self.queue_task(ip_params=ip_params, block=block)
         return data_out
 
+    def queue_fused(self,
+                    fns_in,
+                    fn_out,
+                    stages,
+                    callback=None,
+                    tb=None,
+                    priority=TASK_PRIORITY_BATCH,
+                    deps=[],
+                    block=None):
+        """
+        Take all images of one tile through stages on a single worker
+        Only fn_out is written
+        See run_fused_chain()
+        """
+        for stage in stages:
+            if stage["plugin"] not in get_plugin_ctors():
+                print("Valid plugins:", get_plugin_ctors().keys())
+                assert 0, f"Bad plugin {stage['plugin']}"
+        ip_params = CSIPParams(
+            task_name=FUSED_TASK,
+            data_in={"images": [EtherealImageR(fn=fn_in) for fn_in in fns_in]},
+            data_out={"image": EtherealImageW(want_fn=fn_out)},
+            options={
+                "stages": stages,
+                "basenames": [os.path.basename(fn_in) for fn_in in fns_in],
+                "temp_dir": self.temp_dir,
+            },
+            callback=callback,
+            tb=tb,
+            priority=priority,
+            deps=deps)
+        self.queue_task(ip_params=ip_params, block=block)
+        return ip_params
+
     def queue_hdr(self, **kwargs):
         self.queue_n_to_1_plugin(task_name="hdr-luminance", **kwargs)
 
@@ -344,21 +765,29 @@ class CSImageProcessor(threading.Thread):
                 stack_iindex["dir"],
                 "c%03u_r%03u_z%02u.jpg" % (col, row, selected_stack))
             dst_fn = os.path.join(dir_out, "c%03u_r%03u.jpg" % (col, row))
-            self.log(f"cp {src_fn} {dst_fn}")
-            shutil.copyfile(src_fn, dst_fn)
+            method = materialize_image(src_fn, dst_fn)
+            self.log(f"{method} {src_fn} {dst_fn}")
 
-        # Now copy in the "real" files
+        # Now link in the "real" files
         for basename in this_iindex["images"].keys():
             src_fn = os.path.join(this_iindex["dir"], basename)
             dst_fn = os.path.join(dir_out, basename)
-            self.log(f"cp {src_fn} {dst_fn}")
-            shutil.copyfile(src_fn, dst_fn)
+            method = materialize_image(src_fn, dst_fn)
+            self.log(f"{method} {src_fn} {dst_fn}")
 
-    def tif2jpg_dir(self, iindex_in, dir_out, lazy=True):
+    def tif2jpg_dir(self, iindex_in, dir_out, lazy=True, quality=None):
+        """
+        Convert a .tif scan to .jpg in parallel on the worker pool
+        quality: JPEG quality. Default: imager save_quality
+        """
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
 
         self.log(f"Converting tif => jpg {iindex_in['dir']} => {dir_out}")
+        options = {}
+        if quality is not None:
+            options["quality"] = quality
+        tb = TaskBarrier()
         for fn_base in iindex_in["images"].keys():
             assert ".tif" in fn_base
             fn_in = os.path.join(iindex_in["dir"], fn_base)
@@ -368,12 +797,12 @@ class CSImageProcessor(threading.Thread):
             if lazy and os.path.exists(fn_out):
                 self.log(f"lazy: skip {fn_out}")
             else:
-                args = [
-                    "convert", "-quality",
-                    str(config.get_usc().imager.save_quality()), fn_in, fn_out
-                ]
-                self.log(" ".join(args))
-                subprocess.check_call(args)
+                self.queue_1_to_1_plugin(plugin="convert-jpg",
+                                         fn_in=fn_in,
+                                         fn_out=fn_out,
+                                         options=options,
+                                         tb=tb)
+        tb.wait()
 
     def inspect_final_dir(self, working_iindex):
         healthy = True
@@ -387,10 +816,9 @@ class CSImageProcessor(threading.Thread):
             healthy = False
         return healthy
 
-    '''
     def process_stream(self, *args, **kwargs):
-        StreamCSIP(self, *args, microscope=self.microscope, **kwargs).run()
-    '''
+        return StreamCSIP(self, *args, microscope=self.microscope,
+                          **kwargs).run()
 
     def process_snapshot(self, *args, **kwargs):
         options = kwargs.pop("options", {})
@@ -405,20 +833,12 @@ class CSImageProcessor(threading.Thread):
         if not self.running.is_set():
             return
 
+        # Workers pull directly from the scheduler
         for worker in self.workers.values():
             worker.start()
 
         self.ready.set()
 
-        while self.running.is_set():
-            for worker in self.workers.values():
-                if worker.simple_idle.is_set():
-                    try:
-                        ip_params = self.queue_in.get(True, 0.1)
-                    except queue.Empty:
-                        break
-                    worker.queue_command(ip_params)
-
 
 def microscope_name_from_scan_dir(directory, mconfig):
     """
@@ -445,8 +865,10 @@ def microscope_name_from_scan_dir(directory, mconfig):
 def process_dir(directory,
                 *args,
                 nthreads=None,
+                worker_mode=None,
                 microscope=None,
                 microscope_name=None,
+                worker_limit=None,
                 **kwargs):
     if microscope is None:
         mconfig = {}
@@ -459,7 +881,10 @@ def process_dir(directory,
 
     ip = None
     try:
-        ip = CSImageProcessor(nthreads=nthreads, microscope=microscope)
+        ip = CSImageProcessor(nthreads=nthreads,
+                              worker_mode=worker_mode,
+                              microscope=microscope,
+                              worker_limit=worker_limit)
         ip.start()
         ip.ready.wait(1.0)
         ip.process_dir(directory, *args, **kwargs)
@@ -1,4 +1,12 @@
 from uscope.imager.imager_util import format_mm_3dec
+from uscope.imagep.align import align_images, image_gray
+from uscope.imagep.ff import get_ff_calibration, ff_correct, ff_cache_key
+from uscope.imagep.codec import image_exif, is_npy, load_exif_sidecar
+from uscope.imagep.deconv import (CHANNELS, DECONV_METHODS, PSFTransform,
+                                  deconvolve, load_psf, psf_cache_key)
+from uscope.imagep.qr import (find_qr_code_match_fn, find_qr_code_match,
+                              QR_SCALES)
+from uscope.imagep.telemetry import count_subprocess
 
 import subprocess
 import shutil
@@ -22,6 +30,10 @@ class IPPlugin:
     Thread safe: no
     If you want to do multiple in parallel create multiple instances
     """
+    # Given a single image (ex: a stack of one) output is the same image
+    # DirCSIP then links the input instead of running the plugin
+    single_input_identity = False
+
     def __init__(self,
                  log=None,
                  need_tmp_dir=False,
@@ -77,11 +89,19 @@ class IPPlugin:
             simple plugin: a single key called "images" containing a list of EtherealImageR
         data_out: dictionary of output products
             simple plugin: a single key called "image" containing a an EtherealImageW
+            Prefer handing results over with EtherealImageW.set_im()
+            and reading with EtherealImageR.to_im()
+            so that chained plugins can skip the filesystem
+        Returns whatever _run() returns: None or a dict of per task results
+            align_quality: see uscope.imagep.align
         """
         if self.tmp_dir:
             self.clear_tmp_dir()
         try:
-            self._run(data_in, data_out, options=options)
+            ret = self._run(data_in, data_out, options=options)
+            for image_out in data_out.values():
+                image_out.commit()
+            return ret
         finally:
             if self.tmp_dir:
                 self.clear_tmp_dir()
@@ -89,8 +109,17 @@ class IPPlugin:
     def _run(self, data_in, data_out, options={}):
         assert 0, "required"
 
+    def fingerprint(self):
+        """
+        JSON serializable summary of settings / calibration that affect output
+        Used to invalidate cached results (see uscope.imagep.cache)
+        """
+        return {}
+
 
 class HDREnfusePlugin(IPPlugin):
+    single_input_identity = True
+
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
@@ -115,6 +144,7 @@ class HDREnfusePlugin(IPPlugin):
             args.append(fn)
         self.log(" ".join(args))
         try:
+            count_subprocess()
             subprocess.check_call(args)
         except subprocess.CalledProcessError:
             if not best_effort:
@@ -156,10 +186,11 @@ class HDRLuminancePlugin(IPPlugin):
             "-o",
             out_fn,
         ]
-        fns_in = [image_in.get_filename() for image_in in data_in["images"]]
-        for fn in sorted(fns_in):
-            args.append(fn)
+        # Already in bucket order. Don't sort: in memory images get temp names
+        for image_in in data_in["images"]:
+            args.append(image_in.get_filename())
         self.log(" ".join(args))
+        count_subprocess()
         p = subprocess.Popen(args,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
@@ -176,6 +207,123 @@ class HDRLuminancePlugin(IPPlugin):
                 f"luminance-hdr-cli failed w/ code {p.returncode}")
 
 
+def get_stack_align(usc, plugin_name, class_name):
+    """
+    Return (align_xy, align_zoom) for a focus stacking plugin
+    Set by the microscope ipp plugin config
+    and overridden by PYUSCOPE_ENFUSE_ALIGN_XY / PYUSCOPE_ENFUSE_ALIGN_ZOOM
+    """
+    # X1 has "perfect" axes
+    # Other systems have a lot of jitter
+    align_xy = usc.ipp.get_plugin(plugin_name).get("align_xy", False)
+    env_align_xy = os.getenv("PYUSCOPE_ENFUSE_ALIGN_XY")
+    if env_align_xy:
+        align_xy = env_align_xy == "Y"
+        print("%s: align_xy via environment: %s" % (class_name, align_xy))
+    align_zoom = usc.ipp.get_plugin(plugin_name).get("align_zoom", False)
+    env_align_zoom = os.getenv("PYUSCOPE_ENFUSE_ALIGN_ZOOM")
+    if env_align_zoom:
+        align_zoom = env_align_zoom == "Y"
+        print("%s: align_zoom via environment: %s" % (class_name, align_zoom))
+    return align_xy, align_zoom
+
+
+def hdr_merge_cv(images, method="mertens", exposure_times=None):
+    """
+    Merge a list of 8 bit numpy images of different exposures
+    Return an 8 bit numpy image
+    method
+        mertens: exposure fusion. Exposure times are not needed
+        debevec / robertson: estimate radiance, then tone map back to 8 bit
+            Requires exposure_times (seconds, one per image)
+    https://docs.opencv.org/3.4/d2/df0/tutorial_py_hdr.html
+    """
+    if method == "mertens":
+        merge_mertens = cv2.createMergeMertens()
+        result = merge_mertens.process(images)
+    elif method in ("debevec", "robertson"):
+        assert exposure_times, f"HDR {method} requires exposure times"
+        exposure_times = np.array(exposure_times, dtype=np.float32)
+        if method == "debevec":
+            merge = cv2.createMergeDebevec()
+        else:
+            merge = cv2.createMergeRobertson()
+        hdr = merge.process(images, times=exposure_times.copy())
+        tonemap = cv2.createTonemap(gamma=2.2)
+        result = tonemap.process(hdr.copy())
+    else:
+        raise ValueError(f"Unknown HDR method {method}")
+    # Tone mapping yields NaN where the radiance estimate is 0
+    result = np.nan_to_num(result)
+    return np.clip(result * 255, 0, 255).astype(np.uint8)
+
+
+def get_exif_exposure_time(im):
+    """
+    Return exposure time in seconds from EXIF 33434 or None if not set
+    """
+    exif_ifd = im.getexif().get_ifd(0x8769)
+    exposure = exif_ifd.get(33434)
+    if exposure is None:
+        return None
+    return float(exposure)
+
+
+class HDRMergeCVPlugin(IPPlugin):
+    """
+    In process HDR using OpenCV
+    No CLI tools or temporary files needed
+    See hdr_merge_cv() for methods
+
+    method is taken from (in priority order):
+    -options["method"]
+    -microscope ipp config: plugins => hdr-opencv => method
+    -mertens
+    Exposure times (debevec / robertson) are taken from options["exposure_times"]
+    or the EXIF exposure time of each image as written by the imager
+    """
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options)
+        plugin_config = self.usc.ipp.get_plugin("hdr-opencv")
+        self.method = plugin_config.get("method", "mertens")
+        # Register brackets against the first exposure before merging
+        self.align_xy = plugin_config.get("align_xy", False)
+
+    def fingerprint(self):
+        return {"method": self.method, "align_xy": self.align_xy}
+
+    def _run(self, data_in, data_out, options={}):
+        ret = {}
+        method = options.get("method", self.method)
+        images = []
+        exposure_times = options.get("exposure_times")
+        exif_exposure_times = []
+        exif = None
+        for image_in in data_in["images"]:
+            im = image_in.to_im()
+            if exif is None:
+                exif = im.info.get("exif")
+            exif_exposure_times.append(get_exif_exposure_time(im))
+            images.append(np.array(im.convert("RGB")))
+        if exposure_times is None and None not in exif_exposure_times:
+            exposure_times = exif_exposure_times
+        if self.align_xy and len(images) > 1:
+            images, info = align_images(images)
+            ret["align_quality"] = info["quality"]
+
+        # Channel order doesn't matter to any of the methods => skip BGR
+        result = hdr_merge_cv(images,
+                              method=method,
+                              exposure_times=exposure_times)
+        kwargs = {"quality": 90}
+        if exif is not None:
+            kwargs["exif"] = exif
+        data_out["image"].set_im(Image.fromarray(result), **kwargs)
+        return ret
+
+
 """
 Stack using enfuse
 Currently skips align
@@ -183,36 +331,51 @@ Currently skips align
 
 
 class StackEnfusePlugin(IPPlugin):
+    single_input_identity = True
+
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
                          default_options=default_options,
                          need_tmp_dir=True)
-        # X1 has "perfect" axes
-        # Other systems have a lot of jitter
-        self.align_xy = self.usc.ipp.get_plugin("stack-enfuse").get(
-            "align_xy", False)
-        env_align_xy = os.getenv("PYUSCOPE_ENFUSE_ALIGN_XY")
-        if env_align_xy:
-            self.align_xy = env_align_xy == "Y"
-            print("StackEnfusePlugin: align_xy via environment: %s" % (self.align_xy))
-        self.align_zoom = self.usc.ipp.get_plugin("stack-enfuse").get(
-            "align_zoom", False)
-        env_align_zoom = os.getenv("PYUSCOPE_ENFUSE_ALIGN_ZOOM")
-        if env_align_zoom:
-            self.align_zoom = env_align_zoom == "Y"
-            print("StackEnfusePlugin: align_zoom via environment: %s" % (self.align_zoom))
+        self.align_xy, self.align_zoom = get_stack_align(
+            self.usc, "stack-enfuse", "StackEnfusePlugin")
         self.enfuse = config.get_bc().enfuse_cli()
         self.align_image_stack = config.get_bc().align_image_stack_cli()
+        # align_image_stack: external tool (default)
+        # native: uscope.imagep.align. Also used if align_image_stack is missing
+        self.align_method = self.usc.ipp.get_plugin("stack-enfuse").get(
+            "align_method", "align_image_stack")
+        if not self.align_image_stack:
+            self.align_method = "native"
+
+    def fingerprint(self):
+        return {
+            "align_xy": self.align_xy,
+            "align_zoom": self.align_zoom,
+            "align_method": self.align_method,
+        }
+
+    def align_native(self, data_in, prefix):
+        """
+        Align in process and write the images where enfuse expects them
+        """
+        aligned, info = align_images(
+            [np.array(image_in.to_im()) for image_in in data_in["images"]],
+            affine=self.align_zoom)
+        for imi, image in enumerate(aligned):
+            Image.fromarray(image).save(
+                os.path.join(self.get_tmp_dir(), prefix + "%04u.tif" % imi))
+        return info["quality"]
 
     def _run(self, data_in, data_out, options={}):
         assert self.enfuse, "Requires enfuse"
-        if self.align_xy or self.align_zoom:
-            assert self.align_image_stack, "Requires align_image_stack"
         best_effort = options.get("best_effort", False)
+        ret = {}
 
         def check_call(args):
             try:
+                count_subprocess()
                 subprocess.check_call(args)
             except subprocess.CalledProcessError:
                 if not best_effort:
@@ -226,11 +389,13 @@ class StackEnfusePlugin(IPPlugin):
         # from the middle of the stack
         """
         align_image_stack -m -a OUT $(ls)
-        -m  Optimize field of view for all images, except for first. Useful for aligning focus stacks with slightly different magnification.
+        -m  Optimize field of view for all images, except for first.
+            Useful for aligning focus stacks with slightly different magnification.
             might not apply but keep for now
        -a prefix
     
-        enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --output=baseOpt1.tif OUT*.tif
+        enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1
+            --hard-mask --output=baseOpt1.tif OUT*.tif
         """
         """
         tmp_dir = "/tmp/cs_auto"
@@ -240,7 +405,9 @@ class StackEnfusePlugin(IPPlugin):
         """
 
         prefix = "aligned_"
-        if self.align_xy or self.align_zoom:
+        if (self.align_xy or self.align_zoom) and self.align_method == "native":
+            ret["align_quality"] = self.align_native(data_in, prefix)
+        elif self.align_xy or self.align_zoom:
             # Always output as .tif
             args = list(self.align_image_stack) + [
                 # is there a reason to use -i vs -x -y?
@@ -255,9 +422,9 @@ class StackEnfusePlugin(IPPlugin):
                 "-v", "--use-given-order", "-a",
                 os.path.join(self.get_tmp_dir(), prefix)
             ]
-            for image_fn in sorted(
-                [imr.get_filename() for imr in data_in["images"]]):
-                args.append(image_fn)
+            # Already in bucket order. Don't sort: in memory images get temp names
+            for imr in data_in["images"]:
+                args.append(imr.get_filename())
             # self.log(" ".join(args))
             check_call(args)
         else:
@@ -287,36 +454,251 @@ class StackEnfusePlugin(IPPlugin):
             for fn in glob.glob(os.path.join(self.get_tmp_dir(),
                                              prefix + "*")):
                 os.unlink(fn)
+        return ret
 
 
-class StabilizationPlugin(IPPlugin):
+"""
+Stack in process using numpy / OpenCV
+Roughly what StackEnfusePlugin asks enfuse for:
+--exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask
+ie each pixel comes from the image with the most local contrast
+blended over a Laplacian pyramid to hide the seams
+Saves a process spawn, a .tif conversion and a disk round trip per image
+"""
+
+
+class StackNativePlugin(IPPlugin):
+    single_input_identity = True
+
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
-                         default_options=default_options,
-                         need_tmp_dir=True)
+                         default_options=default_options)
+        self.align_xy, self.align_zoom = get_stack_align(
+            self.usc, "stack-native", "StackNativePlugin")
+        plugin_config = self.usc.ipp.get_plugin("stack-native")
+        # Blur applied to the contrast measure (enfuse --contrast-window-size)
+        # Must be odd
+        self.contrast_window = int(plugin_config.get("contrast_window", 5))
+        # Alignment is estimated on an image scaled down to about this width
+        self.align_width = int(plugin_config.get("align_width", 1024))
+
+    def fingerprint(self):
+        return {
+            "align_xy": self.align_xy,
+            "align_zoom": self.align_zoom,
+            "contrast_window": self.contrast_window,
+            "align_width": self.align_width,
+        }
+
+    def fuse(self, images):
+        height, width = images[0].shape[0:2]
+        # Stop around 16 pixels
+        levels = max(1, min(8, int(math.log2(min(height, width))) - 4))
+
+        # Hard mask: index of the sharpest image for each pixel
+        best_contrast = None
+        best_index = None
+        for imagei, image in enumerate(images):
+            contrast = np.abs(
+                cv2.Laplacian(image_gray(image), cv2.CV_32F, ksize=3))
+            contrast = cv2.GaussianBlur(
+                contrast, (self.contrast_window, self.contrast_window), 0)
+            if best_contrast is None:
+                best_contrast = contrast
+                best_index = np.zeros(contrast.shape, dtype=np.uint8)
+            else:
+                better = contrast > best_contrast
+                best_contrast[better] = contrast[better]
+                best_index[better] = imagei
+
+        # Blend per pyramid level, one image at a time to bound memory
+        blended = None
+        for imagei, image in enumerate(images):
+            mask = (best_index == imagei).astype(np.float32)
+            image_pyramid = laplacian_pyramid(image.astype(np.float32),
+                                              levels)
+            mask_pyramid = gaussian_pyramid(mask, levels)
+            if blended is None:
+                blended = [np.zeros_like(level) for level in image_pyramid]
+            for level, (image_level, mask_level) in enumerate(
+                    zip(image_pyramid, mask_pyramid)):
+                if image_level.ndim == 3:
+                    mask_level = mask_level[..., None]
+                blended[level] += image_level * mask_level
+        return collapse_laplacian_pyramid(blended)
 
     def _run(self, data_in, data_out, options={}):
-        # https://stackoverflow.com/questions/34865765/finding-the-median-of-a-set-of-pictures-using-pil-and-numpy-gives-a-black-and-wh
-
-        images_np = []
+        ret = {}
+        images = []
         exif = None
         for image_in in data_in["images"]:
-            fn = image_in.get_filename()
-            im = Image.open(fn)
-            image_matrix = np.array(im)
-            images_np.append(image_matrix)
+            im = image_in.to_im()
+            images.append(np.array(im))
             if exif is None:
-                exif = im.info.get('exif')
+                exif = im.info.get("exif")
+        dtype = images[0].dtype
+        if len(images) == 1:
+            result = images[0]
+        else:
+            # align_xy: translation only
+            # align_zoom: affine to also absorb magnification change through focus
+            if self.align_xy or self.align_zoom:
+                images, info = align_images(images,
+                                            affine=self.align_zoom,
+                                            max_width=self.align_width)
+                ret["align_quality"] = info["quality"]
+            result = self.fuse(images)
+            result = np.clip(np.round(result), 0,
+                             np.iinfo(dtype).max).astype(dtype)
+        kwargs = {"quality": 90}
+        if exif is not None:
+            kwargs["exif"] = exif
+        data_out["image"].set_im(Image.fromarray(result), **kwargs)
+        return ret
+
+
+def gaussian_pyramid(image, levels):
+    ret = [image]
+    for _level in range(levels):
+        ret.append(cv2.pyrDown(ret[-1]))
+    return ret
+
+
+def laplacian_pyramid(image, levels):
+    gaussian = gaussian_pyramid(image, levels)
+    ret = []
+    for level in range(levels):
+        height, width = gaussian[level].shape[0:2]
+        ret.append(gaussian[level] -
+                   cv2.pyrUp(gaussian[level + 1], dstsize=(width, height)))
+    # Residual low pass image
+    ret.append(gaussian[levels])
+    return ret
+
+
+def collapse_laplacian_pyramid(pyramid):
+    ret = pyramid[-1]
+    for level in reversed(pyramid[:-1]):
+        height, width = level.shape[0:2]
+        ret = cv2.pyrUp(ret, dstsize=(width, height)) + level
+    return ret
+
+
+# Above this many images a sort is cheaper than a min / max network
+MEDIAN_NETWORK_MAX = 16
+
+
+def median_sorted(band):
+    """
+    band: list of same shaped arrays, clobbered
+    Sorts them per element with an odd-even transposition network
+    """
+    n = len(band)
+    tmp = np.empty_like(band[0])
+    for npass in range(n):
+        for i in range(npass % 2, n - 1, 2):
+            np.minimum(band[i], band[i + 1], out=tmp)
+            np.maximum(band[i], band[i + 1], out=band[i + 1])
+            band[i], tmp = tmp, band[i]
+    return band
 
-        image_stack = np.concatenate([im[..., None] for im in images_np],
-                                     axis=3)
-        median_array = np.median(image_stack, axis=3)
-        median_array = median_array.astype(np.uint8)
+
+def median_stack(images, strip_bytes=32 * 1024 * 1024):
+    """
+    Per pixel median of same shaped integer images
+    Same result as np.median(stack).astype(dtype)
+    but the workspace is one row band of about strip_bytes at a time
+    instead of a float64 copy of the whole stack
+    """
+    n = len(images)
+    height = images[0].shape[0]
+    row_bytes = n * images[0][0:1].nbytes
+    strip_rows = max(1, strip_bytes // row_bytes)
+    ret = np.empty_like(images[0])
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        if n <= MEDIAN_NETWORK_MAX:
+            band = median_sorted([image[y0:y1].copy() for image in images])
+        else:
+            band = np.stack([image[y0:y1] for image in images])
+            band.partition((n // 2 - 1, n // 2), axis=0)
+        if n % 2:
+            ret[y0:y1] = band[n // 2]
+        else:
+            # Truncate like astype() on the float median
+            ret[y0:y1] = (band[n // 2 - 1].astype(np.uint32) +
+                          band[n // 2]) // 2
+    return ret
+
+
+def load_stack(images_in, tmp_dir, max_bytes):
+    """
+    Return (list of numpy frames for median_stack(), EXIF of the first image)
+    images_in: EtherealImageR
+    Frames are decoded one at a time
+    If the decoded stack would be larger than max_bytes
+    they're moved into memory mapped files in tmp_dir as they're decoded
+    such that only one decoded frame and the median workspace must stay resident
+    .npy files are memory mapped where they are, no decode
+    In memory inputs (EtherealImageR.im) are of course resident regardless
+    """
+    frames = []
+    exif = None
+    # Decided on the first decoded frame
+    spill = None
+    for i, image_in in enumerate(images_in):
+        if image_in.im is None and is_npy(image_in.fn):
+            frame = np.load(image_in.fn, mmap_mode="r")
+            if i == 0:
+                exif = load_exif_sidecar(image_in.fn)
+            frames.append(frame)
+            continue
+        im = image_in.to_im()
+        if i == 0:
+            exif = im.info.get("exif")
+        frame = np.asarray(im)
+        del im
+        if spill is None:
+            spill = len(images_in) * frame.nbytes > max_bytes
+        if spill:
+            fn = os.path.join(tmp_dir, "stack_%04u.npy" % i)
+            mm = np.lib.format.open_memmap(fn,
+                                           mode="w+",
+                                           dtype=frame.dtype,
+                                           shape=frame.shape)
+            mm[...] = frame
+            frame = mm
+        frames.append(frame)
+    return frames, exif
+
+
+class StabilizationPlugin(IPPlugin):
+    single_input_identity = True
+
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options,
+                         need_tmp_dir=True)
+        plugin_config = self.usc.ipp.get_plugin("stabilization")
+        # Median workspace budget per task
+        self.strip_bytes = int(
+            float(plugin_config.get("strip_mb", 32)) * 1024 * 1024)
+        # Larger decoded stacks are memory mapped from the temp dir
+        self.stack_bytes = int(
+            float(plugin_config.get("stack_mb", 1024)) * 1024 * 1024)
+
+    def _run(self, data_in, data_out, options={}):
+        images_np, exif = load_stack(data_in["images"], self.get_tmp_dir(),
+                                     self.stack_bytes)
+        median_array = median_stack(images_np, strip_bytes=self.strip_bytes)
+        del images_np
         median_image = Image.fromarray(median_array)
-        median_image.save(data_out["image"].get_filename(),
-                          quality=90,
-                          exif=exif)
+        kwargs = {"quality": 90}
+        if exif is not None:
+            kwargs["exif"] = exif
+        data_out["image"].set_im(median_image, **kwargs)
 
 
 """
@@ -325,131 +707,63 @@ Correct uneven illumination using a flat field mask
 
 
 class CorrectFF1Plugin(IPPlugin):
+    """
+    Flat field correction (+ dark frame if calibrated)
+    See uscope.imagep.ff
+
+    bits (options or microscope ipp config): 8 (default) or 16
+        16 bit output must go to a .tif / .png / .npy file (see codec.save_array16())
+    """
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
-                         default_options=default_options,
-                         need_tmp_dir=True)
+                         default_options=default_options)
         # Plugin is always registered
         # Maybe should have a mechanism to exclude if it can't actually run?
-        self.ff_im = None
+        self.cal = None
+        self.cal_key = None
+        self.bits = int(
+            self.usc.ipp.get_plugin("correct-ff1").get("bits", 8))
 
         if self.usc.imager.has_ff_cal():
-            self.ff_im = Image.open(self.usc.imager.ff_cal_fn())
-            self.ff_rband_im, self.ff_gband_im, self.ff_bband_im = self.ff_im.split(
-            )
-            self.ff_rband_np = np.array(self.ff_rband_im)
-            self.ff_gband_np = np.array(self.ff_gband_im)
-            self.ff_bband_np = np.array(self.ff_bband_im)
-            self.ff_minmax()
-
-            # Boost dim values by scalars in the range 1.0 to near 0.0
-            # The lower the flat field value, the more it needs to be scaled
-            # Values at max flat field value stay the same
-            # Note: dead pixels always 0 not currently handled / will crash
-            self.rband_scalar = self.ff_rmax / self.ff_rband_np
-            self.gband_scalar = self.ff_gmax / self.ff_gband_np
-            self.bband_scalar = self.ff_bmax / self.ff_bband_np
-
-            # It's easy to have an outlier that boosts everything
-            self.verbose and print(f"ffi r: {self.ffi_rmin} : {self.ffi_rmax}")
-            self.verbose and print(f"ffi g: {self.ffi_gmin} : {self.ffi_gmax}")
-            self.verbose and print(f"ffi b: {self.ffi_bmin} : {self.ffi_bmax}")
-
-    def npf2im(self, statef):
-        #return statef, None
-        rounded = np.round(statef)
-        #print("row1: %s" % rounded[1])
-        statei = np.array(rounded, dtype=np.uint16)
-        #print(len(statei), len(statei[0]), len(statei[0]))
-        height = len(statef)
-        width = len(statef[0])
-
-        # for some reason I isn't working correctly
-        # only L
-        # workaround by plotting manually
-        im = Image.new("RGB", (width, height), "Black")
-        for y, row in enumerate(statei):
-            for x, val in enumerate(row):
-                # this causes really weird issues if not done
-                val = tuple(int(x) for x in val)
-                im.putpixel((x, y), val)
-
-        return im
-
-    def ff_minmax(self):
-        def bounds_close_band(band):
-            hist = band.histogram()
-            width, height = band.size
-            npixels = width * height
-            thresh = 0.01
-
-            low = None
-            high = None
-            pixels = 0
-            for i, vals in enumerate(hist):
-                pixels += vals
-                if low is None and pixels / npixels >= thresh:
-                    low = i
-                if high is None and pixels / npixels >= (1.0 - thresh):
-                    high = i
-                    break
-            return low, high
-
-        (self.ff_rmin, self.ff_rmax) = bounds_close_band(self.ff_rband_im)
-        (self.ff_gmin, self.ff_gmax) = bounds_close_band(self.ff_gband_im)
-        (self.ff_bmin, self.ff_bmax) = bounds_close_band(self.ff_bband_im)
+            dark_fn = None
+            if self.usc.imager.has_dark_cal():
+                dark_fn = self.usc.imager.dark_cal_fn()
+            # Shared, read only
+            self.cal = get_ff_calibration(self.usc.imager.ff_cal_fn(),
+                                          dark_fn=dark_fn)
+            self.cal_key = ff_cache_key(self.usc.imager.ff_cal_fn(),
+                                        dark_fn=dark_fn)
+
+    def fingerprint(self):
+        return {"cal": self.cal_key, "bits": self.bits}
 
     def _run(self, data_in, data_out, options={}):
         # Calibration must be loaded
-        assert self.ff_im
+        assert self.cal
 
         print(f"FF1: run")
 
-        self.verbose and print("")
-
-        image_in = data_in["image"]
-        # im_in = "cal/cal06_ff_1.5x/2023-06-20_01-22-25_blue_20x_cal6_1.5x_pic/c000_r001.jpg"
-        im = image_in.to_mutable_im()
-        if im.size != self.ff_im.size:
+        bits = int(options.get("bits", self.bits))
+        im = data_in["image"].to_im()
+        if im.size != self.cal.size:
             raise Exception(
                 "Calibration image size %uw x %uh but got image %uw x %uh" %
-                (self.ff_im.width, self.ff_im.height, im.width, im.height))
-
-        rband_im, gband_im, bband_im = im.split()
-        # fixme = Image.merge("RGB", (rband_im, gband_im, bband_im))
-        rband_np = np.array(rband_im)
-        gband_np = np.array(gband_im)
-        bband_np = np.array(bband_im)
-
-        # Rescale based on flat field
-        rband_np = np.multiply(rband_np, self.rband_scalar)
-        gband_np = np.multiply(gband_np, self.gband_scalar)
-        bband_np = np.multiply(bband_np, self.bband_scalar)
-
-        # floats aren't ideal for images
-        rband_np = np.round(rband_np)
-        gband_np = np.round(gband_np)
-        bband_np = np.round(bband_np)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = np.minimum(rband_np, 255)
-        gband_np = np.minimum(gband_np, 255)
-        bband_np = np.minimum(bband_np, 255)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = rband_np.astype(np.uint8)
-        gband_np = gband_np.astype(np.uint8)
-        bband_np = bband_np.astype(np.uint8)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        # Convert back into more standard PIL format
-        final_im_r = Image.fromarray(rband_np, "L")
-        final_im_g = Image.fromarray(gband_np, "L")
-        final_im_b = Image.fromarray(bband_np, "L")
-        final_im = Image.merge("RGB", (final_im_r, final_im_g, final_im_b))
-
-        final_im.save(data_out["image"].get_filename(), quality=90)
+                (self.cal.size[0], self.cal.size[1], im.width, im.height))
+
+        kwargs = {"quality": 90}
+        exif = image_exif(im)
+        if exif is not None:
+            kwargs["exif"] = exif
+        corrected = ff_correct(np.asarray(im.convert("RGB")),
+                               self.cal,
+                               bits=bits)
+        if bits == 16:
+            # PIL can't do 16 bit RGB. Written straight from numpy
+            data_out["image"].set_im(corrected, **kwargs)
+        else:
+            data_out["image"].set_im(Image.fromarray(corrected, "RGB"),
+                                     **kwargs)
 
 
 """
@@ -485,8 +799,8 @@ class CorrectSharp1Plugin(IPPlugin):
         pil_im = data_in["image"].to_im()
         cv_im = np.array(pil_im.convert('RGB'))[:, :, ::-1].copy()
         result = cv2.filter2D(cv_im, -1, self.kernel)
-        cv2.imwrite(data_out["image"].get_filename(), result,
-                    [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        data_out["image"].set_im(Image.fromarray(result[:, :, ::-1]),
+                                 quality=90)
 
 
 """
@@ -581,8 +895,107 @@ class CorrectVM1V1Plugin(IPPlugin):
                                corrected_b[0][0].dtype)
 
         merged = cv2.merge([corrected_b, g, r])
-        cv2.imwrite(data_out["image"].get_filename(), merged,
-                    [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        data_out["image"].set_im(Image.fromarray(merged[:, :, ::-1]),
+                                 quality=90)
+
+
+class CorrectDeconvPlugin(IPPlugin):
+    """
+    Per channel PSF deconvolution by FFT
+    Like correct-vm1v1 but with measured / configured PSFs for any channel
+    See uscope.imagep.deconv for config
+
+    method, balance, iterations (options or microscope ipp config)
+    """
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options)
+        plugin_config = self.usc.ipp.get_plugin("correct-deconv")
+        # Every plugin is built in every worker
+        # A bad config must only fail scans that use this one
+        self.config_error = None
+        self.method = "wiener"
+        self.balance = 0.01
+        self.iterations = 10
+        # channel => config entry
+        self.psf_config = {}
+        # Relative PSF files
+        self.psf_dir = None
+        try:
+            self.method = plugin_config.get("method", self.method)
+            if self.method not in DECONV_METHODS:
+                raise ValueError(f"bad method {self.method}")
+            self.balance = float(plugin_config.get("balance", self.balance))
+            self.iterations = int(
+                plugin_config.get("iterations", self.iterations))
+            self.psf_config = dict(plugin_config.get("psf", {}))
+            for channel in self.psf_config:
+                if channel not in CHANNELS:
+                    raise ValueError(f"bad channel {channel}")
+            if self.psf_config:
+                self.psf_dir = self.usc.get_microscope_data_dir()
+        except (ValueError, TypeError) as e:
+            self.config_error = f"correct-deconv: {e}"
+        # Loaded on first use so that an unused plugin never touches the files
+        # channel index => PSF
+        self.psfs = None
+        # (h, w) => {channel index: PSFTransform}
+        # One plugin instance per worker: computed once, reused for every tile
+        self.transforms = {}
+
+    def check_config(self):
+        if self.config_error:
+            raise ValueError(self.config_error)
+        if not self.psf_config:
+            raise ValueError("correct-deconv: no PSF configured")
+
+    def fingerprint(self):
+        self.check_config()
+        return {
+            "method": self.method,
+            "balance": self.balance,
+            "iterations": self.iterations,
+            "psf": psf_cache_key(self.psf_config, self.psf_dir),
+        }
+
+    def get_transforms(self, shape):
+        transforms = self.transforms.get(shape)
+        if transforms is None:
+            if self.psfs is None:
+                self.psfs = {
+                    CHANNELS.index(channel): load_psf(spec, self.psf_dir)
+                    for channel, spec in self.psf_config.items()
+                }
+            # Normally all tiles are the same size
+            if len(self.transforms) >= 4:
+                self.transforms = {}
+            transforms = {
+                channeli: PSFTransform(psf, shape)
+                for channeli, psf in self.psfs.items()
+            }
+            self.transforms[shape] = transforms
+        return transforms
+
+    def _run(self, data_in, data_out, options={}):
+        self.check_config()
+
+        im = data_in["image"].to_im()
+        image = np.asarray(im.convert("RGB"))
+        corrected = deconvolve(image,
+                               self.get_transforms(image.shape[0:2]),
+                               method=options.get("method", self.method),
+                               balance=float(
+                                   options.get("balance", self.balance)),
+                               iterations=int(
+                                   options.get("iterations",
+                                               self.iterations)))
+        corrected = np.clip(np.rint(corrected), 0, 255).astype(np.uint8)
+        kwargs = {"quality": 90}
+        exif = image_exif(im)
+        if exif:
+            kwargs["exif"] = exif
+        data_out["image"].set_im(Image.fromarray(corrected, "RGB"), **kwargs)
 
 
 class AnnotateScalebarPlugin(IPPlugin):
@@ -681,19 +1094,74 @@ class AnnotateScalebarPlugin(IPPlugin):
         scale_text = draw_scale_text()
         draw_labsmore(scale_text)
 
-        modified_image.save(data_out["image"].get_filename(), quality=90)
+        data_out["image"].set_im(modified_image, quality=90)
+
+
+class ConvertJPGPlugin(IPPlugin):
+    """
+    Re-encode an image (ex: .tif scan) as JPEG, keeping its EXIF
+    Previously done by ImageMagick convert, one image at a time
+
+    quality (options): JPEG quality. Default: imager save_quality
+    """
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options)
+        self.quality = self.usc.imager.save_quality()
+
+    def fingerprint(self):
+        return {"quality": self.quality}
+
+    def _run(self, data_in, data_out, options={}):
+        im = data_in["image"].to_im()
+        exif = image_exif(im)
+        # JPEG has no alpha / 16 bit
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        kwargs = {"quality": int(options.get("quality", self.quality))}
+        if exif:
+            kwargs["exif"] = exif
+        data_out["image"].set_im(im, **kwargs)
+
+
+class QRDetectPlugin(IPPlugin):
+    """
+    Look for a QR code matching a regex. No image output
+    See uscope.imagep.qr
+
+    regex (options): required
+    scales (options): downscale factors to try, coarsest first
+    Returns {"qr": match or None, "scale": downscale it was decoded at}
+    """
+    def _run(self, data_in, data_out, options={}):
+        image_in = data_in["image"]
+        if image_in.fn:
+            match, scale = find_qr_code_match_fn(image_in.fn,
+                                                 options["regex"],
+                                                 scales=options.get(
+                                                     "scales", QR_SCALES))
+        else:
+            match = find_qr_code_match(image_in.to_im(), options["regex"])
+            scale = 1
+        return {"qr": match, "scale": scale}
 
 
 def get_plugin_ctors():
     return {
         "stack-enfuse": StackEnfusePlugin,
+        "stack-native": StackNativePlugin,
         "hdr-enfuse": HDREnfusePlugin,
         "hdr-luminance": HDRLuminancePlugin,
+        "hdr-opencv": HDRMergeCVPlugin,
         "stabilization": StabilizationPlugin,
         "correct-ff1": CorrectFF1Plugin,
         "correct-sharp1": CorrectSharp1Plugin,
         "correct-vm1v1": CorrectVM1V1Plugin,
+        "correct-deconv": CorrectDeconvPlugin,
         "annotate-scalebar": AnnotateScalebarPlugin,
+        "convert-jpg": ConvertJPGPlugin,
+        "qr-detect": QRDetectPlugin,
     }
 
 
@@ -0,0 +1,200 @@
+"""
+QR code detection for naming scans (see BaseConfig.qr_regex())
+
+Find the label quickly without missing small ones:
+-Images are read at reduced resolution
+    JPEG draft mode decodes at 1/2, 1/4, 1/8 for a fraction of the cost
+    Other formats are decoded once and scaled down
+-Search starts at the coarsest scale and goes finer until something decodes
+    Large labels decode at 1/8 or 1/4, a 1/2 scale look down to ~4 pixels per module
+-Full resolution is only decoded if the QR locator saw a code at reduced scale
+    that was too small to read (down to ~3 pixels per module)
+    Images without a label, most of a scan, never get that far
+-The first code matching qr_regex wins
+
+QRPositions remembers which tiles held the label on previous scans
+so that DirCSIP can look there first
+"""
+
+from uscope.util import writej
+from PIL import Image
+import cv2
+import json
+import numpy as np
+import os
+import re
+import threading
+
+# 2024-02-29: this package keeps being problematic
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+    print("WARNING: failed to import pyzbar, using OpenCV QR decoder")
+
+QR_POSITIONS_FN = "qr_positions.json"
+# Downscale factors tried, coarsest first
+QR_SCALES = (8, 4, 2, 1)
+
+
+def decode_full(im):
+    """
+    Return PIL image im as a full resolution grayscale numpy array
+    """
+    return np.asarray(im.convert("L"))
+
+
+def reduce_gray(image, scale):
+    """
+    Return grayscale numpy image approximately 1 / scale in size
+    """
+    if scale == 1:
+        return image
+    height, width = image.shape
+    size = (max(1, width // scale), max(1, height // scale))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def open_reduced(fn, scale):
+    """
+    Return fn as a grayscale numpy array approximately 1 / scale in size
+    """
+    im = Image.open(fn)
+    if im.format == "JPEG" and scale > 1:
+        # Decoder does the scaling (DCT): much faster than a full decode
+        size = (max(1, im.width // scale), max(1, im.height // scale))
+        im.draft("L", size)
+        im = im.convert("L")
+        if im.size != size:
+            im = im.resize(size, Image.BOX)
+        return np.asarray(im)
+    return reduce_gray(decode_full(im), scale)
+
+
+def has_qr_candidate(image):
+    """
+    Return True if the QR locator sees a code in grayscale numpy image
+    whether or not it can be read
+    Much cheaper than a decode at a higher resolution
+    """
+    try:
+        ok, _points = cv2.QRCodeDetector().detect(image)
+    except cv2.error:
+        return False
+    return bool(ok)
+
+
+def decode_qr(image):
+    """
+    image: PIL image or grayscale numpy array
+    Return decoded strings of all QR codes found in image
+    """
+    if isinstance(image, Image.Image):
+        image = np.asarray(image.convert("L"))
+    if pyzbar:
+        decoded = []
+        for symbol in pyzbar.decode(image):
+            try:
+                decoded.append(str(symbol.data, "utf-8"))
+            except UnicodeDecodeError:
+                pass
+        return decoded
+    try:
+        ok, decoded, _points, _straight = cv2.QRCodeDetector(
+        ).detectAndDecodeMulti(image)
+    except cv2.error:
+        return []
+    return [s for s in decoded if s] if ok else []
+
+
+def match_qr(decoded, expr):
+    """
+    Return the first of decoded matching expr or None
+    """
+    for data in decoded:
+        try:
+            m = re.match(expr, data)
+            if m:
+                return m.string
+        except TypeError as e:
+            # Log this error?
+            print("Invalid qr_regex", e)
+            return None
+    return None
+
+
+def find_qr_code_match(image, expr):
+    """
+    Scan image for QR code(s) and return first match
+    """
+    return match_qr(decode_qr(image), expr)
+
+
+def find_qr_code_match_fn(fn, expr, scales=QR_SCALES):
+    """
+    Multi scale search of image file fn
+    Return (match, scale) or (None, None)
+    """
+    im = Image.open(fn)
+    # Formats without draft decode: decode once, reduce from that
+    full = None
+    if im.format != "JPEG":
+        full = decode_full(im)
+    del im
+    candidate = False
+    for i, scale in enumerate(scales):
+        if scale == 1 and i and not candidate:
+            break
+        if full is None:
+            image = open_reduced(fn, scale)
+        else:
+            image = reduce_gray(full, scale)
+        decoded = decode_qr(image)
+        if decoded:
+            # A readable code that doesn't match won't match at higher resolution either
+            match = match_qr(decoded, expr)
+            if match:
+                return match, scale
+            return None, None
+        if scale > 1:
+            candidate = candidate or has_qr_candidate(image)
+    return None, None
+
+
+class QRPositions:
+    """
+    Count of labels found per tile position (col, row)
+    Kept in the microscope data dir since sample holders are reused
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        # "c,r" => hits
+        self.hits = {}
+        if fn and os.path.exists(fn):
+            try:
+                with open(fn, "r") as f:
+                    self.hits = json.load(f)["hits"]
+            except (ValueError, KeyError):
+                print(f"WARNING: corrupt {fn}, ignoring")
+
+    def order(self, iindex):
+        """
+        Return iindex image basenames, most likely label positions first
+        """
+        def key(basename):
+            v = iindex["images"][basename]
+            return -self.hits.get("%u,%u" % (v["col"], v["row"]), 0)
+
+        # Stable: otherwise scan order
+        return sorted(iindex["images"].keys(), key=key)
+
+    def record(self, col, row):
+        if not self.fn:
+            return
+        with self.lock:
+            k = "%u,%u" % (col, row)
+            self.hits[k] = self.hits.get(k, 0) + 1
+            tmp_fn = self.fn + ".tmp"
+            writej(tmp_fn, {"hits": self.hits})
+            os.replace(tmp_fn, self.fn)
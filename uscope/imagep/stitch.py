@@ -0,0 +1,286 @@
+"""
+Local preview stitch: a registered mosaic without waiting on CloudStitch
+
+QuickPano places images at their nominal (stage) positions
+so backlash, stage error and thermal drift show up as seams
+Here every pair of neighbouring images is registered instead:
+-Images are decoded at reduced size (see thumbnails.load_reduced())
+ a row at a time so memory doesn't grow with the scan
+-The nominally overlapping strips are phase correlated (align.estimate_transform())
+ giving the offset between the two images and a quality
+-Image positions are solved by weighted least squares over all offsets
+ Weak nominal offsets keep images without usable overlap (ex: blank areas) in place
+ Offsets that disagree with the solution are dropped and it's solved again
+-The mosaic is rendered by QuickPano at the solved positions
+
+Offsets are measured in the camera's pixel frame
+and turned into canvas positions with the scan's rotation (if any)
+
+Good to a pixel or two: a preview, not a replacement for a real stitch
+(no lens distortion correction, no blending)
+"""
+
+from uscope.imagep.align import estimate_transform
+from uscope.imagep.summary import QuickPano, rotation_inverse_map
+from uscope.imagep.thumbnails import load_reduced
+from uscope.scan_util import index_scan_images
+from uscope.util import writej
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import scipy.sparse
+import scipy.sparse.linalg
+
+# Longest side of the images registration works on
+STITCH_REDUCED_SIZE = 1024
+# Smaller overlaps (reduced pixels) aren't measured
+STITCH_MIN_OVERLAP = 16
+# Offsets with a worse alignment quality are ignored
+STITCH_MIN_QUALITY = 0.3
+# Weight of the nominal offset between every pair of neighbours
+# relative to a measured one (weighted by quality)
+STITCH_NOMINAL_WEIGHT = 1e-3
+# Measured offsets further than this (reduced pixels) from the solution are outliers
+STITCH_MAX_RESIDUAL = 2.0
+
+
+def measure_offset(image_a, image_b, nominal):
+    """
+    image_a / image_b: reduced grayscale numpy images
+    nominal: expected (x, y) position of b relative to a
+    Return ((x, y) measured position of b relative to a, quality)
+    or None if they don't overlap enough
+    """
+    height, width = image_a.shape
+    nx, ny = [int(round(v)) for v in nominal]
+    x0, x1 = max(0, nx), min(width, nx + width)
+    y0, y1 = max(0, ny), min(height, ny + height)
+    if x1 - x0 < STITCH_MIN_OVERLAP or y1 - y0 < STITCH_MIN_OVERLAP:
+        return None
+    ref = image_a[y0:y1, x0:x1]
+    image = image_b[y0 - ny:y1 - ny, x0 - nx:x1 - nx]
+    # Already reduced: estimate at this size
+    warp, quality = estimate_transform(ref, image, max_width=x1 - x0)
+    # Content at ref (x, y) is at image (x, y) + warp translation
+    # => b is that much closer to a than nominal
+    return (nx - warp[0, 2], ny - warp[1, 2]), quality
+
+
+def solve_positions(ntiles, offsets, nominal_offsets):
+    """
+    offsets: list of (i, j, (x, y) position of j relative to i, weight)
+    nominal_offsets: same for the nominal layout. Weighted by STITCH_NOMINAL_WEIGHT
+    Tile 0 is fixed at 0, 0
+    Return ntiles x 2 positions minimizing weighted squared offset error
+    """
+    rows = []
+    cols = []
+    vals = []
+    rhs = []
+    weights = []
+    for constraints, weight_scale in ((offsets, 1.0), (nominal_offsets,
+                                                       STITCH_NOMINAL_WEIGHT)):
+        for i, j, offset, weight in constraints:
+            row = len(rhs)
+            rows += [row, row]
+            cols += [i, j]
+            vals += [-1.0, 1.0]
+            rhs.append(offset)
+            weights.append(weight * weight_scale)
+    # Anchor
+    row = len(rhs)
+    rows.append(row)
+    cols.append(0)
+    vals.append(1.0)
+    rhs.append((0.0, 0.0))
+    weights.append(1.0)
+
+    a = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(rhs), ntiles))
+    w = scipy.sparse.diags(weights)
+    # Normal equations: same matrix for x and y
+    solve = scipy.sparse.linalg.factorized((a.T @ w @ a).tocsc())
+    b = a.T @ w @ np.array(rhs, dtype=np.float64)
+    return np.stack([solve(b[:, 0]), solve(b[:, 1])], axis=1)
+
+
+class PreviewStitch(QuickPano):
+    """
+    QuickPano at registered instead of nominal positions
+    """
+    def __init__(self,
+                 iindex,
+                 output_filename=None,
+                 reduced_size=STITCH_REDUCED_SIZE,
+                 **kwargs):
+        if output_filename is None:
+            d = os.path.join(iindex["dir"], "summary")
+            if not os.path.exists(d):
+                os.mkdir(d)
+            output_filename = os.path.join(d, "preview_stitch.jpg")
+        super().__init__(iindex, output_filename=output_filename, **kwargs)
+        self.reduced_size = reduced_size
+        # (col, row) => canvas (x, y). None: nominal positions
+        self.positions = None
+        self.report = None
+
+    def calc_dims(self):
+        ret = super().calc_dims()
+        if self.positions is None:
+            return ret
+        xs = [x for x, _y in self.positions.values()]
+        ys = [y for _x, y in self.positions.values()]
+        return max(xs) + self.im0.width, max(ys) + self.im0.height
+
+    def image_coordinate(self, col, row):
+        if self.positions is None:
+            return super().image_coordinate(col, row)
+        return self.positions[(col, row)]
+
+    def load_reduced_gray(self, col, row):
+        im = load_reduced(self.cr2info[(col, row)]["filename"],
+                          self.reduced_size)
+        return np.asarray(im.convert("L"))
+
+    def register(self):
+        """
+        Measure neighbour offsets and solve for self.positions
+        """
+        super().calc_dims()
+        cols = self.iindex["cols"]
+        rows = self.iindex["rows"]
+        # Canvas => camera frame
+        to_camera = np.eye(2)
+        rotation_ccw = self.get_rotation_ccw()
+        if rotation_ccw:
+            _w, _h, matrix = rotation_inverse_map(self.im0.width,
+                                                  self.im0.height,
+                                                  rotation_ccw)
+            to_camera = matrix[:, 0:2]
+        nominal = {}
+        for col in range(cols):
+            for row in range(rows):
+                xy = super().image_coordinate(col, row)
+                nominal[(col, row)] = to_camera @ xy
+        # load_reduced() never scales up
+        scale = min(1.0,
+                    self.reduced_size / max(self.im0.width, self.im0.height))
+
+        def tile_index(col, row):
+            return row * cols + col
+
+        def measure(pair):
+            (col_a, row_a, image_a), (col_b, row_b, image_b) = pair
+            nominal_offset = nominal[(col_b, row_b)] - nominal[(col_a, row_a)]
+            measured = measure_offset(image_a, image_b, nominal_offset * scale)
+            return (tile_index(col_a, row_a), tile_index(col_b, row_b),
+                    nominal_offset, measured)
+
+        # (i, j, offset, weight)
+        offsets = []
+        nominal_offsets = []
+        pairs = 0
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            prev = None
+            for row in range(rows):
+                self.verbose and print("  Registering row %u / %u" %
+                                       (row + 1, rows))
+                images = list(
+                    executor.map(lambda col: self.load_reduced_gray(col, row),
+                                 range(cols)))
+                this = [(col, row, images[col]) for col in range(cols)]
+                todo = list(zip(this[:-1], this[1:]))
+                if prev:
+                    todo += list(zip(prev, this))
+                for i, j, nominal_offset, measured in executor.map(
+                        measure, todo):
+                    pairs += 1
+                    nominal_offsets.append((i, j, nominal_offset, 1.0))
+                    if measured is None:
+                        continue
+                    offset, quality = measured
+                    if quality >= STITCH_MIN_QUALITY:
+                        offsets.append(
+                            (i, j, np.array(offset) / scale, quality))
+                prev = this
+
+        def solve():
+            """
+            Return (positions, residual per offset in reduced pixels)
+            """
+            positions = solve_positions(cols * rows, offsets, nominal_offsets)
+            return positions, [
+                np.abs(positions[j] - positions[i] - offset).max() * scale
+                for i, j, offset, _weight in offsets
+            ]
+
+        positions, residuals = solve()
+        outliers = [bool(r > STITCH_MAX_RESIDUAL) for r in residuals]
+        if any(outliers):
+            offsets = [
+                offset for offset, outlier in zip(offsets, outliers)
+                if not outlier
+            ]
+            positions, residuals = solve()
+
+        # Back to canvas, upper left at 0, 0
+        positions = positions @ np.linalg.inv(to_camera).T
+        positions -= positions.min(axis=0)
+        self.positions = {}
+        for col in range(cols):
+            for row in range(rows):
+                x, y = positions[tile_index(col, row)]
+                self.positions[(col, row)] = (int(round(x)), int(round(y)))
+        self.report = {
+            "pairs": pairs,
+            "registered": len(offsets),
+            "outliers": sum(outliers),
+            # Full resolution pixels
+            "max_residual": float(max(residuals, default=0.0) / scale),
+            "positions": {
+                "c%03u_r%03u" % col_row: xy
+                for col_row, xy in sorted(self.positions.items())
+            },
+        }
+        self.verbose and print("  Registered %u / %u pairs, %u outliers" %
+                               (len(offsets), pairs, sum(outliers)))
+
+    def run(self):
+        assert self.iindex[
+            "flat"], "Single image only supported on final level image set"
+        self.load_scan_json()
+        self.register()
+        self.new_dst()
+        try:
+            self.fill_dst()
+            self.save()
+        finally:
+            self.close_dst()
+        writej(
+            os.path.splitext(self.output_filename)[0] + ".json", self.report)
+        self.verbose and print('Done!')
+
+
+def write_preview_stitch(*args, **kwargs):
+    """
+    Return registration report (see PreviewStitch.register())
+    """
+    stitch = PreviewStitch(*args, **kwargs)
+    stitch.run()
+    return stitch.report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Stitch a scan locally by registering neighbours")
+    parser.add_argument("--output", help="Default: summary/preview_stitch.jpg")
+    parser.add_argument("dir_in")
+    args = parser.parse_args()
+
+    write_preview_stitch(index_scan_images(args.dir_in),
+                         output_filename=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,27 @@
 from uscope import cloud_stitch
 from uscope.scan_util import index_scan_images, bucket_group, reduce_iindex_filename, is_tif_scan
 from uscope import config
-from uscope.imagep.util import TaskBarrier, EtherealImageR, EtherealImageW, remove_intermediate_directories, find_qr_code_match, check_valid_image_dir
-from uscope.imagep.summary import write_html_viewer, write_snapshot_grid, write_quick_pano
+from uscope.imagep.util import (TaskBarrier, TASK_PRIORITY_INTERACTIVE,
+                                EtherealImageR, EtherealImageW,
+                                remove_intermediate_directories,
+                                check_valid_image_dir)
+from uscope.imagep.summary import (write_html_viewer, write_snapshot_grid,
+                                   write_quick_pano, write_dzi_pyramid,
+                                   HugeImage)
+from uscope.imagep.stitch import write_preview_stitch
+from uscope.imagep.align import ALIGN_QUALITY_WARN
+from uscope.imagep.cache import ProcessingCache
+from uscope.imagep.telemetry import ProcessingTelemetry
+from uscope.imagep.codec import intermediate_format
+from uscope.imagep.qr import QRPositions, QR_POSITIONS_FN
+from uscope.imagep.materialize import materialize_image
+from uscope.imagep.plugins import get_plugin_ctors
 from uscope.util import writej
 import glob
 import shutil
 import os
+import threading
+import traceback
 from PIL import Image
 """
 Support the following:
@@ -24,34 +39,117 @@ def get_image_suffix(dir_in):
 
 
 class ImageStream:
+    """
+    Images that show up over time, ex: from a scan in progress
+    """
     def __init__(self):
         pass
 
+    def working_dir(self):
+        assert 0, "required"
+
+    def new_images(self, timeout=None):
+        """
+        Return an iterable of EtherealImageR
+        """
+        assert 0, "required"
+
+    def done(self):
+        """
+        Return True once all images have been returned
+        """
+        assert 0, "required"
+
+    def complete(self):
+        """
+        Return True if the capture ran to completion (ie was not aborted)
+        """
+        assert 0, "required"
+
 
-# FIXME: how to integrate this?
-# might require binding to a plugin and adding a queue
 class PlannerImageStream(ImageStream):
-    def __init__(self, pconfig, directory, planner_image_queue_plugin):
+    """
+    Images written by a running Planner
+    Fed by Planner progress events which are emitted right after
+    PlannerSaveImage has written the file for that state
+
+    stream = PlannerImageStream.from_planner(planner)
+    or
+    stream = PlannerImageStream(pconfig, out_dir)
+    planner.register_progress_callback(stream.progress_callback)
+
+    Planner only signals a successful scan
+    Call finish() once planner.run() returns or raises (see run_planner_stream())
+    """
+    def __init__(self, pconfig, directory):
         self.pconfig = pconfig
         self.directory = directory
-        self.planner_image_queue_plugin = planner_image_queue_plugin
+        self.cv = threading.Condition()
+        self.fns = []
+        self.scan_done = False
+        self.scan_complete = False
+
+    @staticmethod
+    def from_planner(planner):
+        ret = PlannerImageStream(planner.pc.j, planner.out_dir)
+        planner.register_progress_callback(ret.progress_callback)
+        return ret
+
+    def progress_callback(self, state):
+        if state["type"] == "image":
+            fn = state.get("image_filename_rel")
+            # Not saved by us (ex: remote imager)
+            if fn is None:
+                return
+            with self.cv:
+                self.fns.append(fn)
+                self.cv.notify_all()
+        # Sent after uscan.json is written
+        elif state["type"] == "meta":
+            self.finish(complete=True)
+
+    def finish(self, complete=False):
+        """
+        No more images will arrive
+        Call this directly if the scan is aborted
+        """
+        with self.cv:
+            self.scan_done = True
+            self.scan_complete = self.scan_complete or complete
+            self.cv.notify_all()
 
     def working_dir(self):
         return self.directory
 
-    def new_images(self):
+    def new_images(self, timeout=None):
         """
         Return an iterable of EtherealImageR
+        Blocks up to timeout until new images arrive or the scan finishes
         """
-        fns = self.planner_image_queue_plugin.new_images()
+        with self.cv:
+            if not self.fns and not self.scan_done:
+                self.cv.wait(timeout)
+            fns = self.fns
+            self.fns = []
         return [EtherealImageR(fn=fn) for fn in fns]
 
+    def done(self):
+        with self.cv:
+            return self.scan_done and not self.fns
+
+    def complete(self):
+        with self.cv:
+            return self.scan_complete
+
     def has_stack(self):
         return "points-stacker" in self.pconfig
 
     def has_hdr(self):
         return "hdr" in self.pconfig["imager"]
 
+    def has_stabilization(self):
+        return "image-stabilization" in self.pconfig
+
     def bucket_size(self, operation):
         """
         Ex:
@@ -60,9 +158,11 @@ class PlannerImageStream(ImageStream):
         Check the scan config to see if stacks have 3 elements
         """
         if operation == "stack":
-            return self.pconfig["points-stacker"]["number"]
+            return int(self.pconfig["points-stacker"]["number"])
         elif operation == "hdr":
             return len(self.pconfig["imager"]["hdr"]["properties_list"])
+        elif operation == "stabilization":
+            return int(self.pconfig["image-stabilization"]["n"])
         else:
             assert 0, "FIXME"
 
@@ -110,12 +210,61 @@ class IPPConfigJ:
         # This takes up disk space => off by default
         return bool(self.j.get("write_quick_pano", False))
 
+    def write_pyramid(self):
+        """
+        Write a Deep Zoom tile pyramid at the final image level
+        Placed like quick pano but works at any size and loads on demand
+        The HTML viewer shows it when present
+        """
+        # Disk space => off by default
+        return bool(self.j.get("write_pyramid", False))
+
+    def write_preview_stitch(self):
+        """
+        Write a combined image file at the final image level
+        Like quick pano but neighbours are registered to each other
+        A preview while waiting on CloudStitch
+        """
+        # Disk space + CPU => off by default
+        return bool(self.j.get("write_preview_stitch", False))
+
     def keep_intermediates(self):
         # https://github.com/Labsmore/pyuscope/issues/410
         # Keep GUI default but more conservative here
         # In part due to no lock file which caused GUI / CLI contention
         return bool(self.j.get("keep_intermediates", True))
 
+    def hdr_plugin(self):
+        """
+        hdr-luminance: luminance-hdr-cli
+        hdr-enfuse: enfuse
+        hdr-opencv: in process OpenCV (Mertens by default)
+        """
+        return self.j.get("hdr_plugin", "hdr-luminance")
+
+    def stack_plugin(self):
+        """
+        stack-enfuse: enfuse + align_image_stack CLI tools
+        stack-native: in process numpy / OpenCV
+        """
+        return self.j.get("stack_plugin", "stack-enfuse")
+
+    def fused(self):
+        """
+        Take each tile through the whole pipeline on one worker
+        Only final images are written (intermediate directories stay empty)
+        Saves a full write / read of the data set per stage
+        and the wait for the slowest tile between stages
+        """
+        return bool(self.j.get("fused", False))
+
+    def intermediate_format(self):
+        """
+        File format between stages, see uscope.imagep.codec
+        native (default), jpg, tif, tif-zstd, npy
+        """
+        return self.j.get("intermediate_format", "native")
+
 
 class DirCSIP:
     def __init__(self,
@@ -129,9 +278,12 @@ class DirCSIP:
                  ewf=None,
                  configj={},
                  microscope=None,
+                 upload_gate=None,
                  verbose=True):
         self.csip = csip
         self.microscope = microscope
+        # acquire()'d before uploading. See uscope.imagep.jobs.UploadGate
+        self.upload_gate = upload_gate
         self.log = csip.log
         self.directory = directory
         self.cs_info = cs_info
@@ -143,16 +295,177 @@ class DirCSIP:
         self.best_effort = best_effort
         self.ipp_config = IPPConfigJ(configj)
         self.verbose = verbose
+        # fn_out => dict returned by the plugin (ex: align_quality)
+        self.task_results = {}
+        # Decides what lazy can skip
+        self.cache = ProcessingCache(directory, log=self.log)
+        self.telemetry = ProcessingTelemetry(directory, log=self.log)
+
+    def task_callback(self, fn_out, key, stage):
+        def callback(ip_params, result, info):
+            self.telemetry.record(stage, fn_out, result, ip_params.telemetry)
+            if result == "ok":
+                if info:
+                    self.task_results[fn_out] = info
+                self.cache.record(fn_out, key, info=info, stage=stage)
+
+        return callback
+
+    def lazy_skip(self, lazy, fn_out, key):
+        """
+        Return True if fn_out is already up to date
+        """
+        if not lazy or not self.cache.is_fresh(fn_out, key):
+            return False
+        self.log(f"lazy: skip {fn_out}")
+        info = self.cache.get_info(fn_out)
+        if info:
+            self.task_results[fn_out] = info
+        return True
+
+    def find_qr_match(self, iindex, qr_regex):
+        """
+        Return the first QR code in the scan matching qr_regex or None
+        Images are checked a batch at a time on the worker pool
+        Positions that had the label before go first
+        and no more batches are queued once something matched
+        """
+        positions_fn = None
+        if self.microscope:
+            positions_fn = os.path.join(
+                self.microscope.usc.get_microscope_data_dir(),
+                QR_POSITIONS_FN)
+        positions = QRPositions(positions_fn)
+        basenames = positions.order(iindex)
+        batch_size = max(1, len(self.csip.workers))
+        for batchi in range(0, len(basenames), batch_size):
+            batch = basenames[batchi:batchi + batch_size]
+            # basename => plugin result
+            results = {}
+
+            def callback(basename):
+                def f(_ip_params, result, info):
+                    if result == "ok" and info:
+                        results[basename] = info
+
+                return f
+
+            tb = TaskBarrier()
+            for basename in batch:
+                self.csip.queue_1_to_1_plugin(plugin="qr-detect",
+                                              fn_in=os.path.join(
+                                                  iindex["dir"], basename),
+                                              data_out={},
+                                              options={"regex": qr_regex},
+                                              callback=callback(basename),
+                                              tb=tb)
+            tb.wait()
+            # Keep preference order within the batch
+            for basename in batch:
+                info = results.get(basename)
+                if info and info["qr"]:
+                    self.log("QR code %s in %s (1/%u scale)" %
+                             (info["qr"], basename, info["scale"]))
+                    v = iindex["images"][basename]
+                    positions.record(v["col"], v["row"])
+                    return info["qr"]
+        self.verbose and self.log("QR code: none found")
+        return None
+
+    def pass_through(self, plugins, fns_in, fn_out, key):
+        """
+        Plugins that wouldn't change a lone image: link it instead of re-encoding
+        plugins: plugin name or list of names (fused chain)
+        Return True if fn_out was materialized
+        """
+        if isinstance(plugins, str):
+            plugins = [plugins]
+        if len(fns_in) != 1:
+            return False
+        if not all(
+                getattr(get_plugin_ctors().get(plugin), "single_input_identity",
+                        False) for plugin in plugins):
+            return False
+        # Format change (ex: intermediate .npy) needs an encode
+        if os.path.splitext(fns_in[0])[1].lower() != os.path.splitext(
+                fn_out)[1].lower():
+            return False
+        method = materialize_image(fns_in[0], fn_out)
+        self.verbose and self.log(f"{method} {fns_in[0]} {fn_out}")
+        self.cache.record(fn_out, key, stage=plugins)
+        return True
+
+    def task_key(self, plugin, fns_in, save_kwargs={}):
+        return self.cache.task_key(
+            plugin,
+            fns_in,
+            options={"save_kwargs": save_kwargs},
+            fingerprints=[self.csip.plugin_fingerprint(plugin)])
+
+    def stage_output(self, final):
+        """
+        Return kwargs selecting the output format of a stage
+        image_suffix: None => same as the stage input
+        save_kwargs: see EtherealImageW
+        """
+        if final:
+            # Whatever the intermediates were, end up like the scan
+            return {
+                "image_suffix": get_image_suffix(self.directory),
+                "save_kwargs": {}
+            }
+        suffix, save_kwargs = intermediate_format(
+            self.ipp_config.intermediate_format())
+        return {"image_suffix": suffix, "save_kwargs": save_kwargs}
+
+    def wait_save(self, tb):
+        """
+        Wait for tasks to finish and persist what completed
+        even if some of them failed
+        """
+        try:
+            tb.wait()
+        finally:
+            self.cache.save()
+
+    def alignment_summary(self):
+        """
+        Per tile alignment quality reported by stack / HDR plugins
+        Tiles below ALIGN_QUALITY_WARN are likely misregistered
+        Return None if no plugin aligned anything
+        """
+        tiles = {}
+        for fn_out, info in sorted(self.task_results.items()):
+            if "align_quality" in info:
+                # ex: stack/c000_r001.jpg
+                k = os.path.join(os.path.basename(os.path.dirname(fn_out)),
+                                 os.path.basename(fn_out))
+                tiles[k] = info["align_quality"]
+        if not tiles:
+            return None
+        flagged = [
+            k for k, quality in tiles.items() if quality < ALIGN_QUALITY_WARN
+        ]
+        for k in flagged:
+            self.log("WARNING: poor alignment %s: %0.3f" % (k, tiles[k]))
+        return {
+            "threshold": ALIGN_QUALITY_WARN,
+            "tiles": tiles,
+            "flagged": flagged,
+        }
 
     def run_n_to_1(self,
                    task_name,
                    bucket_name,
                    iindex_in,
                    dir_out,
-                   lazy=True):
+                   lazy=True,
+                   image_suffix=None,
+                   save_kwargs={}):
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
-        image_suffix = get_image_suffix(iindex_in["dir"])
+        if image_suffix is None:
+            image_suffix = get_image_suffix(iindex_in["dir"])
         buckets = bucket_group(iindex_in, bucket_name)
 
         tb = TaskBarrier()
@@ -163,60 +476,88 @@ class DirCSIP:
                 for _i, fn in sorted(hdrs.items())
             ]
             fn_out = os.path.join(dir_out, fn_prefix + image_suffix)
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
-                self.log("%s %s" % (fn_prefix, fn_out))
-                self.log("  %s" % (hdrs.items(), ))
-                self.log("Queing task")
-                self.csip.queue_n_to_1_plugin(task_name=task_name,
-                                              fns_in=fns,
-                                              fn_out=fn_out,
-                                              tb=tb)
-        tb.wait()
+            key = self.task_key(task_name, fns, save_kwargs=save_kwargs)
+            if self.lazy_skip(lazy, fn_out, key) or self.pass_through(
+                    task_name, fns, fn_out, key):
+                continue
+            self.log("%s %s" % (fn_prefix, fn_out))
+            self.log("  %s" % (hdrs.items(), ))
+            self.log("Queing task")
+            self.csip.queue_n_to_1_plugin(task_name=task_name,
+                                          fns_in=fns,
+                                          fn_out=fn_out,
+                                          callback=self.task_callback(
+                                              fn_out, key, task_name),
+                                          save_kwargs=save_kwargs,
+                                          tb=tb)
+        self.wait_save(tb)
 
     # FIXME: unify this + run_1_to_1
-    def correct_plugin_run(self, plugin_config, iindex_in, dir_out, lazy=True):
+    def correct_plugin_run(self,
+                           plugin_config,
+                           iindex_in,
+                           dir_out,
+                           lazy=True,
+                           image_suffix=None,
+                           save_kwargs={}):
         # TODO: some options as well?
         plugin = plugin_config["plugin"]
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
         tb = TaskBarrier()
         for fn_in in iindex_in["images"].keys():
-            fn_out = os.path.join(dir_out, os.path.basename(fn_in))
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
+            basename_out = os.path.basename(fn_in)
+            if image_suffix is not None:
+                basename_out = os.path.splitext(basename_out)[0] + image_suffix
+            fn_out = os.path.join(dir_out, basename_out)
+            fn_in = os.path.join(iindex_in["dir"], fn_in)
+            key = self.task_key(plugin, [fn_in], save_kwargs=save_kwargs)
+            if not self.lazy_skip(lazy, fn_out, key):
                 self.csip.queue_1_to_1_plugin(plugin=plugin,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
+                                              fn_in=fn_in,
                                               fn_out=fn_out,
+                                              callback=self.task_callback(
+                                                  fn_out, key, plugin),
+                                              save_kwargs=save_kwargs,
                                               tb=tb)
         # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
-        tb.wait()
+        self.wait_save(tb)
 
-    def run_1_to_1(self, task_name, iindex_in, dir_out, lazy=True):
+    def run_1_to_1(self,
+                   task_name,
+                   iindex_in,
+                   dir_out,
+                   lazy=True,
+                   image_suffix=None,
+                   save_kwargs={}):
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
         tb = TaskBarrier()
         for fn_in in iindex_in["images"].keys():
-            fn_out = os.path.join(dir_out, os.path.basename(fn_in))
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
+            basename_out = os.path.basename(fn_in)
+            if image_suffix is not None:
+                basename_out = os.path.splitext(basename_out)[0] + image_suffix
+            fn_out = os.path.join(dir_out, basename_out)
+            fn_in = os.path.join(iindex_in["dir"], fn_in)
+            key = self.task_key(task_name, [fn_in], save_kwargs=save_kwargs)
+            if not self.lazy_skip(lazy, fn_out, key):
                 self.csip.queue_1_to_1_plugin(plugin=task_name,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
+                                              fn_in=fn_in,
                                               fn_out=fn_out,
+                                              callback=self.task_callback(
+                                                  fn_out, key, task_name),
+                                              save_kwargs=save_kwargs,
                                               tb=tb)
         # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
-        tb.wait()
+        self.wait_save(tb)
 
     def hdr_run(self, **kwargs):
-        self.run_n_to_1(task_name="hdr-luminance", bucket_name="hdr", **kwargs)
+        self.run_n_to_1(task_name=self.ipp_config.hdr_plugin(),
+                        bucket_name="hdr",
+                        **kwargs)
 
     def stack_run(self, **kwargs):
-        self.run_n_to_1(task_name="stack-enfuse",
+        self.run_n_to_1(task_name=self.ipp_config.stack_plugin(),
                         bucket_name="stack",
                         **kwargs)
 
@@ -231,28 +572,126 @@ class DirCSIP:
     def correct_ff1_run(self, **kwargs):
         self.run_1_to_1(task_name="correct-ff1", **kwargs)
 
-    def run(self):
+    def make_plan(self, iindex_in):
         """
-        Process a completed scan into processed images
-        Spins off processing to workers where possible
+        Return the stages run() would apply, in order
+        Each is a dict with:
+            plugin: plugin name
+            dir: output subdirectory (relative to the previous stage)
+            bucket: iindex key merged by this stage (ex: "hdr") or None for 1 to 1
         """
+        ret = []
+        for pipeline_this in config.get_usc().ipp.pipeline_first():
+            ret.append({
+                "plugin": pipeline_this["plugin"],
+                "dir": pipeline_this["dir"],
+                "bucket": None
+            })
+        if iindex_in["stabilization"]:
+            ret.append({
+                "plugin": "stabilization",
+                "dir": "stabilization",
+                "bucket": "stabilization"
+            })
+        if iindex_in["hdrs"]:
+            ret.append({
+                "plugin": self.ipp_config.hdr_plugin(),
+                "dir": "hdr",
+                "bucket": "hdr"
+            })
+        if iindex_in["stacks"]:
+            ret.append({
+                "plugin": self.ipp_config.stack_plugin(),
+                "dir": "stack",
+                "bucket": "stack"
+            })
+        if self.ipp_config.snapshot_correction():
+            for pipeline_this in config.get_usc().ipp.snapshot_correction():
+                ret.append({
+                    "plugin": pipeline_this["plugin"],
+                    "dir": pipeline_this["dir"],
+                    "bucket": None
+                })
+        if config.get_usc().imager.has_ff_cal():
+            ret.append({"plugin": "correct-ff1", "dir": "ff1", "bucket": None})
+        return ret
 
-        self.log("Reading metadata...")
-        working_iindex = index_scan_images(self.directory)
-        dst_basename = os.path.basename(os.path.abspath(self.directory))
+    def fused_run(self, iindex_in):
+        """
+        Queue one task per tile that runs all stages in memory
+        Writes only into the final (nested) directory
+        such that the rest of run() sees the same layout as a staged run
+        Returns the final iindex
+        """
+        plan = self.make_plan(iindex_in)
+        if not plan:
+            self.log("Fused: nothing to do")
+            return iindex_in
+        self.log("Fused: %s" %
+                 " => ".join([stage["plugin"] for stage in plan]))
+        dir_out = iindex_in["dir"]
+        for stage in plan:
+            dir_out = os.path.join(dir_out, stage["dir"])
+        os.makedirs(dir_out, exist_ok=True)
+        stages = [{
+            "plugin": stage["plugin"],
+            "bucket": stage["bucket"]
+        } for stage in plan]
+        fingerprints = [
+            self.csip.plugin_fingerprint(stage["plugin"]) for stage in plan
+        ]
+
+        # final basename => input basenames
+        tiles = {}
+        for basename in sorted(iindex_in["images"].keys()):
+            basename_out = basename
+            for stage in plan:
+                if stage["bucket"]:
+                    basename_out = reduce_iindex_filename(
+                        basename_out, remove_key=stage["bucket"]
+                    ) + os.path.splitext(basename_out)[1]
+            tiles.setdefault(basename_out, []).append(basename)
 
-        print("Microscope: %s" % (self.microscope.name, ))
-        print("Serial: %s" % (self.microscope.serial(), ))
-        print("Has FF cal: %s" % config.get_usc().imager.has_ff_cal())
-        print("Options")
-        print("  Keep intermediates:", self.ipp_config.keep_intermediates())
-        print("  Write HTML viewer:", self.ipp_config.write_html_viewer())
-        print("  Write snapshot grid:", self.ipp_config.write_snapshot_grid())
-        print("  Write quick pano:", self.ipp_config.write_quick_pano())
-        print("  Snapshot correction:", self.ipp_config.snapshot_correction())
-        print("  Cloud stitch:", self.ipp_config.cloud_stitch())
+        tb = TaskBarrier()
+        for basename_out, basenames in sorted(tiles.items()):
+            fn_out = os.path.join(dir_out, basename_out)
+            fns_in = [
+                os.path.join(iindex_in["dir"], basename)
+                for basename in basenames
+            ]
+            key = self.cache.task_key(stages,
+                                      fns_in,
+                                      fingerprints=fingerprints)
+            if self.lazy_skip(self.lazy, fn_out, key):
+                continue
+            if self.pass_through([stage["plugin"] for stage in stages],
+                                 fns_in, fn_out, key):
+                continue
+            self.verbose and self.log("%s: %u images" %
+                                      (fn_out, len(basenames)))
+            self.csip.queue_fused(fns_in=fns_in,
+                                  fn_out=fn_out,
+                                  stages=stages,
+                                  callback=self.task_callback(
+                                      fn_out, key,
+                                      [stage["plugin"] for stage in stages]),
+                                  tb=tb)
+        self.wait_save(tb)
+        return index_scan_images(dir_out)
+
+    def staged_run(self, working_iindex):
+        """
+        Run one stage at a time over the whole data set
+        Each stage writes a complete directory that the next stage reads
+        Returns the final iindex
+        """
+        # Stages left to run, including the next one
+        stages_left = len(self.make_plan(working_iindex))
 
-        self.log("")
+        def stage_output():
+            nonlocal stages_left
+            stages_left -= 1
+            return self.stage_output(final=stages_left == 0)
 
         ipp = config.get_usc().ipp.pipeline_first()
         if len(ipp) == 0:
@@ -265,7 +704,8 @@ class DirCSIP:
                 next_dir = os.path.join(working_iindex["dir"], this_dir)
                 self.correct_plugin_run(pipeline_this,
                                         iindex_in=working_iindex,
-                                        dir_out=next_dir)
+                                        dir_out=next_dir,
+                                        **stage_output())
                 working_iindex = index_scan_images(next_dir)
 
         if working_iindex["stabilization"]:
@@ -274,7 +714,8 @@ class DirCSIP:
             next_dir = os.path.join(working_iindex["dir"], "stabilization")
             self.stabilization_run(iindex_in=working_iindex,
                                    dir_out=next_dir,
-                                   lazy=self.lazy)
+                                   lazy=self.lazy,
+                                   **stage_output())
             working_iindex = index_scan_images(next_dir)
 
         if working_iindex["hdrs"]:
@@ -283,7 +724,8 @@ class DirCSIP:
             next_dir = os.path.join(working_iindex["dir"], "hdr")
             self.hdr_run(iindex_in=working_iindex,
                          dir_out=next_dir,
-                         lazy=self.lazy)
+                         lazy=self.lazy,
+                         **stage_output())
             working_iindex = index_scan_images(next_dir)
 
         self.log("")
@@ -295,7 +737,8 @@ class DirCSIP:
             # maybe? helps some use cases
             self.stack_run(iindex_in=working_iindex,
                            dir_out=next_dir,
-                           lazy=self.lazy)
+                           lazy=self.lazy,
+                           **stage_output())
             working_iindex = index_scan_images(next_dir)
         """
         Now apply custom correction plugins
@@ -313,7 +756,8 @@ class DirCSIP:
                     next_dir = os.path.join(working_iindex["dir"], this_dir)
                     self.correct_plugin_run(pipeline_this,
                                             iindex_in=working_iindex,
-                                            dir_out=next_dir)
+                                            dir_out=next_dir,
+                                            **stage_output())
                     working_iindex = index_scan_images(next_dir)
 
         if not config.get_usc().imager.has_ff_cal():
@@ -321,8 +765,49 @@ class DirCSIP:
         else:
             self.verbose and self.log("FF correction: start")
             next_dir = os.path.join(working_iindex["dir"], "ff1")
-            self.correct_ff1_run(iindex_in=working_iindex, dir_out=next_dir)
+            self.correct_ff1_run(iindex_in=working_iindex,
+                                 dir_out=next_dir,
+                                 **stage_output())
             working_iindex = index_scan_images(next_dir)
+        return working_iindex
+
+    def run(self):
+        """
+        Process a completed scan into processed images
+        Spins off processing to workers where possible
+        """
+
+        self.log("Reading metadata...")
+        working_iindex = index_scan_images(self.directory)
+        dst_basename = os.path.basename(os.path.abspath(self.directory))
+
+        print("Microscope: %s" % (self.microscope.name, ))
+        print("Serial: %s" % (self.microscope.serial(), ))
+        print("Has FF cal: %s" % config.get_usc().imager.has_ff_cal())
+        print("Options")
+        print("  Keep intermediates:", self.ipp_config.keep_intermediates())
+        print("  Write HTML viewer:", self.ipp_config.write_html_viewer())
+        print("  Write snapshot grid:", self.ipp_config.write_snapshot_grid())
+        print("  Write quick pano:", self.ipp_config.write_quick_pano())
+        print("  Write pyramid:", self.ipp_config.write_pyramid())
+        print("  Write preview stitch:",
+              self.ipp_config.write_preview_stitch())
+        print("  Snapshot correction:", self.ipp_config.snapshot_correction())
+        print("  Cloud stitch:", self.ipp_config.cloud_stitch())
+        print("  Fused:", self.ipp_config.fused())
+        print("  HDR plugin:", self.ipp_config.hdr_plugin())
+        print("  Stack plugin:", self.ipp_config.stack_plugin())
+        print("  Intermediate format:", self.ipp_config.intermediate_format())
+
+        self.log("")
+        if self.cache.resumed:
+            self.log("Resuming: %u tasks completed before interruption" %
+                     (self.cache.resumed, ))
+
+        if self.ipp_config.fused():
+            working_iindex = self.fused_run(working_iindex)
+        else:
+            working_iindex = self.staged_run(working_iindex)
 
         self.verbose and self.log("")
         healthy = self.csip.inspect_final_dir(working_iindex)
@@ -342,38 +827,58 @@ class DirCSIP:
             assert healthy
             self.log("")
 
+        # Before any rename below
+        telemetry = self.telemetry.finish()
+
         qr_regex = config.bc.qr_regex()
         if qr_regex:
-            for fn in working_iindex["images"]:
-                fn_full = os.path.join(working_iindex["dir"], fn)
-                image = Image.open(fn_full)
-                qr_match = find_qr_code_match(image, qr_regex)
-                if qr_match:
-                    next_dir = working_iindex["dir"] + "_" + qr_match
-                    os.rename(working_iindex["dir"], next_dir)
-                    working_iindex = index_scan_images(next_dir)
-                    self.directory = next_dir
-                    # self.log("QR match found, renaming dir")
-                    break
+            qr_match = self.find_qr_match(working_iindex, qr_regex)
+            if qr_match:
+                next_dir = working_iindex["dir"] + "_" + qr_match
+                os.rename(working_iindex["dir"], next_dir)
+                working_iindex = index_scan_images(next_dir)
+                self.directory = next_dir
+                # self.log("QR match found, renaming dir")
 
         # https://github.com/Labsmore/pyuscope/issues/416
         # In the future we might make this more error resistant instead of skipping it
         if healthy:
-            if self.ipp_config.write_html_viewer():
-                self.verbose and self.log("Writing HTML viewer")
-                if is_tif_scan(working_iindex["dir"]):
-                    # Only Safari supports .tif
-                    self.log(
-                        "WARNING: HTML viewer only works reliably with jpg")
-                write_html_viewer(working_iindex)
+            dzi_fn = None
+            if self.ipp_config.write_pyramid():
+                self.verbose and self.log("Writing pyramid")
+                dzi_fn = write_dzi_pyramid(working_iindex,
+                                           nthreads=len(self.csip.workers))
 
             if self.ipp_config.write_snapshot_grid():
                 self.verbose and self.log("Writing tile image")
-                write_snapshot_grid(working_iindex)
+                write_snapshot_grid(working_iindex,
+                                    nthreads=len(self.csip.workers))
 
             if self.ipp_config.write_quick_pano():
                 self.verbose and self.log("Writing quick pano")
-                write_quick_pano(working_iindex)
+                try:
+                    write_quick_pano(working_iindex,
+                                     nthreads=len(self.csip.workers))
+                except HugeImage as e:
+                    self.log(f"WARNING: quick pano too large: {e}")
+                    if not dzi_fn:
+                        self.log("Writing pyramid instead")
+                        dzi_fn = write_dzi_pyramid(
+                            working_iindex, nthreads=len(self.csip.workers))
+
+            if self.ipp_config.write_preview_stitch():
+                self.verbose and self.log("Writing preview stitch")
+                try:
+                    write_preview_stitch(working_iindex,
+                                         nthreads=len(self.csip.workers))
+                except HugeImage as e:
+                    self.log(f"WARNING: preview stitch too large: {e}")
+
+            if self.ipp_config.write_html_viewer():
+                self.verbose and self.log("Writing HTML viewer")
+                write_html_viewer(working_iindex,
+                                  dzi_fn=dzi_fn,
+                                  nthreads=len(self.csip.workers))
         else:
             self.log(
                 "WARNING: skipping generating summary output on incomplete processed scan"
@@ -382,14 +887,20 @@ class DirCSIP:
         outj = {
             "type": "processing",
         }
+        alignment = self.alignment_summary()
+        if alignment:
+            outj["alignment"] = alignment
+        if telemetry:
+            outj["telemetry"] = telemetry
         writej(os.path.join(self.directory, "processing.json"), outj)
 
         if not self.ipp_config.keep_intermediates():
+            print(
+                f"Clean up intermediates: {working_iindex['dir']} => {self.directory}"
+            )
             remove_intermediate_directories(self.directory,
                                             working_iindex["dir"])
-            print(f"Clean up intermediates: {next_dir} => {self.directory}")
-            next_dir = self.directory
-            working_iindex = index_scan_images(next_dir)
+            working_iindex = index_scan_images(self.directory)
 
         if not self.upload:
             self.log("CloudStitch: skip (requested by CLI)")
@@ -406,7 +917,7 @@ class DirCSIP:
             delete_jpg_dir = None
             main_dir = working_iindex["dir"]
 
-            check_valid_image_dir(working_iindex)
+            check_valid_image_dir(working_iindex, log=self.log)
 
             # CloudStitch currently only supports .jpg
             if is_tif_scan(working_iindex["dir"]):
@@ -414,15 +925,17 @@ class DirCSIP:
                 self.log("Converting to jpg")
                 next_dir = os.path.join(working_iindex["dir"], "jpg_tmp")
                 delete_jpg_dir = next_dir
-                # runs inline, not parallelized
+                # Parallel on the worker pool
                 self.csip.tif2jpg_dir(iindex_in=working_iindex,
                                       dir_out=next_dir,
                                       lazy=self.lazy)
                 working_iindex = index_scan_images(next_dir)
 
-                check_valid_image_dir(working_iindex)
+                check_valid_image_dir(working_iindex, log=self.log)
 
             try:
+                if self.upload_gate:
+                    self.upload_gate.acquire(log=self.log)
                 self.log("Ready to stitch " + working_iindex["dir"])
                 cloud_stitch.upload_dir(working_iindex["dir"],
                                         cs_info=self.cs_info,
@@ -501,11 +1014,13 @@ class SnapshotCSIP:
                 plugin = pipeline_this["plugin"]
                 self.verbose and self.log(f"{plugin}: start")
                 tb = TaskBarrier()
-                data_out = self.csip.queue_1_to_1_plugin(plugin=plugin,
-                                                         im_in=current_image,
-                                                         want_im_out=True,
-                                                         tb=tb,
-                                                         options=options)
+                data_out = self.csip.queue_1_to_1_plugin(
+                    plugin=plugin,
+                    im_in=current_image,
+                    want_im_out=True,
+                    tb=tb,
+                    options=options,
+                    priority=TASK_PRIORITY_INTERACTIVE)
                 tb.wait()
                 current_image = data_out["image"].get_im()
 
@@ -514,9 +1029,11 @@ class SnapshotCSIP:
         else:
             self.verbose and self.log("FF correction: start")
             tb = TaskBarrier()
-            data_out = self.csip.queue_correct_ff1(im_in=current_image,
-                                                   want_im_out=True,
-                                                   tb=tb)
+            data_out = self.csip.queue_correct_ff1(
+                im_in=current_image,
+                want_im_out=True,
+                tb=tb,
+                priority=TASK_PRIORITY_INTERACTIVE)
             tb.wait()
             current_image = data_out["image"].get_im()
 
@@ -524,159 +1041,253 @@ class SnapshotCSIP:
 
 
 """
-WIP, not tested / used currently
+Second generation image processing orchestrator
 See https://github.com/Labsmore/pyuscope/issues/190
 
-Second generation image processing orchestrator
-Constructs a pipeline based on expected input data
-Expects all images to be present
-If it fails you'll need to fall back to DirCSIP
+Processes images as they arrive from an ImageStream (ex: a scan in progress)
+Each tile moves to the next stage as soon as its bucket
+(ex: all exposures of an HDR bracket) is complete
+Produces the same nested directories as DirCSIP
+such that a follow up DirCSIP run (lazy) only has to do the final steps
+Tasks go through that DirCSIP's processing cache (keys, lazy skip, telemetry)
+so the follow up run skips exactly what the stream completed
 """
-'''
+
+
 class StreamCSIP:
-    def __init__(self, csip, image_stream, microscope=None, upload=False):
-        assert 0, "WIP"
+    def __init__(self,
+                 csip,
+                 image_stream,
+                 cs_info=None,
+                 upload=False,
+                 lazy=True,
+                 fix=False,
+                 best_effort=True,
+                 configj={},
+                 finalize=True,
+                 microscope=None,
+                 verbose=True):
         self.csip = csip
+        self.log = csip.log
         self.image_stream = image_stream
         self.microscope = microscope
+        self.cs_info = cs_info
+        self.upload = upload
+        self.lazy = lazy
+        self.fix = fix
+        self.best_effort = best_effort
+        self.configj = configj
+        self.ipp_config = IPPConfigJ(configj)
+        # Run DirCSIP to generate summaries, upload, etc once all tiles are done
+        self.finalize = finalize
+        self.verbose = verbose
 
-        # TODO: auto figure this out
-        # Might also want to move these to be objects
-        self.pipeline = []
+        self.pipeline = self.make_pipeline()
+        self.lock = threading.Lock()
+        # Images waiting for the rest of their bucket, per stage
+        self.buckets = [{} for _pipe in self.pipeline]
+        # statei => DirCSIP.stage_output()
+        self.stage_outputs = {}
+        self.final_fns = set()
+        self.tb = TaskBarrier()
+        # Shares its cache and telemetry with the stream tasks and finalizes
+        # Stages already ran one tile at a time: a fused pass would redo them
+        self.dircsip = DirCSIP(self.csip,
+                               self.image_stream.working_dir(),
+                               cs_info=self.cs_info,
+                               upload=self.upload,
+                               lazy=True,
+                               fix=self.fix,
+                               best_effort=self.best_effort,
+                               configj=dict(self.configj, fused=False),
+                               microscope=self.microscope,
+                               verbose=self.verbose)
+
+    def make_pipeline(self):
+        """
+        Same stages in the same order as DirCSIP
+        """
+        ret = []
+        dir_in = self.image_stream.working_dir()
+
+        def add(plugin, dirname, bucket=None):
+            nonlocal dir_in
+            dir_out = os.path.join(dir_in, dirname)
+            ret.append({
+                "plugin":
+                plugin,
+                "bucket":
+                bucket,
+                "size":
+                self.image_stream.bucket_size(bucket) if bucket else 1,
+                "dir_out":
+                dir_out,
+            })
+            dir_in = dir_out
+
+        for pipeline_this in config.get_usc().ipp.pipeline_first():
+            add(pipeline_this["plugin"], pipeline_this["dir"])
+        if self.image_stream.has_stabilization():
+            add("stabilization", "stabilization", "stabilization")
         if self.image_stream.has_hdr():
-            self.pipeline.append({"plugin": "hdr-enfuse"})
+            add(self.ipp_config.hdr_plugin(), "hdr", "hdr")
         if self.image_stream.has_stack():
-            self.pipeline.append({"plugin": "stack-enfuse"})
-        # Should this be before or after other steps?
-        # Currently expensive so put at the end
+            add(self.ipp_config.stack_plugin(), "stack", "stack")
+        if self.ipp_config.snapshot_correction():
+            for pipeline_this in config.get_usc().ipp.snapshot_correction():
+                add(pipeline_this["plugin"], pipeline_this["dir"])
         if config.get_usc().imager.has_ff_cal():
-            self.pipeline.append({"plugin": "correct-illumination"})
-
-        next_directory = self.image_stream.working_dir()
-        for pipe in self.pipeline:
-            """
-            keys are the next file basename w/o extension
-            ex: 
-            """
-            plugin = pipe["plugin"]
-
-            if plugin == "hdr-enfuse":
-                ptype = "hdr"
-            elif plugin == "stack-enfuse":
-                ptype = "stack"
-            elif plugin == "correct-illumination":
-                ptype = "correct"
-            else:
-                assert 0, plugin
-
-            pipe["buckets"] = {}
-            pipe["type"] = ptype
-            pipe["remove_key"] = ptype
-            pipe["dir_in"] = next_directory
-            """
-            Nest directories like .../mz_mit20x/hdr/stack/
-            """
-            next_directory = os.path.join(next_directory, ptype)
-            pipe["dir_out"] = next_directory
-
-        self.tb = TaskBarrier()
+            add("correct-ff1", "ff1")
+        return ret
 
-    def bucket_images(self, pipe, images):
-        """
-        Place new images into given pipeline stage
-        Don't trigger any processing, even if it could be done now
-        """
-        for image in images:
-            # iindex_filename_key[image.get_filename]
-            fn = image.get_filename()
-            bucketk = reduce_iindex_filename(fn, remove_key=pipe["remove_key"])
-            pipe.buckets.setdefault(bucketk, set()).add(os.path.basename(fn))
-
-    def bucket_full(self, statei, bucketk):
-        plugin = self.pipeline[statei]
-        if plugin == "hdr-enfuse":
-            expected = self.image_stream.bucket_size("hdr")
-        elif plugin == "stack-enfuse":
-            expected = self.image_stream.bucket_size("stack")
-        elif plugin == "correct-illumination":
-            expected = 1
+    def working_dir(self):
+        """
+        Directory final images are written to
+        """
+        if self.pipeline:
+            return self.pipeline[-1]["dir_out"]
         else:
-            assert 0, f"bad plugin {plugin}"
-        return len(self.state[statei][bucketk]) >= expected
+            return self.image_stream.working_dir()
 
-    def process_bucket(self, pipe, bucketk):
-        if not self.bucket_full(pipe, bucketk):
+    def stage_output(self, statei):
+        """
+        Same output format as DirCSIP would use for this stage
+        """
+        with self.lock:
+            ret = self.stage_outputs.get(statei)
+            if ret is None:
+                ret = self.dircsip.stage_output(
+                    final=statei == len(self.pipeline) - 1)
+                self.stage_outputs[statei] = ret
+            return ret
+
+    def add_image(self, statei, fn):
+        """
+        Place a new image into given pipeline stage
+        Kicks off processing if it completes a bucket
+        """
+        if statei == len(self.pipeline):
+            with self.lock:
+                self.final_fns.add(fn)
             return
-        plugin = pipe["plugin"]
-        if plugin == "hdr-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_hdr_enfuse(fns_in=pipe["buckets"][bucketk],
-                                       fn_out=fn_out)
-        elif plugin == "stack-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_stack_enfuse(fns_in=pipe["buckets"][bucketk],
-                                         fn_out=fn_out)
-        elif plugin == "correct-illumination":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            self.csip.queue_correct_illumination(fn_in=fns_in[0],
-                                                 fn_out=fn_out)
-        elif plugin == "save-jpg":
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".jpg")
-            self.csip.queue_convert_jpg(fn_in=fns_in[0], fn_out=fn_out)
+
+        pipe = self.pipeline[statei]
+        basename = os.path.basename(fn)
+        image_suffix = self.stage_output(
+            statei)["image_suffix"] or os.path.splitext(basename)[1]
+        if not pipe["bucket"]:
+            self.process_bucket(
+                statei, [fn],
+                os.path.join(pipe["dir_out"],
+                             os.path.splitext(basename)[0] + image_suffix))
+            return
+
+        bucketk = reduce_iindex_filename(basename, remove_key=pipe["bucket"])
+        with self.lock:
+            fns = self.buckets[statei].setdefault(bucketk, set())
+            fns.add(fn)
+            if len(fns) < pipe["size"]:
+                return
+            del self.buckets[statei][bucketk]
+        fn_out = os.path.join(pipe["dir_out"], bucketk + image_suffix)
+        self.process_bucket(statei, sorted(fns), fn_out)
+
+    def process_bucket(self, statei, fns_in, fn_out):
+        pipe = self.pipeline[statei]
+        os.makedirs(pipe["dir_out"], exist_ok=True)
+        save_kwargs = self.stage_output(statei)["save_kwargs"]
+        key = self.dircsip.task_key(pipe["plugin"],
+                                    fns_in,
+                                    save_kwargs=save_kwargs)
+        done = self.dircsip.lazy_skip(self.lazy, fn_out, key)
+        if not done and pipe["bucket"]:
+            done = self.dircsip.pass_through(pipe["plugin"], fns_in, fn_out,
+                                             key)
+        if done:
+            self.add_image(statei + 1, fn_out)
+            return
+
+        record = self.dircsip.task_callback(fn_out, key, pipe["plugin"])
+
+        def callback(ip_params, result, info):
+            record(ip_params, result, info)
+            if result == "ok":
+                self.add_image(statei + 1, fn_out)
+            else:
+                self.log(
+                    f"WARNING: {pipe['plugin']} failed on {fn_out}: {info}")
+
+        if pipe["bucket"]:
+            self.csip.queue_n_to_1_plugin(task_name=pipe["plugin"],
+                                          fns_in=fns_in,
+                                          fn_out=fn_out,
+                                          callback=callback,
+                                          save_kwargs=save_kwargs,
+                                          tb=self.tb)
         else:
-            assert 0, f"bad plugin {plugin}"
-        del self.pipe["buckets"][bucketk]
+            self.csip.queue_1_to_1_plugin(plugin=pipe["plugin"],
+                                          fn_in=fns_in[0],
+                                          fn_out=fn_out,
+                                          callback=callback,
+                                          save_kwargs=save_kwargs,
+                                          tb=self.tb)
 
     def run(self):
         """
         Stream images (ie from an in progress capture)
-        Two steams of data:
-        -Raw images
-        -Completed intermediate steps
-        Could also just grab from a filesystem hmm
-        """
-        """
-        Keep track of images at each state of the pipeline
-        Key them based on file basenames / assume they are written to the filesystem
-        """
-        self.states = []
-        for _element in self.pipeline:
-            # Buckets
-            self.states.append({})
-
-        # Done when all images have been put into pipeline and all pipeline tasks are processed
-        while not self.image_stream.done() or not self.tb.idle():
-            # New images for the pipeline?
-            new_images = self.image_stream.new_images()
-            self.bucket_images(self.pipeline[0], new_images)
-
-            # In progress images
-            for statei, new_images in self.pop_completed_images():
-                # Move to next pipeline stage if not done
-                if statei != len(self.pipeline) - 1:
-                    self.bucket_images(self.pipeline[statei + 1], new_images)
-
-            # Since images move down the pipeline, any newly completed images will move to next state
-            # Since we check earlier pipeline stages first bias towards BFS
-            # Could reorder if wanted DFS
-            for statei, pipe in enumerate(self.pipeline):
-                for bucketk in list(pipe["state"].keys()):
-                    self.process_bucket(pipe, bucketk)
+        Returns once the stream is done and all tasks have completed
+        """
+        self.log("Stream processing: %s" %
+                 (", ".join([pipe["plugin"] for pipe in self.pipeline]) or
+                  "nothing to do", ))
+        while not self.image_stream.done():
+            # Wakes up as soon as images arrive. Timeout is only a safety net
+            for image in self.image_stream.new_images(timeout=1.0):
+                self.add_image(0, image.get_filename())
         # Finish all remaining allocated tasks
-        self.tb.wait()
-
-        # Last step after all processed
-        if self.upload:
-            assert 0, "fixme"
-            """
-            self.log("Ready to stitch " + working_iindex["dir"])
-            cloud_stitch.upload_dir(working_iindex["dir"],
-                                    cs_info=cs_info,
-                                    dst_basename=dst_basename,
-                                    verbose=verbose)
-            """
-'''
+        try:
+            self.dircsip.wait_save(self.tb)
+        finally:
+            for statei, buckets in enumerate(self.buckets):
+                for bucketk, fns in sorted(buckets.items()):
+                    self.log(
+                        "WARNING: %s: incomplete bucket %s (%u / %u images)" %
+                        (self.pipeline[statei]["plugin"], bucketk, len(fns),
+                         self.pipeline[statei]["size"]))
+        self.log("Stream processing: %u final images" % len(self.final_fns))
+
+        if self.finalize and self.image_stream.complete():
+            # All tiles are done => DirCSIP lazily skips the heavy lifting
+            self.dircsip.run()
+        else:
+            # Aborted scan: leave partial output for a later (lazy) run
+            if self.finalize:
+                self.log("Stream processing: scan incomplete, not finalizing")
+            self.dircsip.telemetry.finish()
+        return self.working_dir()
+
+
+def run_planner_stream(planner, csip, **kwargs):
+    """
+    Run planner, processing images as they are written
+    The stream is finished however the scan ends (done, stopped or crashed)
+    such that processing never waits on a scan that is gone
+    kwargs: passed to StreamCSIP (ex: configj, finalize)
+    Returns planner.run() metadata
+    """
+    stream = PlannerImageStream.from_planner(planner)
+
+    def process():
+        try:
+            csip.process_stream(stream, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            csip.log(f"WARNING: stream processing crashed: {e}")
+
+    thread = threading.Thread(target=process, name="planner-stream")
+    thread.start()
+    try:
+        return planner.run()
+    finally:
+        stream.finish()
+        thread.join()
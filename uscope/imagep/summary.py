@@ -5,6 +5,17 @@ from PIL import Image
 import struct
 from uscope.util import readj
 import math
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+import collections
+import cv2
+import json
+import multiprocessing
+import numpy as np
+import shutil
+import tempfile
+from uscope.imagep.bigtiff import TIFFStripWriter
+from uscope.imagep.thumbnails import get_thumbnails, load_reduced, THUMBNAIL_SIZE
 
 # /usr/local/lib/python2.7/dist-packages/PIL/Image.py:2210: DecompressionBombWarning: Image size (941782785 pixels) exceeds limit of 89478485 pixels, could be decompression bomb DOS attack.
 #   DecompressionBombWarning)
@@ -23,14 +34,32 @@ class HugeTIF(HugeImage):
     pass
 
 
-# FIXME: for some reason this doesn't work on .tif images
-def write_html_viewer(iindex, output_filename=None):
+def write_html_viewer(iindex,
+                      output_filename=None,
+                      dzi_fn=None,
+                      nthreads=None):
+    """
+    dzi_fn: write a deep zoom viewer for this pyramid (see write_dzi_pyramid())
+        instead of a grid of thumbnails
+    Thumbnails are JPEG (also for .tif scans), loaded as they scroll into view
+    and link to the full resolution image
+    """
     if output_filename is None:
         output_filename = os.path.join(iindex["dir"], "index.html")
 
+    if dzi_fn:
+        write_dzi_viewer(dzi_fn, output_filename)
+        return
+
     assert iindex[
         "flat"], "HTML viewer only supported on final level image set"
 
+    thumbnails = get_thumbnails(iindex, nthreads=nthreads)
+    output_dir = os.path.dirname(os.path.abspath(output_filename))
+    this0 = iindex["crs"][(0, 0)]
+    with Image.open(thumbnails[this0["basename"]]) as im0:
+        thumb_w, thumb_h = im0.size
+
     out = """\
 <!DOCTYPE html>
 <html lang="en">
@@ -62,7 +91,9 @@ def write_html_viewer(iindex, output_filename=None):
         }
 
         img {
+            display: block;
             width: 110px;
+            height: auto;
         }
     </style>
 </head>
@@ -71,7 +102,7 @@ def write_html_viewer(iindex, output_filename=None):
     <h2><center>Labsmore Grid Viewer</center></h2>
 """
     if is_tif_scan(iindex["dir"]):
-        out += "WARNING: HTML viewer only works reliably with .jpg (have .tif)<br>\n"
+        out += "WARNING: full resolution .tif images only open in some browsers<br>\n"
     out += """
     <table>
         <tbody>
@@ -82,9 +113,15 @@ def write_html_viewer(iindex, output_filename=None):
             <tr>
 """
         for col in range(iindex["cols"]):
-            fn_rel = iindex["crs"][(col, row)]["basename"]
+            basename = iindex["crs"][(col, row)]["basename"]
+            fn_rel = os.path.relpath(os.path.join(iindex["dir"], basename),
+                                     output_dir)
+            thumb_rel = os.path.relpath(thumbnails[basename], output_dir)
+            # Size given so the layout is known before anything loads
             out += f"""\
-            <td><img src="{fn_rel}"></td>
+            <td><a href="{fn_rel}"><img src="{thumb_rel}"
+                width="{thumb_w}" height="{thumb_h}" loading="lazy"
+                alt="{basename}"></a></td>
 """
         out += """\
             </tr>
@@ -100,25 +137,62 @@ def write_html_viewer(iindex, output_filename=None):
         f.write(out)
 
 
-def write_snapshot_grid(iindex, output_filename=None):
+# Longest side of the snapshot grid. Keeps it well inside JPEG limits
+# Images are scaled down (via thumbnails) to fit
+SNAPSHOT_GRID_MAX_SIZE = 16384
+
+
+def write_snapshot_grid(iindex,
+                        output_filename=None,
+                        max_size=SNAPSHOT_GRID_MAX_SIZE,
+                        nthreads=None):
+    """
+    max_size: scale images down so that the grid's longest side fits
+        None: full resolution
+    """
     if output_filename is None:
         d = os.path.join(iindex["dir"], "summary")
         if not os.path.exists(d):
             os.mkdir(d)
         output_filename = os.path.join(iindex["dir"], "summary", "tiles.jpg")
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
 
     assert iindex[
         "flat"], "Single image only supported on final level image set"
 
     print('Calculating dimensions...')
 
-    #with Image.open(fns_in[0]) as im0:
     this0 = iindex["crs"][(0, 0)]
-    im0 = Image.open(os.path.join(iindex["dir"], this0["basename"]))
-    spacing = int(im0.height * 0.05)
-    w = im0.size[0] * iindex["cols"] + spacing * (iindex["cols"] - 1)
-    h = im0.size[1] * iindex["rows"] + spacing * (iindex["rows"] - 1)
-    dst = Image.new(im0.mode, (w, h))
+    with Image.open(os.path.join(iindex["dir"], this0["basename"])) as im0:
+        mode = im0.mode
+        image_w, image_h = im0.size
+    # Longest side of a scaled down image. None: full resolution
+    size = None
+    if max_size:
+        # Spacing is 5% of the image height
+        full_w = iindex["cols"] * (image_w + image_h * 0.05)
+        full_h = iindex["rows"] * image_h * 1.05
+        scale = max_size / max(full_w, full_h)
+        if scale < 1.0:
+            size = max(1, int(max(image_w, image_h) * scale))
+    if size:
+        # Small enough: share the HTML viewer's thumbnails
+        fns = get_thumbnails(iindex,
+                             size=max(size, THUMBNAIL_SIZE),
+                             nthreads=nthreads)
+        # All images reduce to the same size
+        with load_reduced(fns[this0["basename"]], size) as im0:
+            mode = im0.mode
+            image_w, image_h = im0.size
+    else:
+        fns = {
+            basename: os.path.join(iindex["dir"], basename)
+            for basename in iindex["images"]
+        }
+    spacing = int(image_h * 0.05)
+    w = image_w * iindex["cols"] + spacing * (iindex["cols"] - 1)
+    h = image_h * iindex["rows"] + spacing * (iindex["rows"] - 1)
 
     if output_filename.find('.jpg') >= 0:
         if w >= 2**16 or h >= 2**16:
@@ -127,13 +201,24 @@ def write_snapshot_grid(iindex, output_filename=None):
         if w * h >= 2**32:
             raise HugeJPEG('Image exceeds maximum JPEG size')
 
-    for this in iindex["images"].values():
-        x = im0.width * this["col"] + spacing * this["col"]
-        # lower left vs uppper left coordinate systems
-        row0 = iindex["rows"] - this["row"] - 1
-        y = im0.height * row0 + spacing * row0
-        im = Image.open(os.path.join(iindex["dir"], this["basename"]))
-        dst.paste(im, (x, y))
+    dst = Image.new(mode, (w, h))
+
+    def load(this):
+        if size:
+            im = load_reduced(fns[this["basename"]], size)
+        else:
+            im = Image.open(fns[this["basename"]])
+            im.load()
+        return this, im
+
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        for this, im in executor.map(load, iindex["images"].values()):
+            x = image_w * this["col"] + spacing * this["col"]
+            # lower left vs uppper left coordinate systems
+            row0 = iindex["rows"] - this["row"] - 1
+            y = image_h * row0 + spacing * row0
+            dst.paste(im, (x, y))
+            im.close()
 
     print(('Saving %s...' % (output_filename, )))
     try:
@@ -150,10 +235,67 @@ def write_snapshot_grid(iindex, output_filename=None):
     print('Done!')
 
 
+# Larger QuickPano canvases are memory mapped files
+# so that memory use doesn't grow with the scan size
+QUICK_PANO_MAX_MEMORY = 512 * 1024**2
+# Rows written per TIFF strip batch when saving
+QUICK_PANO_SAVE_ROWS = 256
+# Rows composited per task in rotation mode
+QUICK_PANO_BAND_ROWS = 128
+
+
+def rotation_inverse_map(width, height, rotation_ccw):
+    """
+    Same geometry as PIL Image.rotate(rotation_ccw, expand=True)
+    Return (rotated width, rotated height, 2 x 3 matrix)
+    matrix maps rotated to source pixel coordinates (cv2.WARP_INVERSE_MAP)
+    """
+    angle = -math.radians(rotation_ccw)
+    a = round(math.cos(angle), 15)
+    b = round(math.sin(angle), 15)
+    d = round(-math.sin(angle), 15)
+    e = round(math.cos(angle), 15)
+    center_x = width / 2.0
+    center_y = height / 2.0
+    c = a * -center_x + b * -center_y + center_x
+    f = d * -center_x + e * -center_y + center_y
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (width, 0), (width, height), (0, height)):
+        xx.append(a * x + b * y + c)
+        yy.append(d * x + e * y + f)
+    rotated_w = math.ceil(max(xx)) - math.floor(min(xx))
+    rotated_h = math.ceil(max(yy)) - math.floor(min(yy))
+    dx = -(rotated_w - width) / 2.0
+    dy = -(rotated_h - height) / 2.0
+    c, f = a * dx + b * dy + c, d * dx + e * dy + f
+    # PIL samples pixel centers at +0.5, OpenCV at integer coordinates
+    c += (a + b) * 0.5 - 0.5
+    f += (d + e) * 0.5 - 0.5
+    return rotated_w, rotated_h, np.array([[a, b, c], [d, e, f]])
+
+
 class QuickPano:
-    def __init__(self, iindex, output_filename=None):
+    """
+    Canvas (dst) is a numpy array, BGR or gray like cv2
+    Above max_memory bytes it's a numpy memmap on a temporary file next to the output
+    and tiles are pasted straight into it
+    .tif output is written strip by strip (BigTIFF if needed) => no size limit
+    Rotation mode warps and composites tiles on nthreads threads
+    """
+    def __init__(self,
+                 iindex,
+                 output_filename=None,
+                 max_memory=QUICK_PANO_MAX_MEMORY,
+                 nthreads=None):
         self.iindex = iindex
         self.verbose = False
+        self.max_memory = max_memory
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self.nthreads = nthreads
+        self.dst = None
+        self.dst_file = None
 
         if output_filename is None:
             d = os.path.join(iindex["dir"], "summary")
@@ -193,7 +335,10 @@ class QuickPano:
             assert os.path.exists(thisj["filename"]), thisj["filename"]
             self.cr2info[(col, row)] = thisj
 
-    def new_dst(self):
+    def calc_dims(self):
+        """
+        Return canvas (width, height) and set up image_coordinate()
+        """
         self.verbose and print('Calculating dimensions...')
 
         #with Image.open(fns_in[0]) as im0:
@@ -228,6 +373,10 @@ class QuickPano:
         self.verbose and print(
             f"Calculate image size: {global_width}w x {global_height}h")
         assert global_width > 0 and global_height > 0
+        return global_width, global_height
+
+    def new_dst(self):
+        global_width, global_height = self.calc_dims()
 
         if self.output_filename.find('.jpg') >= 0:
             if global_width >= 2**16 or global_height >= 2**16:
@@ -236,7 +385,58 @@ class QuickPano:
             if global_width * global_height >= 2**32:
                 raise HugeJPEG('Image exceeds maximum JPEG size')
 
-        self.dst = Image.new(im0.mode, (global_width, global_height))
+        self.channels = 1 if self.im0.mode == "L" else 3
+        shape = (global_height, global_width, self.channels)
+        if global_width * global_height * self.channels > self.max_memory:
+            # Not /tmp: might be RAM backed
+            dst_dir = os.path.dirname(os.path.abspath(self.output_filename))
+            self.dst_file = tempfile.NamedTemporaryFile(dir=dst_dir,
+                                                        prefix=".quick_pano_",
+                                                        suffix=".canvas")
+            # Sparse: starts out black without writing anything
+            self.dst = np.memmap(self.dst_file,
+                                 dtype=np.uint8,
+                                 mode="w+",
+                                 shape=shape)
+        else:
+            self.dst = np.zeros(shape, dtype=np.uint8)
+
+    def close_dst(self):
+        self.dst = None
+        if self.dst_file:
+            self.dst_file.close()
+            self.dst_file = None
+
+    def read_image(self, fn):
+        im = cv2.imread(
+            fn,
+            cv2.IMREAD_GRAYSCALE if self.channels == 1 else cv2.IMREAD_COLOR)
+        if im is None:
+            raise IOError(f"Failed to read {fn}")
+        if self.channels == 1:
+            im = im[:, :, None]
+        return im
+
+    def paste(self, im, x, y, mask=None):
+        """
+        Paste im (h x w x channels) with upper left at x, y, clipped to the canvas
+        mask: h x w, only paste where non-zero
+        """
+        left = max(x, 0)
+        top = max(y, 0)
+        right = min(x + im.shape[1], self.dst.shape[1])
+        bottom = min(y + im.shape[0], self.dst.shape[0])
+        if left >= right or top >= bottom:
+            return
+        src = im[top - y:bottom - y, left - x:right - x]
+        dst = self.dst[top:bottom, left:right]
+        if mask is None:
+            dst[:] = src
+        else:
+            np.copyto(dst,
+                      src,
+                      where=mask[top - y:bottom - y, left - x:right - x,
+                                 None].astype(bool))
 
     def image_coordinate(self, col, row):
         """
@@ -281,6 +481,19 @@ class QuickPano:
                                          {}).get("optics",
                                                  {}).get("rotation_ccw")
 
+    def placements(self):
+        """
+        Return list of (x, y, filename) in paste order (upper left ends up on top)
+        """
+        ret = []
+        for row in range(self.iindex["rows"]):
+            row = self.iindex["rows"] - row - 1
+            for col in range(self.iindex["cols"]):
+                col = self.iindex["cols"] - col - 1
+                x, y = self.image_coordinate(col, row)
+                ret.append((x, y, self.cr2info[(col, row)]["filename"]))
+        return ret
+
     def fill_dst_simple(self):
         """
         Paste images in simplified manner
@@ -297,76 +510,112 @@ class QuickPano:
                 info = self.cr2info[(col, row)]
                 x, y = self.image_coordinate(col, row)
                 self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im = Image.open(
+                im = self.read_image(
                     os.path.join(self.iindex["dir"], info["filename"]))
-                self.dst.paste(im, (x, y))
+                self.paste(im, x, y)
 
-    def fill_dst_rotate(self):
+    def plan_rotate(self):
+        """
+        Compute every tile's placement for rotation mode up front
+        Return rows of placements in paste order (upper left ends up on top)
+        Each placement: canvas rectangle (x, y, width, height)
+            and matrix mapping it back to the source image (cv2.WARP_INVERSE_MAP)
+        """
         overlaps = self.get_overlaps()
         rotation_ccw = self.get_rotation_ccw()
-        # print("overlaps", overlaps)
         # Half each side of image
         # Need a few percent of overlap to ensure no gaps
         # TODO: calculate this based on rotation
         trim_x = int(overlaps["x"]["overlap_pixels"] * 0.48)
         trim_y = int(overlaps["y"]["overlap_pixels"] * 0.48)
-        # print("x y", trim_x, trim_y)
-        # print("rotation_ccw", rotation_ccw)
-        orig_mode = self.dst.mode
-        # self.dst.putalpha(255)
-        self.dst = self.dst.convert('RGBA')
-        print('"Quick pano": slower w/ rotation')
-
-        # assert 0
+        rotated_w, rotated_h, matrix = rotation_inverse_map(
+            self.im0.width, self.im0.height, rotation_ccw)
 
+        ret = []
         # Fill from bottom up such that upper left is on top
         for row in range(self.iindex["rows"]):
-            print("  Row %u / %u" % (row + 1, self.iindex["rows"]))
             row = self.iindex["rows"] - row - 1
+            placements = []
             for col in range(self.iindex["cols"]):
                 col = self.iindex["cols"] - col - 1
-                # print("col", col, row)
-                #for this in self.iindex["images"].values():
-                # col, row = this["col"], this["row"]
                 info = self.cr2info[(col, row)]
                 x, y = self.image_coordinate(col, row)
-                self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im_orig = Image.open(
-                    os.path.join(self.iindex["dir"], info["filename"]))
-
-                im = im_orig.convert('RGBA')
-                # im.putalpha(255)
-                im = im.rotate(rotation_ccw, Image.BICUBIC, expand=True)
-                offset_x = 0
-                offset_y = 0
-                """
-                if rotation_ccw > 0:
-                    offset_x = -int(math.sin(rotation_ccw * 3.14 / 180) * im_orig.height)
-                else:
-                    offset_y = -int(math.sin(-rotation_ccw * 3.14 / 180) * im_orig.width)
-                print("offsets", offset_x, offset_y)
-                """
-
-                crop_x0 = 0
-                crop_x1 = im.width
-                crop_y0 = 0
-                crop_y1 = im.height
-                if col > 0:
-                    crop_x0 = trim_x
-                    offset_x += crop_x0
-                if row > 0:
-                    crop_y0 = trim_y
-                    offset_y += crop_y0
+                # Crop of the rotated image that gets pasted
+                crop_x0 = trim_x if col > 0 else 0
+                crop_y0 = trim_y if row > 0 else 0
+                crop_x1 = rotated_w
+                crop_y1 = rotated_h
                 if col < self.iindex["cols"] - 1:
                     crop_x1 -= trim_x
                 if row < self.iindex["rows"] - 1:
                     crop_y1 -= trim_y
-                # print("crop", crop_x0, crop_y0, crop_x1, crop_y1)
-                im = im.crop((crop_x0, crop_y0, crop_x1, crop_y1))
-                # print("paste", (x, y), (x + offset_x, y + offset_y))
+                this_matrix = matrix.copy()
+                this_matrix[:, 2] += matrix[:, 0:2] @ (crop_x0, crop_y0)
+                placements.append({
+                    "filename": info["filename"],
+                    "x": x + crop_x0,
+                    "y": y + crop_y0,
+                    "width": crop_x1 - crop_x0,
+                    "height": crop_y1 - crop_y0,
+                    "matrix": this_matrix,
+                })
+            ret.append(placements)
+        return ret
+
+    def warp_tile(self, placement):
+        """
+        Return (image, mask) ready to paste at placement
+        """
+        im = self.read_image(placement["filename"])
+        dsize = (placement["width"], placement["height"])
+        warped = cv2.warpAffine(im,
+                                placement["matrix"],
+                                dsize,
+                                flags=cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP,
+                                borderMode=cv2.BORDER_REPLICATE)
+        if self.channels == 1:
+            warped = warped[:, :, None]
+        # Like PIL: hard edge, pixels are in or out
+        mask = cv2.warpAffine(np.full(im.shape[0:2], 255, dtype=np.uint8),
+                              placement["matrix"],
+                              dsize,
+                              flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT,
+                              borderValue=0)
+        return warped, mask
+
+    def composite_band(self, tiles, y0, y1):
+        """
+        Paste the part of tiles (list of (placement, (image, mask))) within rows y0:y1
+        """
+        for placement, (im, mask) in tiles:
+            y = placement["y"]
+            top = max(y0, y)
+            bottom = min(y1, y + placement["height"])
+            if top < bottom:
+                self.paste(im[top - y:bottom - y],
+                           placement["x"],
+                           top,
+                           mask=mask[top - y:bottom - y])
 
-                self.dst.paste(im, (x + offset_x, y + offset_y), im)
-        self.dst = self.dst.convert(orig_mode)
+    def fill_dst_rotate(self):
+        print('"Quick pano": slower w/ rotation')
+        rows = self.plan_rotate()
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            for rowi, placements in enumerate(rows):
+                print("  Row %u / %u" % (rowi + 1, len(rows)))
+                tiles = list(
+                    zip(placements, executor.map(self.warp_tile, placements)))
+                # Tiles in a row overlap each other and must be pasted in order
+                # Bands of rows don't: composite those concurrently
+                y0 = min(placement["y"] for placement in placements)
+                y1 = max(placement["y"] + placement["height"]
+                         for placement in placements)
+                list(
+                    executor.map(
+                        lambda y: self.composite_band(
+                            tiles, y, min(y + QUICK_PANO_BAND_ROWS, y1)),
+                        range(y0, y1, QUICK_PANO_BAND_ROWS)))
 
     def fill_dst(self):
         if self.get_rotation_ccw():
@@ -376,26 +625,42 @@ class QuickPano:
 
     def save(self):
         self.verbose and print(('Saving %s...' % (self.output_filename, )))
-        try:
-            self.dst.save(self.output_filename, quality=95)
-        # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
-        #   return struct.pack(self._endian + fmt, *values)
-        # struct.error: 'L' format requires 0 <= number <= 4294967295
-        except struct.error:
+        height, width = self.dst.shape[0:2]
+        if os.path.splitext(self.output_filename)[1].lower() in (".tif",
+                                                                 ".tiff"):
+            # BigTIFF if needed: no more HugeTIF
+            with TIFFStripWriter(self.output_filename,
+                                 width,
+                                 height,
+                                 channels=self.channels) as tiff:
+                for y in range(0, height, QUICK_PANO_SAVE_ROWS):
+                    rows = self.dst[y:y + QUICK_PANO_SAVE_ROWS]
+                    if self.channels == 3:
+                        rows = rows[:, :, ::-1]
+                    tiff.write_rows(rows)
+            return
+        params = []
+        if self.output_filename.find('.jpg') >= 0:
+            params = [cv2.IMWRITE_JPEG_QUALITY, 95]
+        # Encoders work a row at a time: a memmap canvas isn't read in all at once
+        if not cv2.imwrite(self.output_filename, self.dst, params):
             try:
                 os.remove(self.output_filename)
             except OSError:
                 pass
-            raise HugeTIF("Failed to save image of size %uw x %uh" %
-                          (self.dst.width, self.dst.height))
+            raise HugeImage("Failed to save image of size %uw x %uh" %
+                            (width, height))
 
     def run(self):
         assert self.iindex[
             "flat"], "Single image only supported on final level image set"
         self.load_scan_json()
         self.new_dst()
-        self.fill_dst()
-        self.save()
+        try:
+            self.fill_dst()
+            self.save()
+        finally:
+            self.close_dst()
         self.verbose and print('Done!')
 
 
@@ -403,6 +668,494 @@ def write_quick_pano(*args, **kwargs):
     QuickPano(*args, **kwargs).run()
 
 
+"""
+Deep Zoom (DZI) pyramid
+A single full resolution preview of a large scan hits JPEG / TIFF size limits,
+takes minutes to encode and can't be opened by a browser
+Instead write tiles at every power of 2 scale for a viewer to load on demand
+
+Streams: the canvas is rendered top to bottom a band at a time
+and every level is built in the same pass from the one above it
+Memory is a band of decoded scan images plus about two tile rows per level
+"""
+
+DZI_TILE_SIZE = 254
+DZI_OVERLAP = 1
+# Tiles queued for writing per thread before rendering waits
+DZI_PENDING_PER_THREAD = 16
+
+
+class DZILevel:
+    """
+    Rolling band of one pyramid level
+    Only rows that unwritten tiles still need are kept
+    """
+    def __init__(self, pyramid, level, width, height):
+        self.pyramid = pyramid
+        self.level = level
+        self.width = width
+        self.height = height
+        # Rows kept, starting at row y0
+        self.band = None
+        self.y0 = 0
+        # Rows received so far
+        self.rows = 0
+        # Next tile row to write
+        self.tile_row = 0
+        # Odd row waiting for its pair before going to the next level
+        self.carry = None
+        self.dir = os.path.join(pyramid.files_dir, str(level))
+        os.makedirs(self.dir)
+
+    def add_rows(self, rows):
+        self.rows += len(rows)
+        assert self.rows <= self.height
+        if self.band is None or len(self.band) == 0:
+            self.band = rows
+        else:
+            self.band = np.concatenate((self.band, rows))
+        self.write_tile_rows()
+        if self.level:
+            self.reduce(rows)
+
+    def write_tile_rows(self):
+        tile_size = self.pyramid.tile_size
+        overlap = self.pyramid.overlap
+        while self.tile_row * tile_size < self.height:
+            top = max(0, self.tile_row * tile_size - overlap)
+            bottom = min(self.height,
+                         (self.tile_row + 1) * tile_size + overlap)
+            if self.rows < bottom:
+                return
+            band = self.band[top - self.y0:bottom - self.y0]
+            for col in range((self.width + tile_size - 1) // tile_size):
+                left = max(0, col * tile_size - overlap)
+                right = min(self.width, (col + 1) * tile_size + overlap)
+                self.pyramid.write_tile(
+                    os.path.join(
+                        self.dir, "%u_%u.%s" %
+                        (col, self.tile_row, self.pyramid.format)),
+                    band[:, left:right])
+            self.tile_row += 1
+            # Next tile row starts overlap rows up
+            drop = max(0, self.tile_row * tile_size - overlap) - self.y0
+            self.band = self.band[drop:]
+            self.y0 += drop
+
+    def reduce(self, rows, final=False):
+        """
+        Halve rows into the next level down
+        final: no more rows are coming, duplicate an unpaired last row
+        """
+        if self.carry is not None:
+            rows = np.concatenate((self.carry, rows))
+            self.carry = None
+        if len(rows) % 2:
+            if final:
+                rows = np.concatenate((rows, rows[-1:]))
+            else:
+                self.carry = rows[-1:]
+                rows = rows[:-1]
+        if not len(rows):
+            return
+        if rows.shape[1] % 2:
+            rows = np.concatenate((rows, rows[:, -1:]), axis=1)
+        # Exact 2 x 2 box filter
+        self.pyramid.levels[self.level - 1].add_rows(
+            cv2.resize(rows, (rows.shape[1] // 2, len(rows) // 2),
+                       interpolation=cv2.INTER_AREA))
+
+
+class DeepZoomPyramid:
+    """
+    Streaming .dzi writer
+    Feed full resolution BGR rows top to bottom with add_rows() then finish()
+    Tiles are encoded and written by a thread pool
+    """
+    def __init__(self,
+                 dzi_fn,
+                 width,
+                 height,
+                 tile_size=DZI_TILE_SIZE,
+                 overlap=DZI_OVERLAP,
+                 quality=90,
+                 executor=None,
+                 nthreads=None):
+        self.dzi_fn = dzi_fn
+        self.files_dir = os.path.splitext(dzi_fn)[0] + "_files"
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.format = "jpg"
+        self.quality = quality
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self.executor = executor
+        self.own_executor = executor is None
+        if self.own_executor:
+            self.executor = ThreadPoolExecutor(max_workers=nthreads)
+        self.max_pending = DZI_PENDING_PER_THREAD * nthreads
+        self.pending = collections.deque()
+
+        # Stale tiles from a previous (ex: larger) pyramid
+        if os.path.exists(self.files_dir):
+            shutil.rmtree(self.files_dir)
+        # Level 0 is 1 x 1 pixel
+        self.max_level = int(math.ceil(math.log2(max(width, height, 1))))
+        self.levels = {}
+        for level in range(self.max_level + 1):
+            scale = 2**(self.max_level - level)
+            self.levels[level] = DZILevel(self, level,
+                                          (width + scale - 1) // scale,
+                                          (height + scale - 1) // scale)
+
+    def write_tile(self, fn, tile):
+        # Tiles are views into bands that are never modified in place
+        self.pending.append(
+            self.executor.submit(cv2.imwrite, fn, tile,
+                                 [cv2.IMWRITE_JPEG_QUALITY, self.quality]))
+        while len(self.pending) > self.max_pending:
+            self.wait_tile()
+
+    def wait_tile(self):
+        if not self.pending.popleft().result():
+            raise IOError("Failed to write tile")
+
+    def add_rows(self, rows):
+        # Bound what levels concatenate onto their bands
+        for i in range(0, len(rows), self.tile_size):
+            self.levels[self.max_level].add_rows(rows[i:i + self.tile_size])
+
+    def finish(self):
+        for level in range(self.max_level, 0, -1):
+            this = self.levels[level]
+            assert this.rows == this.height, (level, this.rows, this.height)
+            this.reduce(this.band[0:0], final=True)
+        while self.pending:
+            self.wait_tile()
+        if self.own_executor:
+            self.executor.shutdown()
+        # Last: a .dzi means the pyramid is complete
+        with open(self.dzi_fn, "w") as f:
+            f.write(f"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+    Format="{self.format}" Overlap="{self.overlap}"
+    TileSize="{self.tile_size}">
+    <Size Width="{self.width}" Height="{self.height}"/>
+</Image>
+""")
+
+
+def read_dzi(dzi_fn):
+    root = ElementTree.parse(dzi_fn).getroot()
+    size = root.find("{http://schemas.microsoft.com/deepzoom/2008}Size")
+    return {
+        "width": int(size.get("Width")),
+        "height": int(size.get("Height")),
+        "tileSize": int(root.get("TileSize")),
+        "overlap": int(root.get("Overlap")),
+        "format": root.get("Format"),
+    }
+
+
+def read_bgr(fn):
+    im = cv2.imread(fn, cv2.IMREAD_COLOR)
+    if im is None:
+        raise IOError(f"Failed to read {fn}")
+    return im
+
+
+def render_rows(placements, width, height, image_size, band_height, executor):
+    """
+    placements: list of (x, y, filename), later ones on top
+    image_size: (w, h) of every image
+    Yield canvas bands top to bottom
+    Each image is decoded once, in parallel, and dropped once passed
+    """
+    image_w, image_h = image_size
+    # placements index => image
+    decoded = {}
+    for y0 in range(0, height, band_height):
+        y1 = min(height, y0 + band_height)
+        want = [
+            i for i, (_x, y, _fn) in enumerate(placements)
+            if y < y1 and y + image_h > y0 and i not in decoded
+        ]
+        for i, im in zip(
+                want, executor.map(read_bgr,
+                                   [placements[i][2] for i in want])):
+            decoded[i] = im
+        band = np.zeros((y1 - y0, width, 3), dtype=np.uint8)
+        for i in sorted(decoded):
+            x, y, _fn = placements[i]
+            im = decoded[i]
+            # Clip to band
+            top = max(y, y0)
+            bottom = min(y + im.shape[0], y1)
+            left = max(x, 0)
+            right = min(x + im.shape[1], width)
+            if top < bottom and left < right:
+                band[top - y0:bottom - y0, left:right] = im[top - y:bottom - y,
+                                                            left - x:right - x]
+        yield band
+        for i in [i for i in decoded if placements[i][1] + image_h <= y1]:
+            del decoded[i]
+
+
+def grid_placements(iindex, image_size, spacing=0):
+    """
+    Like write_snapshot_grid()
+    Return (width, height, placements)
+    """
+    image_w, image_h = image_size
+    placements = []
+    for this in iindex["images"].values():
+        # lower left vs uppper left coordinate systems
+        row0 = iindex["rows"] - this["row"] - 1
+        placements.append(
+            ((image_w + spacing) * this["col"], (image_h + spacing) * row0,
+             os.path.join(iindex["dir"], this["basename"])))
+    w = image_w * iindex["cols"] + spacing * (iindex["cols"] - 1)
+    h = image_h * iindex["rows"] + spacing * (iindex["rows"] - 1)
+    return w, h, placements
+
+
+def write_dzi_pyramid(iindex,
+                      output_filename=None,
+                      layout="pano",
+                      tile_size=DZI_TILE_SIZE,
+                      overlap=DZI_OVERLAP,
+                      quality=90,
+                      nthreads=None):
+    """
+    Write a Deep Zoom pyramid of the final level image set
+    layout
+        pano: images at their scan positions like QuickPano (rotation not applied)
+            Falls back to grid if the scan JSON isn't available
+        grid: edge to edge by column / row
+    Return .dzi file name. Tiles are in <name>_files next to it
+    """
+    assert iindex["flat"], "Pyramid only supported on final level image set"
+    if output_filename is None:
+        d = os.path.join(iindex["dir"], "summary")
+        if not os.path.exists(d):
+            os.mkdir(d)
+        output_filename = os.path.join(d, "pano.dzi")
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+
+    this0 = iindex["crs"][(0, 0)]
+    with Image.open(os.path.join(iindex["dir"], this0["basename"])) as im0:
+        image_size = im0.size
+
+    placements = None
+    if layout == "pano":
+        pano = QuickPano(iindex, output_filename=output_filename)
+        try:
+            pano.load_scan_json()
+        except Exception as e:
+            print(f"WARNING: pyramid falling back to grid layout: {e}")
+        else:
+            if pano.get_rotation_ccw():
+                print("WARNING: pyramid doesn't apply rotation")
+            width, height = pano.calc_dims()
+            placements = pano.placements()
+    elif layout != "grid":
+        raise ValueError(f"Unknown layout {layout}")
+    if placements is None:
+        width, height, placements = grid_placements(iindex, image_size)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        pyramid = DeepZoomPyramid(output_filename,
+                                  width,
+                                  height,
+                                  tile_size=tile_size,
+                                  overlap=overlap,
+                                  quality=quality,
+                                  executor=executor,
+                                  nthreads=nthreads)
+        for band in render_rows(placements, width, height, image_size,
+                                image_size[1], executor):
+            pyramid.add_rows(band)
+        pyramid.finish()
+    return output_filename
+
+
+def write_dzi_viewer(dzi_fn, output_filename):
+    """
+    Self contained: no network access needed
+    """
+    dzi = read_dzi(dzi_fn)
+    files_dir = os.path.splitext(dzi_fn)[0] + "_files"
+    dzi["url"] = os.path.relpath(
+        files_dir, os.path.dirname(os.path.abspath(output_filename))) + "/"
+    out = """\
+<!DOCTYPE html>
+<html lang="en">
+
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Labsmore Deep Zoom View</title>
+    <style>
+        html,
+        body {
+            margin: 0;
+            height: 100%;
+            overflow: hidden;
+            background-color: #000000;
+        }
+
+        #viewer {
+            position: absolute;
+            inset: 0;
+            overflow: hidden;
+            cursor: grab;
+            touch-action: none;
+        }
+
+        #viewer img {
+            position: absolute;
+            user-select: none;
+            -webkit-user-drag: none;
+        }
+
+        #info {
+            position: absolute;
+            left: 8px;
+            top: 8px;
+            z-index: 100;
+            font-family: Arial, Helvetica, sans-serif;
+            color: gray;
+        }
+    </style>
+</head>
+
+<body>
+    <div id="viewer"></div>
+    <div id="info">
+        Labsmore Deep Zoom Viewer:
+        drag to pan, scroll to zoom, double click to fit
+    </div>
+    <script>
+(function() {
+    const dzi = DZI_JSON;
+    const viewer = document.getElementById("viewer");
+    const maxLevel = Math.ceil(Math.log2(Math.max(dzi.width, dzi.height, 1)));
+    // Always loaded underneath so that there is no blank area while tiles load
+    // Level n is at most 2^n pixels
+    const coarseLevel = Math.min(maxLevel, 10);
+    // Screen pixels per image pixel, image pixel at the upper left of the viewer
+    let scale = 1, originX = 0, originY = 0;
+    // "level/col_row" => img
+    const tiles = new Map();
+
+    function showLevel(level, want) {
+        const levelScale = Math.pow(2, maxLevel - level);
+        const width = Math.ceil(dzi.width / levelScale);
+        const height = Math.ceil(dzi.height / levelScale);
+        const size = dzi.tileSize;
+        const col0 = Math.max(0, Math.floor(originX / levelScale / size));
+        const row0 = Math.max(0, Math.floor(originY / levelScale / size));
+        const col1 = Math.min(Math.ceil(width / size) - 1,
+            Math.floor((originX + viewer.clientWidth / scale) / levelScale / size));
+        const row1 = Math.min(Math.ceil(height / size) - 1,
+            Math.floor((originY + viewer.clientHeight / scale) / levelScale / size));
+        for (let row = row0; row <= row1; row++) {
+            for (let col = col0; col <= col1; col++) {
+                const key = level + "/" + col + "_" + row;
+                let img = tiles.get(key);
+                if (!img) {
+                    img = document.createElement("img");
+                    img.src = dzi.url + key + "." + dzi.format;
+                    img.style.zIndex = level;
+                    viewer.appendChild(img);
+                    tiles.set(key, img);
+                }
+                // Level pixels, overlap included
+                const x0 = Math.max(0, col * size - dzi.overlap);
+                const y0 = Math.max(0, row * size - dzi.overlap);
+                const x1 = Math.min(width, (col + 1) * size + dzi.overlap);
+                const y1 = Math.min(height, (row + 1) * size + dzi.overlap);
+                img.style.left = (x0 * levelScale - originX) * scale + "px";
+                img.style.top = (y0 * levelScale - originY) * scale + "px";
+                img.style.width = (x1 - x0) * levelScale * scale + "px";
+                img.style.height = (y1 - y0) * levelScale * scale + "px";
+                want.add(key);
+            }
+        }
+    }
+
+    function render() {
+        // About one level pixel per screen pixel
+        const level = Math.max(0, Math.min(maxLevel,
+            maxLevel + Math.ceil(Math.log2(scale * window.devicePixelRatio))));
+        const want = new Set();
+        showLevel(Math.min(level, coarseLevel), want);
+        showLevel(level, want);
+        for (const [key, img] of tiles) {
+            if (!want.has(key)) {
+                img.remove();
+                tiles.delete(key);
+            }
+        }
+    }
+
+    function fitScale() {
+        return Math.min(viewer.clientWidth / dzi.width, viewer.clientHeight / dzi.height);
+    }
+
+    function fit() {
+        scale = fitScale();
+        originX = (dzi.width - viewer.clientWidth / scale) / 2;
+        originY = (dzi.height - viewer.clientHeight / scale) / 2;
+        render();
+    }
+
+    let drag = null;
+    viewer.addEventListener("pointerdown", function(e) {
+        drag = {x: e.clientX, y: e.clientY};
+        viewer.setPointerCapture(e.pointerId);
+    });
+    viewer.addEventListener("pointermove", function(e) {
+        if (!drag) {
+            return;
+        }
+        originX -= (e.clientX - drag.x) / scale;
+        originY -= (e.clientY - drag.y) / scale;
+        drag = {x: e.clientX, y: e.clientY};
+        render();
+    });
+    viewer.addEventListener("pointerup", function(e) {
+        drag = null;
+    });
+    viewer.addEventListener("wheel", function(e) {
+        e.preventDefault();
+        // Keep the image pixel under the cursor in place
+        const rect = viewer.getBoundingClientRect();
+        const x = e.clientX - rect.left, y = e.clientY - rect.top;
+        const imageX = originX + x / scale, imageY = originY + y / scale;
+        scale *= Math.pow(2, -Math.max(-300, Math.min(300, e.deltaY)) / 300);
+        scale = Math.max(fitScale() / 4, Math.min(8, scale));
+        originX = imageX - x / scale;
+        originY = imageY - y / scale;
+        render();
+    }, {passive: false});
+    viewer.addEventListener("dblclick", fit);
+    window.addEventListener("resize", render);
+    fit();
+})();
+    </script>
+</body>
+
+</html>
+""".replace("DZI_JSON", json.dumps(dzi))
+    with open(output_filename, "w") as f:
+        f.write(out)
+
+
 def main():
     import argparse
 
@@ -410,13 +1163,18 @@ def main():
     add_bool_arg(parser, "--html", default=True)
     add_bool_arg(parser, "--snapshot-grid", default=True)
     add_bool_arg(parser, "--quick-pano", default=True)
+    add_bool_arg(parser, "--pyramid", default=False)
     parser.add_argument("dir_in")
     args = parser.parse_args()
 
     iindex = index_scan_images(args.dir_in)
 
+    dzi_fn = None
+    if args.pyramid:
+        dzi_fn = write_dzi_pyramid(iindex)
+
     if args.html:
-        write_html_viewer(iindex)
+        write_html_viewer(iindex, dzi_fn=dzi_fn)
 
     if args.snapshot_grid:
         write_snapshot_grid(iindex)
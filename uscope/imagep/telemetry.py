@@ -0,0 +1,200 @@
+"""
+Per task resource accounting for CSImageProcessor
+
+TaskMeter runs where the plugin runs (worker thread or worker process) and measures:
+-cpu_s: CPU time of the worker thread (process in process mode)
+-subprocess_cpu_s: CPU time of reaped subprocesses (ex: enfuse)
+    Process wide: approximate when several worker threads spawn at once
+-read_bytes / write_bytes: read() / write() syscall bytes
+-maxrss_delta: how much the task raised the peak RSS
+-subprocesses: number of processes spawned (see count_subprocess())
+The dispatcher adds:
+-queue_s: time from queued to started
+-wall_s: start to finish
+
+ProcessingTelemetry collects results for a scan:
+-processing_telemetry.jsonl: one line per task, then one per stage at the end
+-summary() for processing.json
+"""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+TELEMETRY_FN = "processing_telemetry.jsonl"
+
+_local = threading.local()
+
+
+def count_subprocess():
+    """
+    Plugins call this right before spawning a process (ex: enfuse)
+    Counted against the task running on this thread
+    """
+    _local.spawns = getattr(_local, "spawns", 0) + 1
+
+
+def read_proc_io(fn):
+    """
+    Return (rchar, wchar) or (None, None) if unsupported (ex: not Linux)
+    """
+    try:
+        with open(fn, "r") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def maxrss_bytes():
+    # Linux reports KiB, macOS bytes
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss * 1024
+
+
+class TaskMeter:
+    """
+    Call start() and stop() from the thread running the task
+    per_thread: CPU / IO of only this thread (worker threads)
+        otherwise of the whole process (worker processes)
+    """
+    def __init__(self, per_thread=True):
+        self.per_thread = per_thread
+
+    def cpu_time(self):
+        if self.per_thread:
+            return time.thread_time()
+        return time.process_time()
+
+    def children_cpu_time(self):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def io(self):
+        if self.per_thread:
+            return read_proc_io("/proc/thread-self/io")
+        return read_proc_io("/proc/self/io")
+
+    def start(self):
+        self.cpu0 = self.cpu_time()
+        self.children_cpu0 = self.children_cpu_time()
+        self.rchar0, self.wchar0 = self.io()
+        self.maxrss0 = maxrss_bytes()
+        self.spawns0 = getattr(_local, "spawns", 0)
+
+    def stop(self):
+        """
+        Return dict of counters since start()
+        """
+        rchar, wchar = self.io()
+        ret = {
+            "cpu_s": self.cpu_time() - self.cpu0,
+            "subprocess_cpu_s":
+            self.children_cpu_time() - self.children_cpu0,
+            "maxrss_delta": maxrss_bytes() - self.maxrss0,
+            "subprocesses": getattr(_local, "spawns", 0) - self.spawns0,
+            "read_bytes": None,
+            "write_bytes": None,
+        }
+        if rchar is not None and self.rchar0 is not None:
+            ret["read_bytes"] = rchar - self.rchar0
+            ret["write_bytes"] = wchar - self.wchar0
+        return ret
+
+
+# Summed across tasks in a stage
+SUM_FIELDS = ("wall_s", "cpu_s", "subprocess_cpu_s", "queue_s", "read_bytes",
+              "write_bytes", "subprocesses")
+
+
+class ProcessingTelemetry:
+    def __init__(self, directory, log=None):
+        if log is None:
+
+            def log(s):
+                print(s)
+
+        self.log = log
+        self.fn = os.path.join(directory, TELEMETRY_FN)
+        self.lock = threading.Lock()
+        # Tells apart appended runs
+        self.run_start = time.time()
+        # stage => aggregate dict
+        self.stages = {}
+
+    def write(self, j):
+        try:
+            with open(self.fn, "a") as f:
+                f.write(json.dumps(j, sort_keys=True) + "\n")
+        except OSError as e:
+            self.log(f"WARNING: failed to write telemetry: {e}")
+
+    def record(self, stage, fn_out, result, telemetry):
+        """
+        stage: plugin name or list of plugin names (fused chain)
+        telemetry: CSIPParams.telemetry
+        """
+        if not isinstance(stage, str):
+            stage = "+".join(stage)
+        j = dict(telemetry,
+                 type="task",
+                 run=self.run_start,
+                 stage=stage,
+                 output=fn_out,
+                 result=result)
+        with self.lock:
+            self.write(j)
+            agg = self.stages.get(stage)
+            if agg is None:
+                agg = {k: 0 for k in SUM_FIELDS}
+                agg.update({
+                    "tasks": 0,
+                    "failed": 0,
+                    "maxrss_delta_max": 0,
+                    "start": telemetry["start"],
+                    "end": telemetry["end"],
+                })
+                self.stages[stage] = agg
+            agg["tasks"] += 1
+            if result != "ok":
+                agg["failed"] += 1
+            for k in SUM_FIELDS:
+                if telemetry.get(k) is not None:
+                    agg[k] += telemetry[k]
+            agg["maxrss_delta_max"] = max(
+                agg["maxrss_delta_max"],
+                telemetry.get("maxrss_delta") or 0)
+            agg["start"] = min(agg["start"], telemetry["start"])
+            agg["end"] = max(agg["end"], telemetry["end"])
+
+    def summary(self):
+        """
+        Per stage aggregates
+        elapsed_s: first task start to last task end
+        Return None if nothing was recorded
+        """
+        with self.lock:
+            if not self.stages:
+                return None
+            ret = {}
+            for stage, agg in self.stages.items():
+                agg = dict(agg)
+                agg["elapsed_s"] = agg.pop("end") - agg.pop("start")
+                ret[stage] = agg
+            return ret
+
+    def finish(self):
+        """
+        Append per stage aggregates to the log and return summary()
+        """
+        summary = self.summary()
+        if summary:
+            for stage, agg in summary.items():
+                self.write(
+                    dict(agg, type="stage", run=self.run_start, stage=stage))
+        return summary
@@ -0,0 +1,88 @@
+"""
+Reduced resolution copies of scan images for the summary outputs
+
+The snapshot grid and HTML viewer only need a few hundred pixels per image
+Decoding every full resolution image to scale it down was most of their cost
+and the HTML viewer made the browser download every full resolution image
+-JPEG: the decoder scales (DCT, draft()), much faster than a full decode
+-Other formats: box reduced (reduce()) before the final resample
+Thumbnails are made in parallel and kept in <scan>/thumbnails/<size>/
+so later summaries and viewer loads reuse them
+A thumbnail is remade when its image is newer
+"""
+
+from uscope.imagep.codec import load_image
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import multiprocessing
+import os
+
+THUMBNAIL_DIR = "thumbnails"
+# Longest side. The HTML viewer shows them at 110 px: leaves room for high DPI
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 85
+
+
+def thumbnail_dir(scan_dir, size=THUMBNAIL_SIZE):
+    return os.path.join(scan_dir, THUMBNAIL_DIR, str(size))
+
+
+def thumbnail_fn(scan_dir, basename, size=THUMBNAIL_SIZE):
+    return os.path.join(thumbnail_dir(scan_dir, size),
+                        os.path.splitext(basename)[0] + ".jpg")
+
+
+def load_reduced(fn, size):
+    """
+    Return fn as a PIL image whose longest side is at most size
+    Same aspect ratio. Never scaled up
+    """
+    im = load_image(fn)
+    # Does draft() / reduce() itself
+    # Default reducing_gap adds a costly resample from twice the size
+    im.thumbnail((size, size), Image.BOX, reducing_gap=1.0)
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    return im
+
+
+def make_thumbnail(fn, thumb_fn, size=THUMBNAIL_SIZE):
+    im = load_reduced(fn, size)
+    # Don't leave a partial thumbnail behind if interrupted
+    tmp_fn = thumb_fn + ".tmp"
+    im.save(tmp_fn, format="JPEG", quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_fn, thumb_fn)
+
+
+def is_fresh(fn, thumb_fn):
+    try:
+        return os.stat(thumb_fn).st_mtime_ns >= os.stat(fn).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def get_thumbnails(iindex, size=THUMBNAIL_SIZE, nthreads=None):
+    """
+    Make any missing or stale thumbnails for an image set
+    Return basename => thumbnail file name
+    """
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    scan_dir = iindex["dir"]
+    os.makedirs(thumbnail_dir(scan_dir, size), exist_ok=True)
+    ret = {}
+    # (image, thumbnail)
+    todo = []
+    for basename in iindex["images"]:
+        fn = os.path.join(scan_dir, basename)
+        thumb_fn = thumbnail_fn(scan_dir, basename, size)
+        ret[basename] = thumb_fn
+        if not is_fresh(fn, thumb_fn):
+            todo.append((fn, thumb_fn))
+    if todo:
+        print(f"Making {len(todo)} / {len(ret)} thumbnails...")
+        with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+            for _ret in executor.map(
+                    lambda this: make_thumbnail(*this, size=size), todo):
+                pass
+    return ret
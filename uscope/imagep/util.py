@@ -1,33 +1,63 @@
-import time
 import os
+import threading
+import heapq
 from PIL import Image, UnidentifiedImageError
 import subprocess
 import tempfile
 import shutil
-import re
-# 2024-02-29: this package keeps being problematic
-try:
-    import pyzbar
-except ImportError:
-    pyzbar = None
-    print("WARNING: failed to import pyzbar")
+import numpy as np
+from multiprocessing import shared_memory
+from uscope.imagep.codec import save_image, load_image, is_npy, image_exif, unshare
+# Moved, still imported from here
+from uscope.imagep.qr import find_qr_code_match
+from uscope.imagep.validate import check_valid_image_dir
 
 # Rayleigh criterion
 # https://oeis.org/A245461
 RC_CONST = 1.21966989
 
 
+def make_temp_filename(temp_dir=None, suffix=".tif"):
+    """
+    Allocate a unique temporary filename
+    Thread (and process) safe: the file is created empty to reserve the name
+    """
+    fd, fn = tempfile.mkstemp(prefix="ethereal_", suffix=suffix, dir=temp_dir)
+    os.close(fd)
+    return fn
+
+
+def npf2im(statef):
+    """
+    Float h x w x 3 numpy array => 8 bit RGB PIL image
+    Values are rounded and clipped to 0 to 255
+    """
+    return Image.fromarray(
+        np.clip(np.rint(statef), 0, 255).astype(np.uint8), "RGB")
+
+
 class EtherealImageR:
     """
     An image that may be on filesystem or in memory
     User tells it what it wants it will munge it into place
     Read only
     """
-    def __init__(self, im=None, fn=None, meta=None):
+    def __init__(self,
+                 im=None,
+                 fn=None,
+                 meta=None,
+                 temp_dir=None,
+                 save_kwargs=None):
         self.im = im
         self.fn = fn
+        # In memory image: how the plugin that made it wanted it saved
+        # See EtherealImageW.get_save_kwargs()
+        self.save_kwargs = save_kwargs or {}
         self.tmp_files = set()
         self.meta = meta
+        # Where to put a file if an in memory image needs one
+        self.temp_dir = temp_dir
+        self.temp_fn = None
 
     def __del__(self):
         self.flush()
@@ -39,15 +69,31 @@ class EtherealImageR:
         for fn in self.tmp_files:
             os.unlink(fn)
         self.tmp_files.clear()
+        self.temp_fn = None
 
     def get_filename(self):
         """
         Return any valid filename
+        In memory images are only written out the first time this is called
+        Intended for plugins that really need a file such as external CLI tools
         """
-        if self.fn:
+        if self.fn and not is_npy(self.fn):
             return self.fn
+        elif self.im or self.fn:
+            # In memory or a format other programs can't read
+            if self.temp_fn is None:
+                im = self.to_im()
+                self.temp_fn = make_temp_filename(self.temp_dir)
+                self.tmp_files.add(self.temp_fn)
+                kwargs = {}
+                # Ex: chained stabilization => luminance HDR needs exposure
+                exif = im.info.get("exif")
+                if exif:
+                    kwargs["exif"] = exif
+                im.save(self.temp_fn, **kwargs)
+            return self.temp_fn
         else:
-            assert 0, "FIXME"
+            assert 0, "No image"
 
     def to_filename(self, fn):
         """
@@ -57,7 +103,7 @@ class EtherealImageR:
         """
         assert fn not in self.tmp_files
         if self.im:
-            self.im.write(fn)
+            self.im.save(fn)
         else:
             os.symlink(self.fn, fn)
         self.tmp_files.add(fn)
@@ -66,11 +112,13 @@ class EtherealImageR:
         """
         Ensure resulting file is a .tif, converting if necessary
         """
-        if self.fn:
-            subprocess.check_call(["convert", self.fn, fn])
-            assert os.path.exists(fn)
-        elif self.im:
-            self.im.write(fn)
+        if self.im or self.fn:
+            im = self.to_im()
+            exif = image_exif(im)
+            if exif:
+                im.save(fn, format="TIFF", exif=exif)
+            else:
+                im.save(fn, format="TIFF")
         else:
             assert 0
 
@@ -87,7 +135,7 @@ class EtherealImageR:
         if self.im:
             return self.im
         else:
-            return Image.open(self.fn)
+            return load_image(self.fn)
 
     def to_mutable_im(self):
         """
@@ -96,41 +144,70 @@ class EtherealImageR:
         if self.im:
             return self.im.copy()
         else:
-            return Image.open(self.fn)
+            return load_image(self.fn)
+
+    def encode(self, shms):
+        """
+        Return a small picklable description for handing off to a worker process
+        In memory images are copied into shared memory
+        Newly allocated blocks are appended to shms and are owned by the caller
+        """
+        if self.im:
+            shm, desc = image_to_shm(self.im)
+            shms.append(shm)
+            return {
+                "im": desc,
+                "meta": self.meta,
+                "temp_dir": self.temp_dir,
+                "save_kwargs": self.save_kwargs
+            }
+        else:
+            return {"fn": self.fn, "meta": self.meta}
+
+    @staticmethod
+    def decode(j):
+        if "im" in j:
+            return EtherealImageR(im=image_from_shm(j["im"]),
+                                  meta=j["meta"],
+                                  temp_dir=j["temp_dir"],
+                                  save_kwargs=j["save_kwargs"])
+        else:
+            return EtherealImageR(fn=j["fn"], meta=j["meta"])
 
 
 class EtherealImageW:
     """
     An image that will be written to output
     User gives some hints as to how it would like the image to be output
-    FIXME: filename centric. Allow setting an Image
-    This mostly works as we currently write all intermediate images anyway
-    """
-
-    temp_images = 0
-
-    # NOTE: this is thread safe because EtherealImageW()s are constructed in the queing process
-    # from the controller
-    # However it would be ideal to make this thread safe
-    @staticmethod
-    def get_image_id():
-        EtherealImageW.temp_images += 1
-        return EtherealImageW.temp_images
 
+    Plugins should hand over their result with set_im()
+    want_fn: image is written to the given file
+    want_im: image is kept in memory and returned by get_im()
+        Plugins that can only write a file (ex: external CLI tools)
+        may still call get_filename() and a temporary file is used instead
+    """
     def __init__(self,
                  want_dir=None,
                  want_basename=None,
                  want_fn=None,
                  want_im=False,
                  meta=None,
-                 temp_dir=None):
+                 temp_dir=None,
+                 save_kwargs={}):
         # for now assume will get the desired output file name
         self.im = None
         self.want_fn = None
         self.temp_filename = None
+        # Plugin wrote here, commit() converts to want_fn
+        self.convert_fn = None
+        self.temp_dir = temp_dir
         self.want_im = False
-
-        tempfile.TemporaryDirectory()
+        # Defaults for PIL save(). Ex: TIFF compression. See uscope.imagep.codec
+        self.save_kwargs = save_kwargs
+        # set_im() kwargs of earlier in memory stages. See inherit_save_kwargs()
+        self.inherited_kwargs = {}
+        # want_im: set_im() kwargs, applied whenever the image is finally saved
+        self.im_kwargs = {}
 
         if want_fn:
             self.want_fn = want_fn
@@ -138,19 +215,235 @@ class EtherealImageW:
             self.want_fn = os.path.join(want_dir, want_basename)
         elif want_im:
             self.want_im = True
-            assert temp_dir
-            self.temp_filename = os.path.join(
-                temp_dir, "ethereal_%u04u.tif" % EtherealImageW.get_image_id())
-            self.want_fn = self.temp_filename
         else:
             assert 0, "Unknown operating mode"
         self.meta = meta
 
     def get_filename(self):
+        """
+        Return the filename the plugin should write to
+        """
+        if self.want_im and self.want_fn is None:
+            self.temp_filename = make_temp_filename(self.temp_dir)
+            self.want_fn = self.temp_filename
+        if is_npy(self.want_fn):
+            # Other programs can't write this
+            if self.convert_fn is None:
+                self.convert_fn = make_temp_filename(self.temp_dir)
+            return self.convert_fn
+        # Written in place by whatever the plugin uses (ex: CLI tool)
+        # Must not go through to a hardlinked source
+        unshare(self.want_fn)
         return self.want_fn
 
+    def commit(self):
+        """
+        Called once the plugin is done writing
+        """
+        if self.convert_fn:
+            save_image(load_image(self.convert_fn), self.want_fn)
+            os.unlink(self.convert_fn)
+            self.convert_fn = None
+
+    def set_im(self, im, **kwargs):
+        """
+        Hand over the result image
+        kwargs are passed to PIL save() when the image goes to disk
+        want_im: they're kept for the final save, see get_save_kwargs()
+        im may be a 16 bit numpy array if the image goes to a file
+        """
+        if self.want_im:
+            if isinstance(im, np.ndarray):
+                raise ValueError("16 bit images can only be written to a file")
+            self.im = im
+            self.im_kwargs = kwargs
+            # Keep metadata with the image for whoever reads it next
+            exif = self.get_save_kwargs().get("exif")
+            if exif is not None:
+                im.info["exif"] = exif
+        else:
+            save_kwargs = dict(self.save_kwargs, **self.inherited_kwargs)
+            save_kwargs.update(kwargs)
+            save_image(im, self.want_fn, **save_kwargs)
+
+    def inherit_save_kwargs(self, images):
+        """
+        Carry save kwargs of in memory input images (EtherealImageR) over
+        to wherever this image ends up
+        The first image wins, like plugins taking EXIF from the first image
+        The plugin's own set_im() kwargs still take priority
+        """
+        kwargs = {}
+        for image in reversed(images):
+            kwargs.update(image.save_kwargs)
+        self.inherited_kwargs = kwargs
+
+    def get_save_kwargs(self):
+        """
+        Return the kwargs the image should be saved with
+        Pass to the EtherealImageR made from get_im() to keep them in a chain
+        """
+        return dict(self.inherited_kwargs, **self.im_kwargs)
+
     def get_im(self):
-        return Image.open(self.want_fn)
+        """
+        Return the resulting image
+        """
+        if self.im is None:
+            # Plugin wrote a file. Pull it in so the temp file can go away
+            im = load_image(self.want_fn)
+            im.load()
+            if self.temp_filename:
+                os.unlink(self.temp_filename)
+                self.temp_filename = None
+                self.want_fn = None
+            if not self.want_im:
+                return im
+            self.im = im
+        return self.im
+
+    def encode(self):
+        """
+        Return a small picklable description for handing off to a worker process
+        """
+        if self.want_im:
+            return {
+                "want_im": True,
+                "meta": self.meta,
+                "temp_dir": self.temp_dir,
+                "inherited_kwargs": self.inherited_kwargs
+            }
+        else:
+            return {
+                "want_fn": self.want_fn,
+                "meta": self.meta,
+                "save_kwargs": self.save_kwargs,
+                "inherited_kwargs": self.inherited_kwargs
+            }
+
+    @staticmethod
+    def decode(j):
+        if j.get("want_im"):
+            ret = EtherealImageW(want_im=True,
+                                 meta=j["meta"],
+                                 temp_dir=j["temp_dir"])
+        else:
+            ret = EtherealImageW(want_fn=j["want_fn"],
+                                 meta=j["meta"],
+                                 save_kwargs=j["save_kwargs"])
+        ret.inherited_kwargs = j["inherited_kwargs"]
+        return ret
+
+
+def image_to_shm(im):
+    """
+    Copy a PIL image into a newly allocated shared memory block
+    Return (SharedMemory, descriptor)
+    The descriptor is picklable and is what gets sent to the other process
+    Caller must close() and unlink() the block when the task is done
+    """
+    arr = np.asarray(im)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    dst = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    dst[...] = arr
+    del dst
+    return shm, {
+        "shm": shm.name,
+        "shape": arr.shape,
+        "dtype": arr.dtype.str,
+        "mode": im.mode,
+    }
+
+
+def image_from_shm(desc, unlink=False):
+    """
+    Attach to a block created by image_to_shm() and return a private PIL copy
+    By default the block is not unlinked: it still belongs to the creator
+    Set unlink when ownership was handed over (ex: worker process results)
+    """
+    shm = shared_memory.SharedMemory(name=desc["shm"])
+    try:
+        src = np.ndarray(desc["shape"],
+                         dtype=np.dtype(desc["dtype"]),
+                         buffer=shm.buf)
+        arr = src.copy()
+        del src
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    im = Image.fromarray(arr)
+    if im.mode != desc["mode"]:
+        im = im.convert(desc["mode"])
+    return im
+
+
+def encode_data(data, shms):
+    """
+    Encode a plugin data_in / data_out dictionary for a worker process
+    Values are EtherealImageR / EtherealImageW or lists of them
+    """
+    def encode_one(v):
+        if isinstance(v, EtherealImageR):
+            return ["R", v.encode(shms)]
+        elif isinstance(v, EtherealImageW):
+            return ["W", v.encode()]
+        else:
+            return ["raw", v]
+
+    ret = {}
+    for k, v in data.items():
+        if isinstance(v, list):
+            ret[k] = ["list", [encode_one(x) for x in v]]
+        else:
+            ret[k] = encode_one(v)
+    return ret
+
+
+def encode_data_results(data):
+    """
+    Worker side: place in memory results from data_out into shared memory
+    Ownership of the blocks passes to whoever calls decode_data_results()
+    """
+    ret = {}
+    for k, v in data.items():
+        if isinstance(v, EtherealImageW) and v.want_im:
+            shm, desc = image_to_shm(v.get_im())
+            shm.close()
+            ret[k] = {"im": desc, "save_kwargs": v.get_save_kwargs()}
+    return ret
+
+
+def decode_data_results(data, j):
+    """
+    Dispatcher side: pull results from encode_data_results() into data_out
+    """
+    for k, v in j.items():
+        # As if set_im() was called on this side
+        data[k].set_im(image_from_shm(v["im"], unlink=True),
+                       **v["save_kwargs"])
+
+
+def decode_data(j):
+    """
+    Inverse of encode_data() as run on the worker side
+    """
+    def decode_one(v):
+        t, val = v
+        if t == "R":
+            return EtherealImageR.decode(val)
+        elif t == "W":
+            return EtherealImageW.decode(val)
+        else:
+            return val
+
+    ret = {}
+    for k, (t, v) in j.items():
+        if t == "list":
+            ret[k] = [decode_one(x) for x in v]
+        else:
+            ret[k] = decode_one([t, v])
+    return ret
 
 
 class SubtaskException(Exception):
@@ -160,26 +453,31 @@ class SubtaskException(Exception):
 class TaskBarrier:
     """
     Track when all allocated tasks are complete
-    TODO: consider an event to wake up for faster response
     """
     def __init__(self):
         self.ntasks_allocated = 0
         self.ntasks_completed = 0
         self.exceptions = 0
+        # Tasks may be allocated from worker callbacks (ex: StreamCSIP)
+        self.cv = threading.Condition()
 
     def callback(self):
-        self.ntasks_completed += 1
+        with self.cv:
+            self.ntasks_completed += 1
+            if self.ntasks_completed >= self.ntasks_allocated:
+                self.cv.notify_all()
 
     def allocate_callback(self):
-        self.ntasks_allocated += 1
+        with self.cv:
+            self.ntasks_allocated += 1
         return self.callback
 
     def wait(self, timeout=None):
-        tstart = time.time()
-        while self.ntasks_allocated > self.ntasks_completed:
-            if timeout and time.time() - tstart > timeout:
+        with self.cv:
+            if not self.cv.wait_for(
+                    lambda: self.ntasks_allocated <= self.ntasks_completed,
+                    timeout=timeout):
                 raise Exception("Timed out")
-            time.sleep(0.1)
         if self.exceptions:
             raise SubtaskException("Task(s) completed with exception")
 
@@ -187,7 +485,86 @@ class TaskBarrier:
         return self.ntasks_allocated == self.ntasks_completed
 
     def add_exception(self):
-        self.exceptions += 1
+        with self.cv:
+            self.exceptions += 1
+
+
+# Higher runs first
+TASK_PRIORITY_BATCH = 0
+# Someone is waiting on the result (ex: GUI snapshot)
+TASK_PRIORITY_INTERACTIVE = 10
+
+
+class TaskScheduler:
+    """
+    Hands tasks to a pool of workers
+    Workers block in get() until a task is runnable: no polling
+
+    Tasks run in priority order, FIFO within the same priority
+    A task may list dependencies (other tasks given to put())
+    It becomes runnable once all of them are task_done()
+    """
+    def __init__(self):
+        self.cv = threading.Condition()
+        # (-priority, sequence, task)
+        self.ready = []
+        self.sequence = 0
+        # id(task) => task for everything put() but not yet task_done()
+        self.active = {}
+        # id(task) => [number of unfinished dependencies, priority, task]
+        self.blocked = {}
+        # id(task) => list of id(blocked task)
+        self.dependents = {}
+        self.closed = False
+
+    def _push(self, task, priority):
+        heapq.heappush(self.ready, (-priority, self.sequence, task))
+        self.sequence += 1
+        self.cv.notify()
+
+    def put(self, task, priority=TASK_PRIORITY_BATCH, deps=()):
+        with self.cv:
+            self.active[id(task)] = task
+            pending = [dep for dep in deps if id(dep) in self.active]
+            if pending:
+                self.blocked[id(task)] = [len(pending), priority, task]
+                for dep in pending:
+                    self.dependents.setdefault(id(dep), []).append(id(task))
+            else:
+                self._push(task, priority)
+
+    def get(self, timeout=None):
+        """
+        Return the highest priority runnable task
+        Return None if closed or on timeout
+        """
+        with self.cv:
+            self.cv.wait_for(lambda: self.ready or self.closed,
+                             timeout=timeout)
+            if self.closed or not self.ready:
+                return None
+            return heapq.heappop(self.ready)[2]
+
+    def task_done(self, task):
+        """
+        Task completed (successfully or not): release its dependents
+        """
+        with self.cv:
+            del self.active[id(task)]
+            for blocked_id in self.dependents.pop(id(task), []):
+                blocked = self.blocked[blocked_id]
+                blocked[0] -= 1
+                if blocked[0] == 0:
+                    del self.blocked[blocked_id]
+                    self._push(blocked[2], blocked[1])
+
+    def close(self):
+        """
+        Wake up all workers. get() returns None from now on
+        """
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
 
 
 def remove_intermediate_directories(top_dir, nested_dir):
@@ -234,51 +611,3 @@ def remove_intermediate_directories(top_dir, nested_dir):
 
     # Finally delete the tmp directory
     shutil.rmtree(tmp_dir)
-
-
-def find_qr_code_match(image, expr):
-    """
-    Scan image for QR code(s) and return first match
-    """
-    if not pyzbar:
-        raise ImportError("Failed to import pyzbar")
-
-    decode_results = pyzbar.pyzbar.decode(image)
-    for decoded in decode_results:
-        data = decoded.data
-        try:
-            m = re.match(expr, str(data, "utf-8"))
-            if m:
-                return m.string
-        except TypeError as e:
-            # Log this error?
-            print("Invalid qr_regex", e)
-            return None
-
-    # No detected match
-    return None
-
-
-def check_valid_image_dir(iindex, quick=False):
-    """
-    Quick: check for 0 size only
-    Slow: actually parse the image header
-    """
-    errors = 0
-    image_dir = iindex["dir"]
-    for fn_base in iindex["images"]:
-        fn = os.path.join(image_dir, fn_base)
-        if os.stat(fn).st_size == 0:
-            errors += 1
-            print(f"ERROR: bad file {fn}")
-        if not quick:
-            try:
-                with Image.open(fn) as _im:
-                    pass
-            except UnidentifiedImageError as e:
-                errors += 1
-                print(f"ERROR: bad file {e}")
-
-    if errors:
-        raise ValueError(
-            f"Directory contains invalid image files: {image_dir}")
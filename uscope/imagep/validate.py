@@ -0,0 +1,319 @@
+"""
+Check that a scan directory's images are intact (ex: before upload)
+
+Cheap structural checks run on every file, in parallel:
+-size: not empty
+-.jpg: SOI marker at the start, EOI marker at the end (catches truncated writes)
+-.tif: header, IFD chain and strip / tile data all within the file
+-.npy: header parses and array data is all there
+Only a random sample, plus anything failing the cheap checks, is fully decoded
+A file that fails a cheap check but decodes is a warning, not an error
+
+Problems are reported as dicts:
+{"file": basename, "check": "size" / "jpeg" / "tiff" / "npy" / "decode", "error": str, "fatal": bool}
+"""
+
+from uscope.imagep.codec import load_image, is_npy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import random
+import struct
+
+# Files fully decoded per directory, regardless of size
+SAMPLE_DECODES = 16
+# Files checked at once. Mostly waiting on (network) storage
+VALIDATE_THREADS = 16
+
+# Garbage some writers append after EOI
+JPEG_TAIL_BYTES = 64
+
+# TIFF type => value size
+TIFF_TYPE_SIZES = {
+    1: 1,  # BYTE
+    2: 1,  # ASCII
+    3: 2,  # SHORT
+    4: 4,  # LONG
+    5: 8,  # RATIONAL
+    6: 1,  # SBYTE
+    7: 1,  # UNDEFINED
+    8: 2,  # SSHORT
+    9: 4,  # SLONG
+    10: 8,  # SRATIONAL
+    11: 4,  # FLOAT
+    12: 8,  # DOUBLE
+    13: 4,  # IFD
+    16: 8,  # LONG8
+    17: 8,  # SLONG8
+    18: 8,  # IFD8
+}
+TIFF_OFFSET_FORMATS = {3: "H", 4: "I", 16: "Q"}
+# (offsets tag, byte counts tag)
+TIFF_DATA_TAGS = ((273, 279), (324, 325))
+# Guard against IFD loops
+TIFF_MAX_IFDS = 64
+
+
+class ImageCheckError(Exception):
+    def __init__(self, check, error):
+        super().__init__(f"{check}: {error}")
+        self.check = check
+        self.error = error
+
+
+class InvalidImageDir(ValueError):
+    """
+    problems: see module docstring
+    """
+    def __init__(self, msg, problems):
+        super().__init__(msg)
+        self.problems = problems
+
+
+def check_jpeg(f, size):
+    if size < 4 or f.read(2) != b"\xff\xd8":
+        raise ImageCheckError("jpeg", "missing SOI marker")
+    f.seek(max(0, size - JPEG_TAIL_BYTES))
+    if not f.read().rstrip(b"\x00").endswith(b"\xff\xd9"):
+        raise ImageCheckError("jpeg", "missing EOI marker (truncated?)")
+
+
+def tiff_values(f, endian, size, typ, count, value):
+    """
+    Return a list of integer values for an offsets / byte counts entry
+    """
+    fmt = TIFF_OFFSET_FORMATS.get(typ)
+    if fmt is None:
+        raise ImageCheckError("tiff", f"unexpected offset type {typ}")
+    nbytes = count * struct.calcsize(fmt)
+    if nbytes > len(value):
+        offset = struct.unpack(endian + ("Q" if len(value) == 8 else "I"),
+                               value)[0]
+        if offset + nbytes > size:
+            raise ImageCheckError("tiff", "offsets past end of file")
+        f.seek(offset)
+        value = f.read(nbytes)
+    return struct.unpack(endian + fmt * count, value[:nbytes])
+
+
+def check_tiff(f, size):
+    header = f.read(16)
+    if header[:2] == b"II":
+        endian = "<"
+    elif header[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ImageCheckError("tiff", "bad byte order")
+    magic = struct.unpack(endian + "H", header[2:4])[0]
+    if magic == 42:
+        big = False
+        offset = struct.unpack(endian + "I", header[4:8])[0]
+    elif magic == 43:
+        big = True
+        offset = struct.unpack(endian + "Q", header[8:16])[0]
+    else:
+        raise ImageCheckError("tiff", f"bad magic {magic}")
+    count_fmt, entry_size, next_fmt = ("Q", 20, "Q") if big else ("H", 12, "I")
+    count_size = struct.calcsize(count_fmt)
+    next_size = struct.calcsize(next_fmt)
+    has_data = False
+    ifds = 0
+    while offset:
+        ifds += 1
+        if ifds > TIFF_MAX_IFDS:
+            raise ImageCheckError("tiff", "too many IFDs (loop?)")
+        if offset + count_size > size:
+            raise ImageCheckError("tiff", "IFD past end of file")
+        f.seek(offset)
+        n = struct.unpack(endian + count_fmt, f.read(count_size))[0]
+        table_size = n * entry_size + next_size
+        if offset + count_size + table_size > size:
+            raise ImageCheckError("tiff", "IFD past end of file")
+        table = f.read(table_size)
+        # tag => (type, count, value / offset bytes)
+        entries = {}
+        for i in range(n):
+            entry = table[i * entry_size:(i + 1) * entry_size]
+            tag, typ = struct.unpack(endian + "HH", entry[:4])
+            if big:
+                count = struct.unpack(endian + "Q", entry[4:12])[0]
+                value = entry[12:20]
+            else:
+                count = struct.unpack(endian + "I", entry[4:8])[0]
+                value = entry[8:12]
+            entries[tag] = (typ, count, value)
+            # Values that don't fit in the entry live elsewhere in the file
+            nbytes = count * TIFF_TYPE_SIZES.get(typ, 0)
+            if nbytes > len(value) and struct.unpack(
+                    endian + ("Q" if big else "I"), value)[0] + nbytes > size:
+                raise ImageCheckError("tiff",
+                                      f"tag {tag} data past end of file")
+        for offsets_tag, counts_tag in TIFF_DATA_TAGS:
+            if offsets_tag not in entries:
+                continue
+            if counts_tag not in entries:
+                raise ImageCheckError(
+                    "tiff", f"tag {offsets_tag} without {counts_tag}")
+            offsets = tiff_values(f, endian, size, *entries[offsets_tag])
+            counts = tiff_values(f, endian, size, *entries[counts_tag])
+            if len(offsets) != len(counts):
+                raise ImageCheckError("tiff", "offsets / byte counts mismatch")
+            if max(o + c for o, c in zip(offsets, counts)) > size:
+                raise ImageCheckError(
+                    "tiff", "image data past end of file (truncated?)")
+            has_data = True
+        offset = struct.unpack(endian + next_fmt, table[n * entry_size:])[0]
+    if not has_data:
+        raise ImageCheckError("tiff", "no image data")
+
+
+def check_npy(f, size):
+    try:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _fortran_order, dtype = np.lib.format.read_array_header_1_0(
+                f)
+        else:
+            shape, _fortran_order, dtype = np.lib.format.read_array_header_2_0(
+                f)
+    except ValueError as e:
+        raise ImageCheckError("npy", str(e))
+    expect = f.tell() + int(np.prod(shape)) * dtype.itemsize
+    if size < expect:
+        raise ImageCheckError("npy", "array data truncated")
+
+
+# extension => structural check
+STRUCTURE_CHECKS = {
+    ".jpg": check_jpeg,
+    ".jpeg": check_jpeg,
+    ".tif": check_tiff,
+    ".tiff": check_tiff,
+    ".npy": check_npy,
+}
+
+
+def decode_image(fn):
+    if is_npy(fn):
+        # load_image() maps it: force a read
+        np.load(fn)
+        return
+    with load_image(fn) as im:
+        im.load()
+
+
+def validate_image(fn, decode=False):
+    """
+    Return list of problems with image file fn, empty if it's fine
+    decode: also fully decode it
+    """
+    basename = os.path.basename(fn)
+
+    def problem(check, error, fatal=True):
+        return {
+            "file": basename,
+            "check": check,
+            "error": error,
+            "fatal": fatal
+        }
+
+    try:
+        size = os.stat(fn).st_size
+    except OSError as e:
+        return [problem("size", str(e))]
+    if size == 0:
+        return [problem("size", "empty file")]
+    ret = []
+    check = STRUCTURE_CHECKS.get(os.path.splitext(fn)[1].lower())
+    if check:
+        try:
+            with open(fn, "rb") as f:
+                check(f, size)
+        except ImageCheckError as e:
+            ret.append(problem(e.check, e.error))
+        except (OSError, struct.error) as e:
+            ret.append(problem("size", f"short read: {e}"))
+    else:
+        # Unknown format: decode decides
+        decode = True
+    if ret or decode:
+        try:
+            decode_image(fn)
+            # Reader copes with it
+            for p in ret:
+                p["fatal"] = False
+        except Exception as e:
+            ret.append(problem("decode", str(e)))
+    return ret
+
+
+def validate_image_dir(iindex,
+                       quick=False,
+                       nthreads=VALIDATE_THREADS,
+                       sample=SAMPLE_DECODES):
+    """
+    quick: only check sizes
+    sample: number of files to fully decode
+    Return report dict:
+    {"files": N, "decoded": N sampled, "problems": [...]}
+    """
+    image_dir = iindex["dir"]
+    basenames = list(iindex["images"].keys())
+    sampled = set()
+    if not quick:
+        sampled = set(random.sample(basenames, min(sample, len(basenames))))
+
+    def check(basename):
+        fn = os.path.join(image_dir, basename)
+        if quick:
+            try:
+                if os.stat(fn).st_size:
+                    return []
+            except OSError:
+                pass
+            return [{
+                "file": basename,
+                "check": "size",
+                "error": "empty or missing file",
+                "fatal": True
+            }]
+        return validate_image(fn, decode=basename in sampled)
+
+    problems = []
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        for file_problems in executor.map(check, basenames):
+            problems += file_problems
+    return {
+        "files": len(basenames),
+        "decoded": len(sampled),
+        "problems": problems,
+    }
+
+
+def check_valid_image_dir(iindex, quick=False, log=None, **kwargs):
+    """
+    Raise InvalidImageDir if any image is damaged
+    Quick: check for 0 size only
+    Otherwise: structural checks (see module docstring)
+    Return validate_image_dir() report
+    """
+    if log is None:
+
+        def log(s):
+            print(s)
+
+    report = validate_image_dir(iindex, quick=quick, **kwargs)
+    errors = 0
+    for problem in report["problems"]:
+        fn = os.path.join(iindex["dir"], problem["file"])
+        if problem["fatal"]:
+            errors += 1
+            log(f"ERROR: bad file {fn}: {problem['check']}: {problem['error']}"
+                )
+        else:
+            log(f"WARNING: {fn}: {problem['check']}: {problem['error']}")
+    if errors:
+        raise InvalidImageDir(
+            f"Directory contains invalid image files: {iindex['dir']}",
+            report["problems"])
+    return report
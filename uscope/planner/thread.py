@@ -6,14 +6,18 @@ plannerj: planner configuration JSON. Written to disk
 """
 
 from uscope.planner.planner_util import get_planner
+from uscope.imagep.streams import run_planner_stream
 import threading
 
 
 class PlannerThreadBase:
-    def __init__(self, planner_args, progress_cb):
+    def __init__(self, planner_args, progress_cb, csip=None, stream_kwargs={}):
         self.planner_args = planner_args
         self.planner = None
         self.progress_cb = progress_cb
+        # Set to process tiles as they are captured (StreamCSIP)
+        self.csip = csip
+        self.stream_kwargs = stream_kwargs
 
     def log(self, msg=""):
         print(msg)
@@ -48,8 +52,17 @@ class PlannerThreadBase:
     def run(self):
         self.planner = get_planner(log=self.log, **self.planner_args)
         self.planner.register_progress_callback(self.progress_cb)
-        self.planner.run()
+        self.run_planner()
+
+    def run_planner(self):
+        if self.csip is None:
+            return self.planner.run()
+        else:
+            return run_planner_stream(self.planner, self.csip,
+                                      **self.stream_kwargs)
 
 
 class SimplePlannerThread(PlannerThreadBase, threading.Thread):
-    pass
+    def __init__(self, *args, **kwargs):
+        PlannerThreadBase.__init__(self, *args, **kwargs)
+        threading.Thread.__init__(self)
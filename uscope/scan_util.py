@@ -152,9 +152,11 @@ def index_scan_images(dir_in):
     stacks = 0
     stabilization = 0
     crs = OrderedDict()
+    # .npy: intermediate stages, see uscope.imagep.codec
     for fn_full in sorted(
             list(glob.glob(dir_in + "/*.jpg")) +
-            list(glob.glob(dir_in + "/*.tif"))):
+            list(glob.glob(dir_in + "/*.tif")) +
+            list(glob.glob(dir_in + "/*.npy"))):
         basename = os.path.basename(fn_full)
 
         v = iindex_parse_fn(basename)
@@ -4,55 +4,44 @@ Pre-process files for cloud stitch
 CloudStitch only operates on .jpg right now (bandwidth etc)
 So pre-process files / tifs individually first
 
-TODO: parallel
+Scans found in the scan dir are processed several at once, see uscope.imagep.jobs
 """
 
-from uscope.imagep.pipeline import process_dir, already_uploaded
+from uscope.imagep.jobs import ScanScheduler
 from uscope.cloud_stitch import CSInfo
 from uscope.util import add_bool_arg
 from uscope import config
 from uscope import cloud_stitch
-import os
-import time
 import json
+import sys
 
 
-def run(directories, batch_sleep=2400, microscope_name=None, *args, **kwargs):
-    if directories:
-        for directory in directories:
-            process_dir(directory,
-                        microscope_name=microscope_name,
-                        *args,
-                        **kwargs)
-    else:
-        # Something 3 like execution units right now
-        burst_size = 2
-        uploads = 0
+def run(directories,
+        batch_sleep=2400,
+        microscope_name=None,
+        watch=False,
+        max_scans=2,
+        nthreads=None,
+        **kwargs):
+    """
+    directories: process these, one at a time in the foreground
+    Otherwise process whatever is ready in the scan dir, max_scans at once
+    watch: then keep processing new scans as they complete
+    """
+    scheduler = ScanScheduler(directories=directories,
+                              scan_dir=config.get_bc().get_scan_dir(),
+                              watch=watch,
+                              nthreads=nthreads,
+                              max_scans=max_scans,
+                              upload_interval=batch_sleep,
+                              microscope_name=microscope_name,
+                              **kwargs)
+    if not directories:
         print("Scanning data dir for new scans")
-        # Only take the top directory listing
-        for root, directories, _files in os.walk(
-                config.get_bc().get_scan_dir()):
-            break
-        for basename in directories:
-            directory = os.path.join(root, basename)
-            if already_uploaded(directory):
-                print(f"{basename}: skip, already uploaded")
-                continue
-            print("")
-            print("")
-            print("")
-            print("*" * 78)
-            print(f"{basename}: not uploaded")
-            print("*" * 78)
-            if uploads >= burst_size:
-                print(
-                    "WARNING: throttling upload to let stitch server catch up")
-                time.sleep(batch_sleep)
-            process_dir(directory,
-                        *args,
-                        microscope_name=microscope_name,
-                        **kwargs)
-            uploads += 1
+    failed = scheduler.run()
+    if failed:
+        print("Failed: %s" % (", ".join(failed), ))
+    return failed
 
 
 def main():
@@ -76,7 +65,33 @@ def main():
         default=True,
         help="Best effort in lieu of crashing on error (ex: stack failure)")
     add_bool_arg(parser, "--quick-pano", default=None, help="")
-    parser.add_argument("--threads", default=None, type=int)
+    add_bool_arg(parser, "--preview-stitch", default=None, help="")
+    add_bool_arg(
+        parser,
+        "--fused",
+        default=None,
+        help="Process each tile through all steps at once (no intermediate images)")
+    parser.add_argument(
+        "--intermediate-format",
+        default=None,
+        help="Image format between steps: native, jpg, tif, tif-zstd, npy")
+    parser.add_argument("--threads",
+                        default=None,
+                        type=int,
+                        help="Worker threads shared by all scans")
+    parser.add_argument("--max-scans",
+                        default=2,
+                        type=int,
+                        help="Scans processed at once (scan dir mode)")
+    add_bool_arg(parser,
+                 "--watch",
+                 default=False,
+                 help="Keep running and process new scans as they complete")
+    add_bool_arg(
+        parser,
+        "--processes",
+        default=False,
+        help="Run image processing workers as processes instead of threads")
     parser.add_argument("--access-key")
     parser.add_argument("--secret-key")
     parser.add_argument("--id-key")
@@ -87,7 +102,8 @@ def main():
     parser.add_argument("--batch-sleep",
                         default=2400,
                         type=int,
-                        help="Hack for not overloading stitch service")
+                        help="Hack for not overloading stitch service: "
+                        "seconds between uploads after the first two")
     parser.add_argument("--ewf")
     parser.add_argument("--microscope")
     parser.add_argument("--json")
@@ -104,19 +120,29 @@ def main():
         j = json.loads(args.json)
     if args.quick_pano is not None:
         j["write_quick_pano"] = args.quick_pano
+    if args.preview_stitch is not None:
+        j["write_preview_stitch"] = args.preview_stitch
+    if args.fused is not None:
+        j["fused"] = args.fused
+    if args.intermediate_format is not None:
+        j["intermediate_format"] = args.intermediate_format
 
-    run(args.dirs_in,
-        cs_info=cs_info,
-        ewf=args.ewf,
-        upload=args.upload,
-        fix=args.fix,
-        best_effort=args.best_effort,
-        lazy=args.lazy,
-        batch_sleep=args.batch_sleep,
-        nthreads=args.threads,
-        microscope_name=args.microscope,
-        configj=j,
-        verbose=args.verbose)
+    failed = run(args.dirs_in,
+                 cs_info=cs_info,
+                 ewf=args.ewf,
+                 upload=args.upload,
+                 fix=args.fix,
+                 best_effort=args.best_effort,
+                 lazy=args.lazy,
+                 batch_sleep=args.batch_sleep,
+                 nthreads=args.threads,
+                 max_scans=args.max_scans,
+                 watch=args.watch,
+                 worker_mode="process" if args.processes else None,
+                 microscope_name=args.microscope,
+                 configj=j,
+                 verbose=args.verbose)
+    sys.exit(1 if failed else 0)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
+from uscope.imagep.plugins import hdr_merge_cv
 import cv2 as cv
-import numpy as np
 import glob
 import re
 import os
 import subprocess
 
 
-# https://docs.opencv.org/3.4/d2/df0/tutorial_py_hdr.html
 def process_image_cv(
     fns_in,
     exposure_times,
@@ -18,39 +17,19 @@ def process_image_cv(
     print("Processing", fns_in, exposure_times)
     # Loading exposure images into a list
     img_list = [cv.imread(fn) for fn in fns_in]
-    exposure_times = np.array(exposure_times, dtype=np.float32)
 
-    # Tonemap HDR image
-    tonemap1 = cv.createTonemap(gamma=2.2)
-
-    if fn_out_debevec:
-        # Merge exposures to HDR image
-        merge_debevec = cv.createMergeDebevec()
-        hdr_debevec = merge_debevec.process(img_list,
-                                            times=exposure_times.copy())
-        res_debevec = tonemap1.process(hdr_debevec.copy())
-        res_debevec_8bit = np.clip(res_debevec * 255, 0, 255).astype('uint8')
-        cv.imwrite(fn_out_debevec, res_debevec_8bit)
-        print("  Saving", fn_out_debevec)
-
-    if fn_out_robertson:
-        merge_robertson = cv.createMergeRobertson()
-        hdr_robertson = merge_robertson.process(img_list,
-                                                times=exposure_times.copy())
-        res_robertson = tonemap1.process(hdr_robertson.copy())
-        res_robertson_8bit = np.clip(res_robertson * 255, 0,
-                                     255).astype('uint8')
-        cv.imwrite(fn_out_robertson, res_robertson_8bit)
-        print("  Saving", fn_out_robertson)
-
-    if fn_out_mertens:
-        # Exposure fusion using Mertens
-        merge_mertens = cv.createMergeMertens()
-        res_mertens = merge_mertens.process(img_list)
-        # Convert datatype to 8-bit and save
-        res_mertens_8bit = np.clip(res_mertens * 255, 0, 255).astype('uint8')
-        cv.imwrite(fn_out_mertens, res_mertens_8bit)
-        print("  Saving", fn_out_mertens)
+    for method, fn_out in (
+        ("debevec", fn_out_debevec),
+        ("robertson", fn_out_robertson),
+        ("mertens", fn_out_mertens),
+    ):
+        if fn_out:
+            cv.imwrite(
+                fn_out,
+                hdr_merge_cv(img_list,
+                             method=method,
+                             exposure_times=exposure_times))
+            print("  Saving", fn_out)
 
 
 def run(